@@ -1,10 +1,15 @@
 from opentrons import protocol_api
 from opentrons.protocol_api import SINGLE, ALL
 #import time
-#import sys
+import sys
 #import imageio.v3 as iif
 #import imageio.v2 as iid
-import subprocess
+
+# helper scripts live next to record_video.py in the jupyter notebooks folder on the flex;
+# appended, not prepended, so their plain module names never shadow the robot server's packages
+if "/var/lib/jupyter/notebooks" not in sys.path:
+    sys.path.append("/var/lib/jupyter/notebooks")
+from recorder_control import recorded
 
 metadata = {
     'protocolName': 'BSA Assay with Video Recording',
@@ -17,6 +22,7 @@ requirements = {
     "apiLevel": "2.21"
 }
 
+@recorded(estimated_minutes=60)
 def run(protocol: protocol_api.ProtocolContext):
     #say hello
     protocol.comment("Place BSA Standard in A1, Lysis buffer in A2, and samples in row B")
@@ -26,11 +32,6 @@ def run(protocol: protocol_api.ProtocolContext):
     num_rows = 8  # A-H
     num_replicates = 3  # the number of replicates
 
-    #Start recording the video
-    video_output_file = 'BCA_Assay_012425.mp4'
-    device_index = "<video2>"
-    duration = 200
-    video_process = subprocess.Popen(["python3", "/var/lib/jupyter/notebooks/record_video.py"])
 
     # Load modules
     heater_shaker = protocol.load_module('heaterShakerModuleV1', 'D1')
@@ -202,7 +203,4 @@ def run(protocol: protocol_api.ProtocolContext):
     heater_shaker.deactivate_shaker()
     heater_shaker.deactivate_heater()
     heater_shaker.open_labware_latch()
-    temp_module.deactivate()
-
-    # Stop video recording after the main task is completed
-    video_process.terminate()
\ No newline at end of file
+    temp_module.deactivate()
\ No newline at end of file
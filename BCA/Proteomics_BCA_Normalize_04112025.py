@@ -1,11 +1,17 @@
 from opentrons import protocol_api
 from opentrons.protocol_api import SINGLE, ALL
-import pandas as pd
-import numpy as np
-import subprocess
 from pathlib import Path
 import datetime
 import time
+import sys
+
+# helper scripts live next to record_video.py in the jupyter notebooks folder on the flex;
+# appended, not prepended, so their plain module names never shadow the robot server's packages
+if "/var/lib/jupyter/notebooks" not in sys.path:
+    sys.path.append("/var/lib/jupyter/notebooks")
+from file_watcher import wait_for_file
+from normalization import load_or_plan
+from recorder_control import recorded
 
 metadata = {
     'protocolName': 'BCA Assay with Normalization and Video Recording',
@@ -18,7 +24,9 @@ requirements = {
     "apiLevel": "2.21"
 }
 
+@recorded(estimated_minutes=120)
 def run(protocol: protocol_api.ProtocolContext):
+    run_started = time.time()  # the plate reader export must be newer than this
     #######################################################################################
     protocol.comment(
         "Place BSA Standard in A1, Lysis buffer in A2, tbta in A3, biotin in A4, cuso4 in A5, tcep in A6 and samples in row B")
@@ -30,11 +38,6 @@ def run(protocol: protocol_api.ProtocolContext):
     num_rows = 8  # A-H
     num_replicates = 3  # the number of replicates
 
-    #Start recording the video
-    video_output_file = 'BCA_Assay_012425.mp4'
-    device_index = "<video2>"
-    duration = 400
-    video_process = subprocess.Popen(["python3", "/var/lib/jupyter/notebooks/record_video.py"])
 
     # Load modules
     heater_shaker = protocol.load_module('heaterShakerModuleV1', 'D1')
@@ -232,81 +235,26 @@ def run(protocol: protocol_api.ProtocolContext):
     # Get today's date in YYMMDD format
     today_date = datetime.date.today().strftime("%y%m%d")
 
-    find_file = subprocess.Popen(['python3',"/var/lib/jupyter/notebooks/wait_for_file.py"],stdout=subprocess.PIPE,
-        text=True)
-    stdout, stderr = find_file.communicate()
-
-    if stderr:
-        raise ValueError(f"Error while waiting for file: {stderr}")
-
-    # Extract the file path from the output
-    file_path = stdout.splitlines()[1]
-    if not file_path:
-        raise ValueError("No file path returned by wait_for_file.py")
+    # Wait here for the plate reader export, reported in the run log (see file_watcher.py)
+    plate_file = wait_for_file(directory, prefix=today_date, report=protocol.comment, since=run_started)
+    file_path = plate_file.path
 
     protocol.comment(f"Successfully loaded: {file_path}")
-    # Read the data file
-    df = pd.read_excel(file_path, header=5, nrows=8, usecols="C:N")
-
-    # Create a list of well names (A1 to H12)
-    well_names = [f"{row}{col}" for col in range(1, 13) for row in "ABCDEFGH"]
-
-    # Flatten the absorbance values into a single list
-    absorbance_values = df.values.flatten()
-
-    # Create the DataFrame
-    initial_df = pd.DataFrame({'Well': well_names, 'Absorbance': absorbance_values})
-
-    # Process data for normalization
-    samples, replicate_1, replicate_2, replicate_3 = [], [], [], []
-    sample_index = 1
-    for col_offset in range(0, 12, 3):  # Iterate by column groups (triplets)
-        for row_offset in range(8):  # Iterate row-wise for each sample
-            start = row_offset * 12 + col_offset  # Starting index for the sample
-            if start + 2 < len(initial_df):
-                samples.append(f"Sample {sample_index}")
-                replicate_1.append(initial_df.iloc[start]['Absorbance'])
-                replicate_2.append(initial_df.iloc[start + 1]['Absorbance'])
-                replicate_3.append(initial_df.iloc[start + 2]['Absorbance'])
-                sample_index += 1
-
-    final_df = pd.DataFrame({
-        'Sample': samples,
-        'Replicate 1': replicate_1,
-        'Replicate 2': replicate_2,
-        'Replicate 3': replicate_3
-    })
-
-    samples_1_to_8 = final_df.iloc[:8]
-    samples_1_to_8['Mean Absorbance'] = samples_1_to_8[['Replicate 1', 'Replicate 2', 'Replicate 3']].mean(axis=1)
-    protein_concentrations = [10, 5, 2.5, 1.25, 0.625, 0.3125, 0.15625, 0]
-    samples_1_to_8['Protein Concentration (mg/mL)'] = protein_concentrations
-
-    slope, intercept = np.polyfit(samples_1_to_8['Protein Concentration (mg/mL)'], samples_1_to_8['Mean Absorbance'], 1)
-    y_pred = slope * samples_1_to_8['Protein Concentration (mg/mL)'] + intercept
-    ss_res = np.sum((samples_1_to_8['Mean Absorbance'] - y_pred) ** 2)
-    ss_tot = np.sum((samples_1_to_8['Mean Absorbance'] - np.mean(samples_1_to_8['Mean Absorbance'])) ** 2)
-    r_squared = 1 - (ss_res / ss_tot)
-
-    unknown_samples = final_df.iloc[8:8 + num_samples]
-    unknown_samples['Mean Absorbance'] = unknown_samples[['Replicate 1', 'Replicate 2', 'Replicate 3']].mean(axis=1)
-    unknown_samples['Protein Concentration (mg/mL)'] = (unknown_samples['Mean Absorbance'] - intercept) / slope
-
-
-    unknown_samples['Sample Volume (mL)'] = (target_concentration * final_volume) / unknown_samples['Protein Concentration (mg/mL)']
-    unknown_samples['Diluent Volume (mL)'] = final_volume - unknown_samples['Sample Volume (mL)']
-    unknown_samples.loc[unknown_samples['Sample Volume (mL)'] > final_volume, ['Sample Volume (mL)', 'Diluent Volume (mL)']] = [final_volume, 0]
-    protocol.comment("\nNormalized Unknown Samples (to 1 mg/mL in 500 µL):")
-    print(unknown_samples[['Sample', 'Protein Concentration (mg/mL)', 'Sample Volume (mL)', 'Diluent Volume (mL)']])
-
-    normalized_samples = unknown_samples[['Sample', 'Protein Concentration (mg/mL)', 'Sample Volume (mL)', 'Diluent Volume (mL)']].reset_index().drop(columns='index')
     rows = ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H']
-    destination_wells  = [f'{rows[i % 8]}{(i // 8)+ 1}' for i in range(len(normalized_samples))]
-
-    for i, row in normalized_samples.iterrows():
-        source_well = sample_locations[i]
-        normalized_volume = row['Sample Volume (mL)']
-        diluent_volume = 500 - normalized_volume
-        destination_well = destination_wells[i]
-        p1000_multi.transfer(normalized_volume, temp_adapter[source_well], plate3[destination_well], rate=0.5, new_tip='once')
-        p1000_multi.transfer(diluent_volume, reservoir['A7'], plate3[destination_well], rate=0.5, new_tip='once')
+    destination_wells  = [f'{rows[i % 8]}{(i // 8)+ 1}' for i in range(num_samples)]
+
+    # The transfer plan for this export (see normalization.py): made at the plate reader with
+    # normalization.py, or here the same way. All volumes in it are in µL.
+    plan = load_or_plan(file_path, num_samples, sources=sample_locations, destinations=destination_wells,
+                        target_mg_ml=target_concentration, final_ul=final_volume * 1000, prefilled_ul=0)
+    for note in plan['notes']:
+        protocol.comment(note)
+    protocol.comment(f"Normalizing to {target_concentration} mg/mL in {plan['final_ul']:g} µL:")
+    for transfer in plan['transfers']:
+        protocol.comment(f"{transfer['name']}: {transfer['sample_ul']} µL sample + {transfer['diluent_ul']} µL diluent")
+
+    for transfer in plan['transfers']:
+        if transfer['sample_ul'] > 0:
+            p1000_multi.transfer(transfer['sample_ul'], temp_adapter[transfer['source']], plate3[transfer['destination']], rate=0.5, new_tip='once')
+        if transfer['diluent_ul'] > 0:
+            p1000_multi.transfer(transfer['diluent_ul'], reservoir['A7'], plate3[transfer['destination']], rate=0.5, new_tip='once')
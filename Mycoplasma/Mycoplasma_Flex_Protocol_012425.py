@@ -1,6 +1,12 @@
 from opentrons import protocol_api
 from opentrons.protocol_api import SINGLE, ALL
-import subprocess
+import sys
+
+# helper scripts live next to record_video.py in the jupyter notebooks folder on the flex;
+# appended, not prepended, so their plain module names never shadow the robot server's packages
+if "/var/lib/jupyter/notebooks" not in sys.path:
+    sys.path.append("/var/lib/jupyter/notebooks")
+from recorder_control import recorded
 
 metadata = {
     'protocolName': 'Mycoplasma Detection PCR Protocol',
@@ -13,6 +19,7 @@ requirements = {
     "apiLevel": "2.21"
 }
 
+@recorded(estimated_minutes=45)
 def run(protocol: protocol_api.ProtocolContext):
 
     # Enter the number of samples 
@@ -21,12 +28,6 @@ def run(protocol: protocol_api.ProtocolContext):
     # Step 4: Gel preparation and loading (manual step for now)
     protocol.comment("This protcol runs pcr assay for mycoplasma contamination.")
     
-    #Start recording the video
-    video_output_file = 'BCA_Assay_012425.mp4'
-    device_index = "<video2>"
-    duration = 200
-    video_process = subprocess.Popen(["python3", "/var/lib/jupyter/notebooks/record_video.py"])
-    
     # Load modules
     heater_shaker = protocol.load_module('heaterShakerModuleV1', 'D1')
     thermocycler = protocol.load_module('thermocyclerModuleV2')
@@ -128,8 +129,5 @@ def run(protocol: protocol_api.ProtocolContext):
     thermocycler.set_block_temperature(4)  # Hold at 4°C
     thermocycler.open_lid()
     
-    # Stop video recording after the main task is completed
-    video_process.terminate()
-    
     # Step 4: Gel preparation and loading (manual step for now)
     protocol.comment("After PCR, analyze products on a 2% agarose gel stained with ethidium bromide or SafeView.")
\ No newline at end of file
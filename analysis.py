@@ -0,0 +1,210 @@
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from typing import Any, Callable
+
+# Vision checks on the live camera feed (tip on the pipette, plate seated on
+# the heater-shaker, labware in the gripper) without touching the capture or
+# recording path.
+#
+# A sampler thread wakes up only when an analyzer is due, takes the newest
+# frame from the camera ring (a reference, no copy, no waiting) and submits
+# its JPEG bytes to a process pool of niced workers, so decoding and analysis
+# never hold the GIL of the process that captures or records. Each analyzer
+# has at most one frame in flight: if it is still busy when its next frame is
+# due, that frame is skipped (and counted) instead of queueing up. Results
+# come back with the frame's capture time on a bounded queue; when nobody
+# drains it the oldest results are discarded.
+#
+# An analyzer is a plain top-level function taking the JPEG bytes (use
+# decode() for an RGB array) and returning anything picklable, e.g.
+#
+#     def tip_present(data): ...
+#     analysis.register("tip", tip_present, interval=1.0)
+#
+# The workers are spawned, so they import the analyzer's module and the main
+# script afresh: a script using FrameAnalysis needs the usual
+# `if __name__ == "__main__":` guard.
+
+WORKERS = 2
+RESULTS_SIZE = 256
+
+
+@dataclass(frozen=True)
+class AnalysisResult:
+    """What one analyzer found in one frame."""
+
+    name: str
+    seq: int
+    timestamp: float  # capture time of the frame
+    finished: float   # when the analyzer returned
+    value: Any = None
+    error: str = None
+
+
+@dataclass
+class _Analyzer:
+    name: str
+    fn: Callable
+    interval: float
+    due: float = 0.0
+    busy: bool = False
+    seq: int = -1  # last frame submitted
+    analyzed: int = 0
+    skipped: int = 0
+    failed: int = 0
+
+
+def decode(data: bytes):
+    """Decode a JPEG frame to an RGB numpy array (height, width, 3), for use inside analyzers."""
+    import io
+
+    import numpy as np
+    from PIL import Image
+
+    return np.asarray(Image.open(io.BytesIO(data)).convert("RGB"))
+
+
+def _nice():
+    if hasattr(os, "nice"):
+        os.nice(10)
+
+
+class FrameAnalysis:
+    """
+    Run registered analyzers on sampled frames of a FrameRing in a process pool.
+
+    Args:
+        ring (FrameRing): Camera ring to sample (camera.ring).
+        workers (int): Worker processes.
+        results_size (int): Results kept for get() before the oldest are dropped.
+    """
+
+    def __init__(self, ring, workers: int = WORKERS, results_size: int = RESULTS_SIZE):
+        self.ring = ring
+        self.workers = workers
+        self.results = queue.Queue(maxsize=results_size)
+        self._analyzers = {}
+        self._latest = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._pool = None
+        self._thread = None
+
+    def register(self, name: str, fn: Callable, interval: float = 1.0):
+        """
+        Add an analyzer, run on at most one frame every interval seconds.
+
+        Args:
+            name (str): Name the results carry.
+            fn: Top-level (picklable) function taking JPEG bytes.
+            interval (float): Seconds between sampled frames.
+        """
+        with self._lock:
+            self._analyzers[name] = _Analyzer(name, fn, interval)
+        self._wake.set()
+
+    def unregister(self, name: str):
+        with self._lock:
+            self._analyzers.pop(name, None)
+            self._latest.pop(name, None)
+
+    def start(self):
+        self._pool = self._new_pool()
+        self._thread = threading.Thread(target=self._run, name="analysis", daemon=True)
+        self._thread.start()
+        return self
+
+    def _new_pool(self) -> ProcessPoolExecutor:
+        # spawn, not fork: the parent has camera and server threads
+        return ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"), initializer=_nice)
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def get(self, timeout: float = None) -> AnalysisResult:
+        """
+        Next result, oldest first.
+
+        Raises:
+            queue.Empty: If none arrives within timeout.
+        """
+        return self.results.get(timeout=timeout)
+
+    def latest(self) -> dict:
+        """The most recent result of every analyzer, by name."""
+        with self._lock:
+            return dict(self._latest)
+
+    def stats(self) -> dict:
+        """Frames analyzed, skipped (analyzer still busy) and failed, per analyzer."""
+        with self._lock:
+            return {a.name: {"analyzed": a.analyzed, "skipped": a.skipped, "failed": a.failed}
+                    for a in self._analyzers.values()}
+
+    def _run(self):
+        while not self._stop.is_set():
+            now = time.time()
+            with self._lock:
+                due = [a for a in self._analyzers.values() if a.due <= now]
+                wake = min((a.due for a in self._analyzers.values()), default=now + 1.0)
+            frame = self.ring.latest() if due else None
+            if not due:
+                self._wake.wait(max(wake - now, 0.01))
+            elif frame is None:
+                self._wake.wait(0.1)  # no frame from the camera yet
+            else:
+                for analyzer in due:
+                    analyzer.due = max(analyzer.due + analyzer.interval, now)
+                    if frame.seq == analyzer.seq:
+                        continue  # the camera has stopped; nothing new to look at
+                    if analyzer.busy:
+                        analyzer.skipped += 1
+                        continue
+                    try:
+                        future = self._pool.submit(analyzer.fn, frame.data)
+                    except BrokenProcessPool:
+                        # a worker died (e.g. an analyzer crashed the interpreter): start over
+                        print("Analysis worker died, restarting the pool")
+                        self._pool = self._new_pool()
+                        continue
+                    analyzer.busy = True
+                    analyzer.seq = frame.seq
+                    future.add_done_callback(lambda f, a=analyzer, fr=frame: self._done(a, fr, f))
+            self._wake.clear()
+
+    def _done(self, analyzer: _Analyzer, frame, future):
+        analyzer.busy = False
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is None:
+            analyzer.analyzed += 1
+            result = AnalysisResult(analyzer.name, frame.seq, frame.timestamp, time.time(), future.result())
+        else:
+            analyzer.failed += 1
+            result = AnalysisResult(analyzer.name, frame.seq, frame.timestamp, time.time(),
+                                    error=f"{type(error).__name__}: {error}")
+        with self._lock:
+            if analyzer.name in self._analyzers:
+                self._latest[analyzer.name] = result
+        while True:
+            try:
+                self.results.put_nowait(result)
+                break
+            except queue.Full:
+                try:
+                    self.results.get_nowait()
+                except queue.Empty:
+                    pass
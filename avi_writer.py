@@ -0,0 +1,197 @@
+import struct
+import sys
+from array import array
+
+# Minimal MJPEG-in-AVI muxer. The camera already delivers JPEG frames, so the
+# recorder can store them as-is: every frame is one '00dc' chunk written
+# straight from the capture buffer, with no decode, no pixel copy and no
+# re-encode. Any player that handles AVI (VLC, ffmpeg, browsers via a later
+# transcode) can open the result.
+
+AVIF_HASINDEX = 0x10
+AVIIF_KEYFRAME = 0x10
+
+# AVI 1.0 uses 32-bit chunk sizes and most readers give up past 2 GB
+MAX_FILE_SIZE = 2**31 - 2**24
+
+
+def jpeg_size(data: bytes) -> tuple:
+    """
+    Read (width, height) from a JPEG's start-of-frame marker without decoding it.
+
+    Raises:
+        ValueError: If data is not a baseline/progressive JPEG.
+    """
+    if data[:2] != b"\xff\xd8":
+        raise ValueError("Not a JPEG frame")
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            i += 1
+            continue
+        marker = data[i + 1]
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7 or marker == 0xFF:
+            i += 1 if marker == 0xFF else 2
+            continue
+        length = struct.unpack_from(">H", data, i + 2)[0]
+        # SOF0..SOF15 except DHT (C4), JPG (C8) and DAC (CC)
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack_from(">HH", data, i + 5)
+            return width, height
+        i += 2 + length
+    raise ValueError("JPEG frame has no start-of-frame marker")
+
+
+class MjpegAviWriter:
+    """
+    Write JPEG frames into an AVI container without re-encoding.
+
+    Frame size is taken from the first frame. When frames are given timestamps,
+    the writer keeps the file on a constant fps timeline: gaps are filled with
+    empty chunks (players repeat the previous frame) and frames arriving faster
+    than fps are skipped, so playback runs in real time.
+
+    Args:
+        output_file (str): Path to the .avi file.
+        fps (float): Nominal frame rate stored in the header.
+    """
+
+    def __init__(self, output_file: str, fps: float):
+        self.output_file = output_file
+        self.fps = fps
+        self.frames = 0
+        self.size = 0
+        self.last_offset = None  # file offset of the most recent chunk
+        self._offsets = array("I")
+        self._sizes = array("I")
+        self._max_chunk = 0
+        self._start_time = None
+        self._origin = None
+        self._dimensions = None
+        self._file = open(output_file, "wb")
+        self._movi = None
+
+    def write(self, data: bytes, timestamp: float = None, index: int = None) -> bool:
+        """
+        Append one JPEG frame.
+
+        Args:
+            data (bytes): Complete JPEG image as delivered by the camera.
+            timestamp (float): Capture time in seconds, used to place the frame on the fps timeline.
+            index (int): Position on the fps timeline, if the caller already knows it. The
+                first frame written defines the start of the timeline. With neither
+                timestamp nor index the frame is appended unconditionally.
+
+        Returns:
+            bool: False if the frame was skipped because it arrived ahead of the timeline.
+        """
+        if self._movi is None:
+            self._dimensions = jpeg_size(data)
+            self._write_headers()
+        if timestamp is not None and index is None:
+            if self._start_time is None:
+                self._start_time = timestamp
+            index = int((timestamp - self._start_time) * self.fps + 0.5)
+        if index is not None:
+            if self._origin is None:
+                self._origin = index
+            index -= self._origin
+            if index < self.frames:
+                return False
+            while self.frames < index:
+                self._chunk(b"")
+        self._chunk(data)
+        return True
+
+    @property
+    def full(self) -> bool:
+        return self.size >= MAX_FILE_SIZE
+
+    def close(self):
+        if self._file.closed:
+            return
+        if self._movi is None:
+            self._file.close()
+            return
+        f = self._file
+        movi_end = f.tell()
+        entries = array("I")
+        chunk_id = _fourcc(b"00dc")
+        for offset, size in zip(self._offsets, self._sizes):
+            entries.extend((chunk_id, AVIIF_KEYFRAME, offset, size))
+        if sys.byteorder == "big":
+            entries.byteswap()
+        f.write(b"idx1" + struct.pack("<I", len(entries) * 4))
+        f.write(entries.tobytes())
+        end = f.tell()
+        # patch sizes and frame counts now that they are known
+        f.seek(4)
+        f.write(struct.pack("<I", end - 8))
+        f.seek(self._movi - 4)
+        f.write(struct.pack("<I", movi_end - self._movi))
+        f.seek(12)
+        self._write_hdrl()
+        f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _chunk(self, data: bytes):
+        f = self._file
+        size = len(data)
+        self.last_offset = f.tell()
+        self._offsets.append(self.last_offset - self._movi)
+        self._sizes.append(size)
+        f.write(b"00dc" + struct.pack("<I", size))
+        if size:
+            f.write(data)
+            if size & 1:
+                f.write(b"\0")
+        self._max_chunk = max(self._max_chunk, size)
+        self.frames += 1
+        self.size = f.tell()
+
+    def _write_headers(self):
+        self._file.write(b"RIFF\0\0\0\0AVI ")
+        self._write_hdrl()
+        self._file.write(b"LIST\0\0\0\0movi")
+        self._movi = self._file.tell() - 4
+
+    def _write_hdrl(self):
+        width, height = self._dimensions
+        usec_per_frame = int(1_000_000 / self.fps)
+        rate, scale = _rational(self.fps)
+        avih = struct.pack(
+            "<10I16x",
+            usec_per_frame, self._max_chunk * int(self.fps + 1), 0, AVIF_HASINDEX,
+            self.frames, 0, 1, self._max_chunk, width, height,
+        )
+        strh = struct.pack(
+            "<4s4sIHHIIIIIIIIhhhh",
+            b"vids", b"MJPG", 0, 0, 0, 0, scale, rate, 0, self.frames,
+            self._max_chunk, 0xFFFFFFFF, 0, 0, 0, width, height,
+        )
+        strf = struct.pack("<IiiHH4sIiiII", 40, width, height, 1, 24, b"MJPG", width * height * 3, 0, 0, 0, 0)
+        strl = _list(b"strl", _chunk(b"strh", strh) + _chunk(b"strf", strf))
+        self._file.write(_list(b"hdrl", _chunk(b"avih", avih) + strl))
+
+
+def _fourcc(code: bytes) -> int:
+    return struct.unpack("<I", code)[0]
+
+
+def _chunk(fourcc: bytes, payload: bytes) -> bytes:
+    return fourcc + struct.pack("<I", len(payload)) + payload
+
+
+def _list(kind: bytes, payload: bytes) -> bytes:
+    return b"LIST" + struct.pack("<I", len(payload) + 4) + kind + payload
+
+
+def _rational(fps: float) -> tuple:
+    """Express fps as the (rate, scale) pair AVI stream headers use."""
+    scale = 1 if float(fps).is_integer() else 1000
+    return int(round(fps * scale)), scale
@@ -0,0 +1,379 @@
+import os
+import socket
+import struct
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+
+# Single owner of the flex camera. One capture loop reads JPEG frames from the
+# V4L2 device and publishes them into a FrameRing. Every consumer on the robot
+# (the video app's viewers, the recorder) reads from that ring, either in the
+# same process or through the local frame socket, so /dev/video2 is opened and
+# read exactly once no matter how many consumers there are.
+
+DEVICE_PATH = "/dev/video2"
+SOCKET_PATH = "/tmp/flex_camera.sock"
+RING_SIZE = 64
+
+# seq, capture timestamp, payload length
+_HEADER = struct.Struct("!QdI")
+
+
+class CameraFormatError(ValueError):
+    """The requested resolution, pixel format or frame rate is not offered by the device."""
+
+
+def choose_frame_type(frame_types, pixel_format: str = "MJPG", width: int = None, height: int = None,
+                      fps: float = None):
+    """
+    Validate a capture request against the frame types the device reports.
+
+    Args:
+        frame_types: Device frame types (v4l2py FrameType: pixel_format, width, height, min_fps, max_fps).
+        pixel_format (str): Four character code, e.g. "MJPG".
+        width (int): Requested width, or None to accept the device default.
+        height (int): Requested height, or None to accept the device default.
+        fps (float): Requested frame rate, or None to accept the device default.
+
+    Returns:
+        tuple: (width, height, fps) to set on the device, None for anything left at the
+        device default. fps is the lowest supported rate at or above the request; the
+        consumer decimates the rest.
+
+    Raises:
+        CameraFormatError: If the device cannot deliver the request.
+    """
+    code = _fourcc(pixel_format)
+    formats = [ft for ft in frame_types if int(ft.pixel_format) == code]
+    if not formats:
+        offered = sorted({_fourcc_str(int(ft.pixel_format)) for ft in frame_types})
+        raise CameraFormatError(f"Camera does not offer {pixel_format} frames (offers {', '.join(offered)})")
+    if width is not None or height is not None:
+        formats = [ft for ft in formats if width in (None, ft.width) and height in (None, ft.height)]
+        if not formats:
+            sizes = sorted({(ft.width, ft.height) for ft in frame_types if int(ft.pixel_format) == code})
+            raise CameraFormatError(
+                f"Camera does not offer {width or '*'}x{height or '*'} {pixel_format} "
+                f"(offers {', '.join(f'{w}x{h}' for w, h in sizes)})"
+            )
+        # the first match fills in a dimension that was left open
+        width, height = formats[0].width, formats[0].height
+        formats = [ft for ft in formats if (ft.width, ft.height) == (width, height)]
+    if fps is None:
+        return width, height, None
+    rates = sorted(float(ft.max_fps) for ft in formats)
+    if fps > rates[-1]:
+        raise CameraFormatError(f"Camera cannot capture {pixel_format} at {fps:g} fps (max {rates[-1]:g})")
+    return width, height, min(rate for rate in rates if rate >= fps)
+
+
+def _fourcc(code: str) -> int:
+    return ord(code[0]) | ord(code[1]) << 8 | ord(code[2]) << 16 | ord(code[3]) << 24
+
+
+def _fourcc_str(value: int) -> str:
+    return "".join(chr((value >> shift) & 0xFF) for shift in (0, 8, 16, 24))
+
+
+@dataclass(frozen=True)
+class Frame:
+    seq: int
+    timestamp: float
+    data: bytes
+
+
+class FrameRing:
+    """
+    Fixed-size buffer of the most recent frames shared by all consumers.
+
+    Args:
+        size (int): Number of frames kept before the oldest is overwritten.
+    """
+
+    def __init__(self, size: int = RING_SIZE):
+        self._frames = deque(maxlen=size)
+        self._cond = threading.Condition()
+        self._next_seq = 0
+        self.closed = False
+
+    def publish(self, data: bytes, timestamp: float = None) -> Frame:
+        """Append a new frame and wake every waiting consumer."""
+        with self._cond:
+            frame = Frame(self._next_seq, time.time() if timestamp is None else timestamp, data)
+            self._append(frame)
+        return frame
+
+    def put(self, frame: Frame):
+        """Append a frame that already has a sequence number (e.g. from the frame socket)."""
+        with self._cond:
+            self._append(frame)
+
+    def _append(self, frame: Frame):
+        self._frames.append(frame)
+        self._next_seq = frame.seq + 1
+        self._cond.notify_all()
+
+    @property
+    def next_seq(self) -> int:
+        return self._next_seq
+
+    def latest(self) -> Frame:
+        with self._cond:
+            return self._frames[-1] if self._frames else None
+
+    def seq_at(self, timestamp: float) -> int:
+        """Seq of the oldest frame still held that was captured at or after timestamp (next_seq if none)."""
+        with self._cond:
+            for frame in self._frames:
+                if frame.timestamp >= timestamp:
+                    return frame.seq
+            return self._next_seq
+
+    def wait_next(self, after_seq: int = -1, timeout: float = None) -> Frame:
+        """
+        Return the first frame newer than after_seq, blocking until one arrives.
+
+        If the caller fell so far behind that the frame it wants was already
+        overwritten, the oldest frame still held is returned; the gap in seq
+        tells the caller how many frames it missed.
+
+        Returns:
+            Frame or None on timeout or when the ring is closed.
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.closed or self._next_seq > after_seq + 1, timeout):
+                return None
+            if not self._frames or (self.closed and self._next_seq <= after_seq + 1):
+                return None
+            index = max(after_seq + 1 - self._frames[0].seq, 0)
+            return self._frames[index]
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+
+def iter_frames(ring: FrameRing, timeout: float = 5.0):
+    """Yield frames from the ring in order until it is closed or goes quiet for timeout seconds."""
+    seq = -1
+    while True:
+        frame = ring.wait_next(seq, timeout)
+        if frame is None:
+            return
+        seq = frame.seq
+        yield frame
+
+
+class Camera:
+    """
+    Long-lived capture loop shared by every consumer on the robot.
+
+    The first Camera to start opens the V4L2 device and (if publish is set)
+    serves its frames on a unix socket. Any Camera started while another
+    process owns the device subscribes to that socket instead, and takes the
+    device over if the owner goes away.
+
+    The owner configures resolution and frame interval on the device itself,
+    so the camera only produces what is asked for. A subscriber gets whatever
+    the owner configured and has to decimate on its side.
+
+    Args:
+        device_path (str): Camera device (e.g., "/dev/video2").
+        socket_path (str): Unix socket used to share frames between processes.
+        ring_size (int): Number of frames kept in the shared ring buffer.
+        publish (bool): Serve frames to other processes while owning the device.
+        width (int): Capture width, or None for the device default.
+        height (int): Capture height, or None for the device default.
+        fps (float): Capture frame rate, or None for the device default.
+        pixel_format (str): Capture pixel format. Consumers expect JPEG frames.
+    """
+
+    def __init__(self, device_path: str = DEVICE_PATH, socket_path: str = SOCKET_PATH,
+                 ring_size: int = RING_SIZE, publish: bool = True, width: int = None,
+                 height: int = None, fps: float = None, pixel_format: str = "MJPG"):
+        self.device_path = device_path
+        self.socket_path = socket_path
+        self.publish = publish
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.pixel_format = pixel_format
+        self.ring = FrameRing(ring_size)
+        self.owner = False
+        self.format = None
+        self.error = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._server = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="camera", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._server is not None:
+            self._server.close()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+        self.ring.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if not self._subscribe():
+                    self._capture()
+            except CameraFormatError as e:
+                # retrying will not make the device support the request
+                print(f"Camera error: {e}")
+                self.error = e
+                self.ring.close()
+                return
+            except Exception as e:
+                print(f"Camera error: {e}")
+                self._stop.wait(1.0)
+
+    def _subscribe(self) -> bool:
+        """Read frames from the owning process. Returns False if nobody owns the device."""
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket_path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            sock.close()
+            return False
+        # a silent owner for more than a few seconds is treated like a dropped connection
+        sock.settimeout(5.0)
+        with sock:
+            header = bytearray(_HEADER.size)
+            offset = None
+            while not self._stop.is_set():
+                try:
+                    if not _recv_into(sock, header):
+                        break
+                    seq, timestamp, length = _HEADER.unpack(header)
+                    data = bytearray(length)
+                    if not _recv_into(sock, data):
+                        break
+                except socket.timeout:
+                    break
+                if offset is None:
+                    # keep local sequence numbers increasing across owner restarts
+                    offset = self.ring.next_seq - seq
+                self.ring.put(Frame(seq + offset, timestamp, bytes(data)))
+        return True
+
+    def _capture(self):
+        from v4l2py import Device, VideoCapture
+
+        with Device(self.device_path) as cam:
+            capture = VideoCapture(cam)
+            self._configure(cam, capture)
+            self.owner = True
+            if self.publish:
+                self._server = _FrameServer(self.ring, self.socket_path).start()
+            try:
+                with capture as stream:
+                    for frame in stream:
+                        self.ring.publish(bytes(frame.data))
+                        if self._stop.is_set():
+                            break
+            finally:
+                self.owner = False
+                if self._server is not None:
+                    self._server.close()
+                    self._server = None
+
+    def _configure(self, cam, capture):
+        """Set resolution and frame interval on the device before streaming starts."""
+        width, height, fps = choose_frame_type(
+            cam.info.frame_types, self.pixel_format, self.width, self.height, self.fps
+        )
+        if width is not None:
+            capture.set_format(width, height, self.pixel_format)
+        if fps is not None:
+            capture.set_fps(fps)
+        self.format = capture.get_format()
+        print(f"Camera capturing {self.format.width}x{self.format.height} at {float(capture.get_fps()):g} fps")
+
+
+class _FrameServer:
+    """Unix socket server streaming the ring to other processes, one thread per client."""
+
+    def __init__(self, ring: FrameRing, socket_path: str):
+        self.ring = ring
+        self.socket_path = socket_path
+        self._closed = threading.Event()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)  # stale socket from a crashed owner
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(socket_path)
+        self._sock.listen()
+
+    def start(self):
+        threading.Thread(target=self._accept, name="camera-server", daemon=True).start()
+        return self
+
+    def close(self):
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self._sock.close()
+        try:
+            os.unlink(self.socket_path)
+        except FileNotFoundError:
+            pass
+
+    def _accept(self):
+        while not self._closed.is_set():
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(conn,), name="camera-client", daemon=True).start()
+
+    def _serve(self, conn: socket.socket):
+        # start at the live edge rather than replaying the backlog
+        seq = self.ring.next_seq - 1
+        with conn:
+            while not self._closed.is_set():
+                frame = self.ring.wait_next(seq, timeout=1.0)
+                if frame is None:
+                    continue
+                seq = frame.seq
+                try:
+                    _send_all(conn, _HEADER.pack(frame.seq, frame.timestamp, len(frame.data)), frame.data)
+                except OSError:
+                    return
+
+
+def _send_all(sock: socket.socket, header: bytes, data: bytes):
+    """Send header and payload with scatter/gather writes instead of joining them."""
+    parts = [memoryview(header), memoryview(data)]
+    while parts:
+        sent = sock.sendmsg(parts)
+        while parts and sent >= len(parts[0]):
+            sent -= len(parts[0])
+            parts.pop(0)
+        if parts:
+            parts[0] = parts[0][sent:]
+
+
+def _recv_into(sock: socket.socket, buf: bytearray) -> bool:
+    view = memoryview(buf)
+    while view:
+        n = sock.recv_into(view)
+        if n == 0:
+            return False
+        view = view[n:]
+    return True
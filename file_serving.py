@@ -0,0 +1,100 @@
+import asyncio
+import mmap
+import os
+import re
+from email.utils import formatdate
+
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+# Serving multi-GB recordings to browsers. Players ask for byte ranges (to
+# read the index at the end of the file, and again on every seek), so only
+# the requested bytes are sent. Where the ASGI server supports it the file
+# goes to the socket with sendfile (the zerocopysend extension); otherwise it
+# is memory-mapped and sent in slices, so the bytes come straight from the
+# page cache, shared by every client reviewing the same run, and memory per
+# download stays at one chunk.
+
+CHUNK_SIZE = 1 << 20
+_RANGE = re.compile(r"bytes=(\d*)-(\d*)")
+
+
+def parse_range(header: str, size: int):
+    """
+    Parse a single-range Range header into (start, end) inclusive.
+
+    Returns:
+        tuple: (start, end), or None to send the whole file (no header, or several ranges).
+
+    Raises:
+        ValueError: If the range cannot be satisfied.
+    """
+    if not header or "," in header:
+        return None
+    match = _RANGE.fullmatch(header.strip())
+    if match is None or match.groups() == ("", ""):
+        raise ValueError(header)
+    first, last = match.groups()
+    if first == "":
+        # suffix range: the last n bytes
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError(header)
+    return start, end
+
+
+class RangeFileResponse(Response):
+    """
+    File response that honours Range requests and never reads the file into memory.
+
+    Args:
+        path (str): File to send.
+        range_header (str): The request's Range header, if any.
+        media_type (str): Content type of the file.
+    """
+
+    def __init__(self, path, range_header: str = None, media_type: str = "application/octet-stream"):
+        self.path = path
+        stat = os.stat(path)
+        self.size = stat.st_size
+        headers = {
+            "Accept-Ranges": "bytes",
+            "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+        }
+        try:
+            span = parse_range(range_header, self.size)
+        except ValueError:
+            span = None
+            status_code = 416
+            headers["Content-Range"] = f"bytes */{self.size}"
+            self.start, self.length = 0, 0
+        else:
+            if span is None:
+                status_code = 200
+                self.start, self.length = 0, self.size
+            else:
+                status_code = 206
+                self.start, self.length = span[0], span[1] - span[0] + 1
+                headers["Content-Range"] = f"bytes {span[0]}-{span[1]}/{self.size}"
+        headers["Content-Length"] = str(self.length)
+        super().__init__(status_code=status_code, headers=headers, media_type=media_type)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if self.length == 0 or scope.get("method") == "HEAD":
+            await send({"type": "http.response.body", "body": b""})
+            return
+        with open(self.path, "rb") as f:
+            if "http.response.zerocopysend" in scope.get("extensions", {}):
+                await send({"type": "http.response.zerocopysend", "file": f.fileno(),
+                            "offset": self.start, "count": self.length})
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                end = self.start + self.length
+                for offset in range(self.start, end, CHUNK_SIZE):
+                    # page faults on a cold file would otherwise block the event loop
+                    chunk = await asyncio.to_thread(mapped.__getitem__, slice(offset, min(offset + CHUNK_SIZE, end)))
+                    await send({"type": "http.response.body", "body": chunk,
+                                "more_body": offset + CHUNK_SIZE < end})
@@ -0,0 +1,174 @@
+import ctypes
+import ctypes.util
+import datetime
+import os
+import select
+import struct
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+# Wait, inside the protocol, for the plate reader's export to land in the
+# notebooks folder: no helper process, no polling delay. On the Flex (Linux)
+# the directory is watched with inotify and a file counts as written the
+# moment its writer closes it (or it is renamed into place). Elsewhere, or if
+# inotify is unavailable, the directory is polled, and a file counts as
+# written once it has not changed for SETTLE_SECONDS. Only files modified
+# after the wait started count, or after the time the caller passes as since
+# (e.g. when its run started), so an export left over from an earlier run the
+# same day is never picked up. A file that qualifies, was already there and is
+# settled is returned at once.
+
+PLATE_READER_DIR = "/var/lib/jupyter/notebooks/TWH/"
+SUFFIXES = (".xlsx", ".xls", ".csv", ".txt")
+SETTLE_SECONDS = 2.0
+POLL_INTERVAL = 1.0
+REPORT_INTERVAL = 5 * 60  # seconds between "still waiting" comments
+
+_IN_CLOSE_WRITE = 0x008
+_IN_MOVED_TO = 0x080
+_IN_CREATE = 0x100
+_IN_MODIFY = 0x002
+_EVENT = struct.Struct("iIII")  # wd, mask, cookie, name length
+
+
+@dataclass(frozen=True)
+class PlateReaderFile:
+    """The export that was waited for."""
+
+    path: Path
+    size: int
+    modified: float  # mtime
+    waited: float    # seconds spent waiting
+    how: str         # "closed", "moved", "settled" (no more changes) or "existing"
+
+
+class _Inotify:
+    """Minimal inotify watch on one directory, through libc (no extra packages)."""
+
+    def __init__(self, directory: Path):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE | _IN_MODIFY
+        if libc.inotify_add_watch(self.fd, str(directory).encode(), mask) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, f"inotify_add_watch failed for {directory}")
+
+    def read(self, timeout: float) -> list:
+        """(mask, file name) of the events within timeout seconds."""
+        if not select.select([self.fd], [], [], max(timeout, 0))[0]:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events, offset = [], 0
+        while offset + _EVENT.size <= len(data):
+            _, mask, _, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0").decode(errors="replace")
+            offset += length
+            events.append((mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def _matches(name: str, prefix: str, suffixes) -> bool:
+    # skip Office lock files and partial downloads
+    return name.startswith(prefix) and name.lower().endswith(tuple(suffixes)) and not name.startswith("~$")
+
+
+def wait_for_file(directory: str = PLATE_READER_DIR, prefix: str = None, suffixes=SUFFIXES,
+                  timeout: float = None, settle: float = SETTLE_SECONDS, report=print,
+                  report_interval: float = REPORT_INTERVAL, since: float = None) -> PlateReaderFile:
+    """
+    Wait for a completely written file named prefix* in directory.
+
+    Args:
+        directory (str): Folder the plate reader exports to.
+        prefix (str): File name prefix; defaults to today's date as YYMMDD.
+        suffixes: Accepted file extensions.
+        timeout (float): Give up after this many seconds, or None to wait indefinitely.
+        settle (float): Seconds without changes after which a file counts as written
+            when it was not seen being closed.
+        report: Called with progress messages, e.g. protocol.comment.
+        report_interval (float): Seconds between "still waiting" messages.
+        since (float): Ignore files last modified before this time (time.time()); defaults to
+            now. Pass the run's start time to accept an export written earlier in the run.
+
+    Returns:
+        PlateReaderFile: The newest matching file.
+
+    Raises:
+        TimeoutError: If no file was written within timeout.
+        FileNotFoundError: If directory does not exist.
+    """
+    directory = Path(directory)
+    if not directory.is_dir():
+        raise FileNotFoundError(f"Plate reader folder {directory} does not exist")
+    prefix = datetime.date.today().strftime("%y%m%d") if prefix is None else prefix
+    since = time.time() if since is None else since
+    start = time.monotonic()
+    deadline = None if timeout is None else start + timeout
+    try:
+        watch = _Inotify(directory)
+    except (OSError, AttributeError, TypeError):
+        watch = None  # not Linux, or inotify unavailable: poll
+    report(f"Waiting for the plate reader file {prefix}* in {directory}")
+    next_report = start + report_interval
+    closed = {}  # name -> "closed" or "moved", from inotify
+    first = True
+    try:
+        while True:
+            found = _newest_complete(directory, prefix, suffixes, settle, closed, first, since)
+            if found is not None:
+                path, stat, how = found
+                result = PlateReaderFile(path, stat.st_size, stat.st_mtime, time.monotonic() - start, how)
+                report(f"Found {path.name} ({stat.st_size / 1024:.0f} KB) after {result.waited:.0f} s")
+                return result
+            first = False
+            now = time.monotonic()
+            if deadline is not None and now >= deadline:
+                raise TimeoutError(f"No {prefix}* file in {directory} after {timeout:.0f} s")
+            if now >= next_report:
+                report(f"Still waiting for the plate reader file {prefix}* ({(now - start) / 60:.0f} min)")
+                next_report = now + report_interval
+            wait = min(next_report, deadline or next_report) - now
+            if watch is None:
+                time.sleep(min(wait, POLL_INTERVAL))
+                continue
+            # wake up at least every settle seconds for files written without a close event
+            for mask, name in watch.read(min(wait, settle)):
+                if mask & (_IN_CLOSE_WRITE | _IN_MOVED_TO) and _matches(name, prefix, suffixes):
+                    closed[name] = "closed" if mask & _IN_CLOSE_WRITE else "moved"
+    finally:
+        if watch is not None:
+            watch.close()
+
+
+def _newest_complete(directory: Path, prefix: str, suffixes, settle: float, closed: dict, first: bool,
+                     since: float):
+    """(path, stat, how) of the newest matching file written since since if it is completely written, else None."""
+    newest = None
+    with os.scandir(directory) as it:
+        for entry in it:
+            if entry.is_file() and _matches(entry.name, prefix, suffixes):
+                stat = entry.stat()
+                # a file moved in keeps its old mtime, but the event shows it arrived during the wait
+                if stat.st_mtime < since and entry.name not in closed:
+                    continue
+                if newest is None or stat.st_mtime > newest[1].st_mtime:
+                    newest = (entry, stat)
+    if newest is None or newest[1].st_size == 0:
+        return None
+    entry, stat = newest
+    if entry.name in closed:
+        return Path(entry.path), stat, closed[entry.name]
+    if time.time() - stat.st_mtime >= settle:
+        return Path(entry.path), stat, "existing" if first else "settled"
+    return None
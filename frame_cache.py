@@ -0,0 +1,89 @@
+import io
+import threading
+
+from PIL import Image
+
+# Downscaled copies of the camera's latest frame. Dashboards that poll a small
+# thumbnail of every robot should not each cost a JPEG decode and encode: the
+# first request for a width after a new frame scales it (decoding at reduced
+# size straight from the JPEG's DCT coefficients via PIL draft mode), and
+# every other request for that frame and width gets the cached bytes.
+# Cropped deck regions (see rois.py) are cached the same way.
+
+WIDTHS = (160, 320, 640)  # widths a frame can be scaled to, so the cache stays bounded
+QUALITY = 80
+
+
+def scale_jpeg(data: bytes, width: int, quality: int = QUALITY) -> bytes:
+    """
+    Scale a JPEG frame down to width pixels wide, keeping its aspect ratio.
+
+    Frames already that narrow are returned unchanged.
+    """
+    image = Image.open(io.BytesIO(data))
+    if image.width <= width:
+        return data
+    height = max(round(image.height * width / image.width), 1)
+    # decode at the smallest power-of-two scale that is still at least width wide
+    image.draft("RGB", (width, height))
+    image = image.convert("RGB")
+    if image.width != width:
+        image = image.resize((width, height), Image.BILINEAR)
+    out = io.BytesIO()
+    image.save(out, "JPEG", quality=quality)
+    return out.getvalue()
+
+
+class ScaledFrameCache:
+    """
+    The latest frame scaled to each width (and cropped to each region), computed once per frame.
+
+    Concurrent requests for the same frame, width and region wait for the
+    first one to finish instead of scaling it again.
+
+    Args:
+        widths (tuple): Widths frames can be scaled to.
+        quality (int): JPEG quality of the scaled frames.
+        rois (dict): Regions frames can be cropped to, name -> fractional box (rois.load_rois()).
+    """
+
+    def __init__(self, widths: tuple = WIDTHS, quality: int = QUALITY, rois: dict = None):
+        self.widths = tuple(widths)
+        self.quality = quality
+        self.rois = dict(rois or {})
+        self._cache = {}  # (width, roi) -> (seq, jpeg)
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    def check(self, width: int = None, roi: str = None):
+        """
+        Raises:
+            ValueError: If width is not one of the cache's widths, or roi not one of its regions.
+        """
+        if width is None and roi is None or width is not None and width not in self.widths:
+            raise ValueError(f"Width must be one of {', '.join(map(str, self.widths))}")
+        if roi is not None and roi not in self.rois:
+            raise ValueError(f"Region must be one of {', '.join(self.rois)}")
+
+    def get(self, frame, width: int = None, roi: str = None) -> bytes:
+        """
+        Return frame scaled to width, cropped to the named region first if roi is given.
+
+        Raises:
+            ValueError: If width is not one of the cache's widths, or roi not one of its regions.
+        """
+        self.check(width, roi)
+        key = (width, roi)
+        with self._locks_lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            cached = self._cache.get(key)
+            if cached is None or cached[0] != frame.seq:
+                if roi is None:
+                    data = scale_jpeg(frame.data, width, self.quality)
+                else:
+                    from rois import crop_jpeg
+                    data = crop_jpeg(frame.data, self.rois[roi], width, self.quality)
+                cached = (frame.seq, data)
+                self._cache[key] = cached
+            return cached[1]
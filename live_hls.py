@@ -0,0 +1,236 @@
+import asyncio
+import os
+import re
+import shutil
+import threading
+import time
+from pathlib import Path
+
+# Live HLS (fragmented MP4) stream of the camera with a rewindable window.
+#
+# One ffmpeg process encodes the same frames the MJPEG endpoints serve (it is
+# just another pump subscriber) to H.264 in two-second fMP4 segments. Every
+# segment, the oldest segments over the byte budget are deleted and the
+# playlist the app serves is rebuilt from ffmpeg's with only the segments
+# still on disk. Players start at the live edge and can seek back through
+# everything kept, like any HLS "DVR" stream.
+#
+# The encoder is the most expensive thing the app runs, so it only runs while
+# someone is watching: the app calls watch() on every /live request, which
+# starts it, and it stops (dropping its segments) once no request has come
+# for idle_timeout seconds.
+
+PLAYLIST = "live.m3u8"
+INIT_SEGMENT = "init.mp4"
+SEGMENT_SECONDS = 2
+LIVE_FPS = 10
+BYTE_BUDGET = 512 * 2**20
+MAX_SEGMENTS = 3600  # ffmpeg's own list (2 hours); the rewind window is at most this long
+MIN_SEGMENTS = 3  # never evict below what a player needs to start
+IDLE_TIMEOUT = 60  # players fetch a segment every SEGMENT_SECONDS while watching
+_SEGMENT_NAME = re.compile(r"seg_\d{6}\.m4s")
+
+
+class HlsLive:
+    """
+    Encode a pump's frames into a live HLS stream.
+
+    Frames are fed to ffmpeg at a constant fps (repeating the last frame if
+    the camera is slower, skipping frames if it is faster), so segment
+    durations match wall-clock time.
+
+    Args:
+        source: FramePump or TierPump to encode, e.g. the 640 wide tier.
+        directory (str): Where the segments are written (emptied on start).
+        fps (float): Frame rate of the encoded stream.
+        segment_seconds (float): Segment length.
+        byte_budget (int): Delete the oldest segments once they take more than this.
+        idle_timeout (float): Stop encoding this many seconds after the last watch(), or None to run until stop().
+    """
+
+    def __init__(self, source, directory: str, fps: float = LIVE_FPS,
+                 segment_seconds: float = SEGMENT_SECONDS, byte_budget: int = BYTE_BUDGET,
+                 idle_timeout: float = IDLE_TIMEOUT):
+        self.source = source
+        self.directory = Path(directory)
+        self.fps = fps
+        self.segment_seconds = segment_seconds
+        self.byte_budget = byte_budget
+        self.idle_timeout = idle_timeout
+        self.evicted = 0
+        self._task = None
+        self._watched = time.monotonic()
+        self._sizes = {}
+        self._playlist = None  # (mtime of ffmpeg's playlist, served playlist)
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._watched = time.monotonic()
+            self._task = asyncio.create_task(self._run())
+        return self
+
+    def watch(self):
+        """Someone is watching: start the encoder if it is not running, and keep it running. Call from the event loop."""
+        self._watched = time.monotonic()
+        return self.start()
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def playlist(self) -> str:
+        """
+        The playlist to serve: every segment still kept, oldest first.
+
+        Re-read only when ffmpeg has written a new segment.
+
+        Raises:
+            FileNotFoundError: If no segment has been written yet.
+        """
+        with self._lock:
+            path = self.directory / PLAYLIST
+            mtime = path.stat().st_mtime_ns
+            if self._playlist is None or self._playlist[0] != mtime:
+                self._playlist = (mtime, self._rebuild(path.read_text()))
+            return self._playlist[1]
+
+    def segment_path(self, name: str) -> Path:
+        """
+        Path of a segment (or the init segment) by the name the playlist uses.
+
+        Raises:
+            FileNotFoundError: If the name is not a segment, or it was evicted.
+        """
+        if name != INIT_SEGMENT and not _SEGMENT_NAME.fullmatch(name):
+            raise FileNotFoundError(name)
+        path = self.directory / name
+        if not path.exists():
+            raise FileNotFoundError(name)
+        return path
+
+    def _rebuild(self, text: str) -> str:
+        header, segments, tags = [], [], []
+        for line in text.splitlines():
+            if not line or line.startswith(("#EXT-X-MEDIA-SEQUENCE", "#EXT-X-ENDLIST")):
+                continue
+            if line.startswith(("#EXTINF", "#EXT-X-PROGRAM-DATE-TIME", "#EXT-X-DISCONTINUITY")):
+                tags.append(line)
+            elif not line.startswith("#"):
+                segments.append((line, tags))
+                tags = []
+            elif not segments and not tags:
+                header.append(line)
+        kept = self._evict()
+        segments = [(name, tags) for name, tags in segments if name in kept]
+        # segment names carry ffmpeg's sequence number
+        sequence = int(segments[0][0][4:10]) if segments else 0
+        lines = header + [f"#EXT-X-MEDIA-SEQUENCE:{sequence}"]
+        for name, tags in segments:
+            lines += tags + [name]
+        return "\n".join(lines) + "\n"
+
+    def _evict(self) -> set:
+        """Delete the oldest segments over the byte budget; return the names of those kept."""
+        names = sorted(path.name for path in self.directory.glob("seg_*.m4s"))
+        total = 0
+        first = len(names)
+        for i in range(len(names) - 1, -1, -1):
+            name = names[i]
+            if name not in self._sizes:
+                self._sizes[name] = (self.directory / name).stat().st_size
+            total += self._sizes[name]
+            if total > self.byte_budget and len(names) - i > MIN_SEGMENTS:
+                break
+            first = i
+        for name in names[:first]:
+            self._sizes.pop(name, None)
+            try:
+                os.unlink(self.directory / name)
+                self.evicted += 1
+            except FileNotFoundError:
+                pass
+        return set(names[first:])
+
+    def _refresh(self):
+        try:
+            self.playlist()
+        except FileNotFoundError:
+            pass
+
+    def _command(self) -> list:
+        import imageio_ffmpeg
+
+        gop = max(int(self.fps * self.segment_seconds), 1)
+        return [
+            imageio_ffmpeg.get_ffmpeg_exe(), "-loglevel", "error",
+            "-f", "mjpeg", "-framerate", str(self.fps), "-i", "pipe:0",
+            "-c:v", "libx264", "-preset", "veryfast", "-tune", "zerolatency", "-pix_fmt", "yuv420p",
+            "-g", str(gop), "-keyint_min", str(gop), "-sc_threshold", "0",
+            "-f", "hls", "-hls_time", str(self.segment_seconds), "-hls_list_size", str(MAX_SEGMENTS),
+            "-hls_segment_type", "fmp4", "-hls_fmp4_init_filename", INIT_SEGMENT,
+            "-hls_segment_filename", str(self.directory / "seg_%06d.m4s"),
+            "-hls_flags", "independent_segments+program_date_time+temp_file",
+            str(self.directory / PLAYLIST),
+        ]
+
+    async def _run(self):
+        queue = self.source.subscribe()
+        try:
+            while True:
+                shutil.rmtree(self.directory, ignore_errors=True)
+                self.directory.mkdir(parents=True)
+                self._sizes.clear()
+                self._playlist = None
+                process = await asyncio.create_subprocess_exec(
+                    *self._command(), stdin=asyncio.subprocess.PIPE,
+                    preexec_fn=(lambda: os.nice(10)) if hasattr(os, "nice") else None,
+                )
+                try:
+                    finished = await self._feed(queue, process.stdin)
+                except (BrokenPipeError, ConnectionResetError):
+                    finished = False
+                finally:
+                    if process.returncode is None:
+                        process.stdin.close()
+                        await process.wait()
+                if finished:
+                    return
+                print(f"Live encoder exited ({process.returncode}), restarting")
+                await asyncio.sleep(5)
+        finally:
+            self.source.unsubscribe(queue)
+            # nobody is watching: a later viewer must not get this run's stale playlist
+            with self._lock:
+                shutil.rmtree(self.directory, ignore_errors=True)
+                self._playlist = None
+                self._sizes.clear()
+
+    async def _feed(self, queue: asyncio.Queue, stdin) -> bool:
+        """Write frames at a constant rate until the source ends or nobody watches (True), or ffmpeg goes away."""
+        frame = await queue.get()
+        tick = refresh = time.monotonic()
+        while frame is not None:
+            if self.idle_timeout is not None and tick - self._watched > self.idle_timeout:
+                print("Live stream idle, stopping the encoder")
+                return True
+            stdin.write(frame.data)
+            await stdin.drain()
+            if tick >= refresh:
+                # keep to the byte budget even while no player is fetching the playlist
+                await asyncio.to_thread(self._refresh)
+                refresh = tick + self.segment_seconds
+            tick = max(tick + 1 / self.fps, time.monotonic())
+            await asyncio.sleep(tick - time.monotonic())
+            while not queue.empty():
+                frame = queue.get_nowait()
+        return True
@@ -0,0 +1,284 @@
+import bisect
+import os
+import resource
+import threading
+import time
+from pathlib import Path
+
+# Counters and histograms for the recorder and the video app, rendered in the
+# Prometheus text format on the app's /metrics.
+#
+# Most values are read from counters the code keeps anyway (frames written,
+# drop totals, client counts) only when /metrics is scraped, through a
+# function given to the metric; the per-frame cost is just the histograms,
+# one bisect and two additions each. The recorder is a separate process, so
+# it writes its metrics to RECORDER_METRICS every few seconds (like the
+# node_exporter textfile collector) and the app appends that file to its own.
+# The recorder service runs several recordings at once in one process; it
+# writes one file for all of them, each recording's series labelled with its
+# name (LabeledRegistries).
+
+RECORDER_METRICS = "/tmp/flex_recorder.prom"
+STALE_SECONDS = 30  # a recorder file older than this is from a recorder that is gone
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def _labels(labels) -> str:
+    labels = list(labels)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}" if labels else ""
+
+
+class Metric:
+    """
+    A counter or gauge.
+
+    Args:
+        name (str): Metric name, e.g. flex_recorder_frames_written_total.
+        help (str): One-line description.
+        kind (str): "counter" or "gauge".
+        fn: Called at render time for the value, or a {label value: value} dict
+            when label is set (keyed by tuples for several labels). Without fn,
+            use inc() and set().
+        label: Name of the label the values are split by, or a tuple of names.
+    """
+
+    def __init__(self, name: str, help: str, kind: str = "counter", fn=None, label: str = None):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.fn = fn
+        self.label = label
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def set(self, value: float):
+        self.value = value
+
+    def render(self, labels=()) -> list:
+        """HELP and TYPE lines, then the samples, each with the (name, value) pairs of labels in front."""
+        value = self.value if self.fn is None else self.fn()
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        labels = tuple(labels)
+        if self.label is None:
+            lines.append(f"{self.name}{_labels(labels)} {value:g}")
+        else:
+            names = self.label if isinstance(self.label, tuple) else (self.label,)
+            for key, v in value.items():
+                key = key if isinstance(key, tuple) else (key,)
+                lines.append(f"{self.name}{_labels(labels + tuple(zip(names, key)))} {v:g}")
+        return lines
+
+
+class Histogram:
+    """
+    Cumulative histogram with fixed buckets (seconds).
+
+    observe() may be called from any thread; a sample that races with a
+    scrape is at worst counted in the next one.
+
+    Args:
+        name (str): Metric name, e.g. flex_recorder_capture_to_write_seconds.
+        help (str): One-line description.
+        buckets: Upper bounds, ascending.
+    """
+
+    def __init__(self, name: str, help: str, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def render(self, labels=()) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        labels = tuple(labels)
+        total = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            total += count
+            lines.append(f"{self.name}_bucket{_labels(labels + (('le', bound),))} {total}")
+        lines += [f"{self.name}_sum{_labels(labels)} {self.sum:g}", f"{self.name}_count{_labels(labels)} {total}"]
+        return lines
+
+
+class Registry:
+    """The metrics of one process, rendered together."""
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name: str, help: str, fn=None, label: str = None) -> Metric:
+        return self.add(Metric(name, help, "counter", fn, label))
+
+    def gauge(self, name: str, help: str, fn=None, label: str = None) -> Metric:
+        return self.add(Metric(name, help, "gauge", fn, label))
+
+    def histogram(self, name: str, help: str, buckets=LATENCY_BUCKETS) -> Histogram:
+        return self.add(Histogram(name, help, buckets))
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+class LabeledRegistries:
+    """
+    Registries of the same metrics, one per value of a label, rendered as one.
+
+    The recorder service keeps one per running recording (label "recording"),
+    so a single MetricsFile covers them all. Metrics of the process as a whole
+    go in shared; a per-value registry's metric of the same name is left out.
+
+    Args:
+        label (str): Label telling the registries apart.
+    """
+
+    def __init__(self, label: str):
+        self.label = label
+        self.shared = Registry()
+        self.registries = {}
+
+    def add(self, value: str, registry: Registry):
+        self.registries[value] = registry
+
+    def remove(self, value: str):
+        self.registries.pop(value, None)
+
+    def render(self) -> str:
+        shared = {metric.name for metric in self.shared.metrics}
+        families = {}  # name -> lines; the text format wants each metric's samples together
+        for value, registry in list(self.registries.items()):
+            for metric in registry.metrics:
+                if metric.name in shared:
+                    continue
+                lines = metric.render(((self.label, value),))
+                if metric.name in families:
+                    families[metric.name] += lines[2:]  # HELP and TYPE once
+                else:
+                    families[metric.name] = lines
+        lines = [line for family in families.values() for line in family]
+        return self.shared.render() + ("\n".join(lines) + "\n" if lines else "")
+
+
+def rate(fn):
+    """A gauge function giving how fast the counter fn() grew (per second) since it was last called."""
+    last = [time.monotonic(), fn()]
+
+    def per_second() -> float:
+        now, value = time.monotonic(), fn()
+        elapsed = now - last[0]
+        speed = (value - last[1]) / elapsed if elapsed > 0 else 0.0
+        last[:] = [now, value]
+        return speed
+
+    return per_second
+
+
+def add_process_metrics(registry: Registry, prefix: str):
+    """Register CPU time and resident memory of the current process as <prefix>_cpu_seconds_total and <prefix>_resident_memory_bytes."""
+    registry.counter(f"{prefix}_cpu_seconds_total", "User and system CPU time of the process.", _cpu_seconds)
+    registry.gauge(f"{prefix}_resident_memory_bytes", "Resident memory of the process.", _rss_bytes)
+
+
+def _cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _rss_bytes() -> float:
+    try:
+        # current RSS; ru_maxrss would only give the peak
+        return int(Path("/proc/self/statm").read_text().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class ClientLag:
+    """
+    Send lag of stream clients: how old each frame is when its bytes have been handed to the socket.
+
+    Args:
+        registry (Registry): Where the lag histogram and the per-client gauge are registered.
+        prefix (str): Metric name prefix.
+    """
+
+    def __init__(self, registry: Registry, prefix: str = "flex_stream"):
+        self.histogram = registry.histogram(f"{prefix}_send_lag_seconds", "Capture to sent, every frame of every client.")
+        self.current = {}
+        registry.gauge(f"{prefix}_client_lag_seconds", "Send lag of the last frame, per connected client.",
+                       lambda: dict(self.current), label="client")
+
+    def observe(self, client: str, seconds: float):
+        self.current[client] = seconds
+        self.histogram.observe(seconds)
+
+    def remove(self, client: str):
+        self.current.pop(client, None)
+
+
+class MetricsFile:
+    """
+    Write a registry to a file every interval seconds (atomically), for a process without an HTTP server.
+
+    Args:
+        registry (Registry): Metrics to write.
+        path (str): File to write, read by the video app's /metrics.
+        interval (float): Seconds between writes.
+    """
+
+    def __init__(self, registry: Registry, path: str = RECORDER_METRICS, interval: float = 5):
+        self.registry = registry
+        self.path = Path(path)
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="metrics", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.path.unlink(missing_ok=True)
+
+    def write(self):
+        temp = self.path.with_name(f".{self.path.name}.{os.getpid()}")
+        temp.write_text(self.registry.render())
+        os.replace(temp, self.path)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except OSError as e:
+                print(f"Could not write metrics: {e}")
+
+
+def read_metrics_file(path: str = RECORDER_METRICS, stale_seconds: float = STALE_SECONDS) -> str:
+    """Contents of a MetricsFile, or "" if there is none or its writer has stopped updating it."""
+    try:
+        path = Path(path)
+        if time.time() - path.stat().st_mtime > stale_seconds:
+            return ""
+        return path.read_text()
+    except FileNotFoundError:
+        return ""
@@ -0,0 +1,83 @@
+import io
+
+import numpy as np
+from PIL import Image
+
+# Change detection for adaptive recording. Each candidate frame is decoded at
+# 1/8 scale straight from the JPEG's DCT coefficients (PIL draft mode, so an
+# 80x60 grey thumbnail for a 640x480 frame) and compared to the previous one
+# with a single vectorized numpy difference. While the deck is still, the
+# recorder keeps only an occasional frame; as soon as the gantry or gripper
+# moves it is back to full rate.
+
+PIXEL_THRESHOLD = 12    # grey levels a thumbnail pixel must change by to count
+AREA_THRESHOLD = 0.004  # fraction of thumbnail pixels that must change to count as motion
+HOLD_SECONDS = 3.0      # keep full rate this long after the last motion
+IDLE_INTERVAL = 30.0    # while still, keep one frame this often
+
+
+def thumbnail(data: bytes) -> np.ndarray:
+    """Decode a JPEG frame at 1/8 scale to a grey (h, w) int16 array."""
+    image = Image.open(io.BytesIO(data))
+    image.draft("L", (max(image.width // 8, 1), max(image.height // 8, 1)))
+    return np.asarray(image.convert("L"), dtype=np.int16)
+
+
+class MotionDetector:
+    """
+    Decide frame by frame whether the recorder needs to keep it.
+
+    Args:
+        pixel_threshold (int): Grey levels a thumbnail pixel must change by to count.
+        area_threshold (float): Fraction of pixels that must change to count as motion.
+        hold_seconds (float): Keep every frame this long after the last motion.
+        idle_interval (float): While nothing moves, keep one frame this often.
+        roi (tuple): Only look for motion in this part of the frame (see rois.py), or None for all of it.
+    """
+
+    def __init__(self, pixel_threshold: int = PIXEL_THRESHOLD, area_threshold: float = AREA_THRESHOLD,
+                 hold_seconds: float = HOLD_SECONDS, idle_interval: float = IDLE_INTERVAL, roi: tuple = None):
+        self.pixel_threshold = pixel_threshold
+        self.area_threshold = area_threshold
+        self.hold_seconds = hold_seconds
+        self.idle_interval = idle_interval
+        self.roi = roi
+        self.last_motion = None
+        self._previous = None
+        self._last_kept = None
+
+    def changed(self, data: bytes) -> float:
+        """Fraction of the thumbnail that changed since the previous frame."""
+        thumb = thumbnail(data)
+        if self.roi is not None:
+            left, top, right, bottom = self.roi
+            height, width = thumb.shape
+            thumb = thumb[int(top * height):max(int(bottom * height), int(top * height) + 1),
+                          int(left * width):max(int(right * width), int(left * width) + 1)]
+        previous, self._previous = self._previous, thumb
+        if previous is None or previous.shape != thumb.shape:
+            return 1.0
+        return np.count_nonzero(np.abs(thumb - previous) > self.pixel_threshold) / thumb.size
+
+    def keep(self, data: bytes, timestamp: float) -> bool:
+        """
+        Return True if the frame should be recorded.
+
+        Frames are kept while something moves, for hold_seconds afterwards, and
+        once every idle_interval while the deck is still. A frame that cannot be
+        decoded counts as motion.
+        """
+        try:
+            moved = self.changed(data) > self.area_threshold
+        except (OSError, ValueError):
+            moved = True  # a truncated or corrupt frame: keep it rather than guess
+        if moved:
+            self.last_motion = timestamp
+        keep = (
+            self._last_kept is None
+            or (self.last_motion is not None and timestamp - self.last_motion <= self.hold_seconds)
+            or timestamp - self._last_kept >= self.idle_interval
+        )
+        if keep:
+            self._last_kept = timestamp
+        return keep
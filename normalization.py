@@ -0,0 +1,376 @@
+import argparse
+import csv
+import datetime
+import io
+import json
+import os
+import re
+from pathlib import Path
+
+import numpy as np
+
+from file_watcher import PLATE_READER_DIR
+
+# Plan the protein normalization away from the robot: from the plate reader
+# export (and optionally a sample manifest) to a transfer plan, one line per
+# sample with the sample and diluent volumes to pipette, in µL.
+#
+#     python3 normalization.py 250412_BCA.xlsx --samples 10 --final-ul 385 --prefilled-ul 192.5
+#
+# The plan is written to PLAN_DIR as <export name>.json (read by the
+# protocols) and .csv (for people), and records the export's content hash.
+# A protocol calls load_or_plan() for its export: it executes the plan made
+# at the plate reader if there is one for that file and it was made for the
+# protocol's volumes and wells, and otherwise plans itself, the same way.
+#
+# Every volume is in µL and every concentration in mg/mL; the field names say
+# so. Sample volumes are target * final / concentration, limited to what
+# fits next to the diluent already in the well (prefilled_ul). Volumes below
+# min_ul are not pipetted: the sample is raised to min_ul (too concentrated,
+# pre-dilute it) and a diluent top-up is skipped. Samples too dilute to reach
+# the target get the most that fits and a flag, and samples that cannot be
+# read off the standard curve get no transfers at all.
+#
+# Standards and unknowns are both read as the mean of their replicates
+# without the outliers (plate_analysis.replicate_stats' clean_mean), the
+# absorbance standard_curve.fit_plates() fits too; the plan records it.
+#
+#     {"units": {"volume": "uL", "concentration": "mg/mL"}, "absorbance": "clean_mean", "final_ul": 500, ...,
+#      "transfers": [{"sample": "Sample 9", "name": "lysate 1", "source": "B1", "destination": "A1",
+#                     "concentration_mg_ml": 2.4, "sample_ul": 208.3, "diluent_ul": 291.7,
+#                     "final_concentration_mg_ml": 1.0, "flags": []}, ...]}
+
+PLAN_DIR = Path(PLATE_READER_DIR) / "plans"  # not the export folder itself, or the .csv would pass for an export
+PLAN_VERSION = 1
+UNITS = {"volume": "uL", "concentration": "mg/mL"}
+ABSORBANCE = "clean_mean"  # which replicate statistic the plan's absorbances are
+TARGET_MG_ML = 1.0
+FINAL_UL = 500.0
+MIN_VOLUME_UL = 5.0  # smallest volume the Flex 1000 µL pipette dispenses
+STANDARDS = 8  # samples 1-8 on the BCA plate are the BSA standards
+FLAGS = ("too_dilute", "too_concentrated", "off_curve", "extrapolated", "replicates_disagree")
+_WELL = re.compile(r"[A-P]([1-9]|1[0-9]|2[0-4])$")
+
+
+def sample_locations(count: int) -> list:
+    """Tubes the protocols load the samples from: B1-B6, C1-C6, D1-D6."""
+    if count > 18:
+        raise ValueError("The tube rack holds at most 18 samples")
+    return [f"{'BCD'[i // 6]}{i % 6 + 1}" for i in range(count)]
+
+
+def destination_wells(count: int) -> list:
+    """Wells of the normalized samples, down the columns: A1, B1, ... H1, A2, ..."""
+    return [f"{'ABCDEFGH'[i % 8]}{i // 8 + 1}" for i in range(count)]
+
+
+def load_manifest(path) -> list:
+    """
+    Samples from a CSV with a "name" column and optional "source" and "destination" columns.
+
+    Row i is the i-th unknown on the BCA plate (Sample 9, Sample 10, ...).
+
+    Raises:
+        ValueError: If there is no name column or a row has no name.
+    """
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        rows = [{key.strip().lower(): (value or "").strip() for key, value in row.items() if key}
+                for row in csv.DictReader(f)]
+    if not rows or "name" not in rows[0]:
+        raise ValueError(f"{path} needs a header with a name column")
+    for number, row in enumerate(rows, start=2):
+        if not row["name"]:
+            raise ValueError(f"{path} line {number}: no sample name")
+    return rows
+
+
+def volumes(concentration, target_mg_ml: float = TARGET_MG_ML, final_ul: float = FINAL_UL,
+            prefilled_ul: float = 0.0, min_ul: float = MIN_VOLUME_UL) -> dict:
+    """
+    Sample and diluent volumes for every sample at once.
+
+    Args:
+        concentration: Measured concentrations in mg/mL (NaN for samples off the curve).
+        target_mg_ml (float): Concentration to normalize to.
+        final_ul (float): Volume in the destination well when done, µL.
+        prefilled_ul (float): Diluent already in the destination well, µL.
+        min_ul (float): Smallest volume to pipette, µL.
+
+    Returns:
+        dict: "sample_ul", "diluent_ul" and "final_concentration_mg_ml" arrays, and the boolean
+            arrays "too_dilute", "too_concentrated" and "off_curve".
+    """
+    concentration = np.asarray(concentration, dtype=float)
+    room = final_ul - prefilled_ul  # the most sample that fits
+    off_curve = ~np.isfinite(concentration)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        needed = np.where(concentration > 0, target_mg_ml * final_ul / concentration, np.inf)
+    too_dilute = ~off_curve & (needed > room)
+    too_concentrated = ~off_curve & (needed < min_ul)
+    sample = np.clip(needed, min_ul, room)
+    diluent = room - sample
+    diluent = np.where(diluent < min_ul, 0.0, diluent)  # too little to pipette: the well ends up slightly short
+    sample, diluent = np.where(off_curve, 0.0, sample), np.where(off_curve, 0.0, diluent)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        final = np.where(off_curve, np.nan, np.maximum(concentration, 0) * sample / (prefilled_ul + sample + diluent))
+    return {"sample_ul": np.round(sample, 1), "diluent_ul": np.round(diluent, 1),
+            "final_concentration_mg_ml": np.round(final, 3),
+            "too_dilute": too_dilute, "too_concentrated": too_concentrated, "off_curve": off_curve}
+
+
+def plan_normalization(plate_file, samples: int = None, manifest=None, target_mg_ml: float = TARGET_MG_ML,
+                       final_ul: float = FINAL_UL, prefilled_ul: float = 0.0, min_ul: float = MIN_VOLUME_UL,
+                       weighting: str = None, sources=None, destinations=None) -> dict:
+    """
+    The transfer plan for one BCA plate.
+
+    Args:
+        plate_file: Plate reader export.
+        samples (int): Number of unknowns; defaults to the manifest's length.
+        manifest: Rows from load_manifest(), or None to name the samples "Sample 9", ...
+            and use the protocols' tubes and wells.
+        target_mg_ml, final_ul, prefilled_ul, min_ul: See volumes().
+        weighting (str): Standard curve weighting, see standard_curve.fit_curves().
+        sources, destinations: The protocol's sample tubes and destination wells, in sample
+            order; default to sample_locations() and destination_wells(). A manifest's own
+            wells take precedence.
+
+    Raises:
+        ValueError: For impossible volumes, a manifest of the wrong length, or an unreadable plate.
+    """
+    from plate_analysis import replicate_stats, replicate_table
+    from plate_reader import file_hash, read_plate
+    from standard_curve import fit_curves
+
+    if samples is None and manifest is None:
+        raise ValueError("Give the number of samples or a manifest")
+    samples = len(manifest) if samples is None else samples
+    if manifest is not None and len(manifest) != samples:
+        raise ValueError(f"The manifest lists {len(manifest)} samples, expected {samples}")
+    if not 0 < samples <= 32 - STANDARDS:
+        raise ValueError(f"A BCA plate holds 1 to {32 - STANDARDS} samples, got {samples}")
+    if not 0 <= prefilled_ul < final_ul or min_ul <= 0 or target_mg_ml <= 0:
+        raise ValueError("Need 0 <= prefilled_ul < final_ul, min_ul > 0 and target_mg_ml > 0")
+
+    plate = read_plate(plate_file)
+    table = replicate_table(plate)
+    absorbance = replicate_stats(plate)[ABSORBANCE]
+    curve = fit_curves(absorbance[:STANDARDS], weighting=weighting)
+    unknowns = table.iloc[STANDARDS:STANDARDS + samples]
+    concentration = curve.concentration(absorbance[STANDARDS:STANDARDS + samples])
+    plan_volumes = volumes(concentration, target_mg_ml, final_ul, prefilled_ul, min_ul)
+    extrapolated = curve.extrapolated(concentration) & ~plan_volumes["off_curve"]
+
+    notes = [curve.summary()]
+    measured = table.iloc[:STANDARDS + samples]
+    for _, sample in measured[measured["Outliers"] > 0].iterrows():
+        notes.append(f"Check {sample['Sample']} ({sample['Wells']}): replicates disagree, CV {sample['CV']:.0%}")
+    sources = list(sample_locations(min(samples, 18)) if sources is None else sources)
+    destinations = list(destination_wells(samples) if destinations is None else destinations)
+    transfers = []
+    for i, (_, sample) in enumerate(unknowns.iterrows()):
+        row = manifest[i] if manifest is not None else {}
+        flags = [flag for flag, mask in (("too_dilute", plan_volumes["too_dilute"]),
+                                         ("too_concentrated", plan_volumes["too_concentrated"]),
+                                         ("off_curve", plan_volumes["off_curve"]),
+                                         ("extrapolated", extrapolated)) if mask[i]]
+        if sample["Outliers"] > 0:
+            flags.append("replicates_disagree")
+        transfer = {"sample": sample["Sample"], "name": row.get("name") or sample["Sample"],
+                    "wells": sample["Wells"], "source": row.get("source") or (sources[i] if i < len(sources) else None),
+                    "destination": row.get("destination") or (destinations[i] if i < len(destinations) else None),
+                    "absorbance": round(float(absorbance[STANDARDS + i]), 4),
+                    "concentration_mg_ml": _number(concentration[i], 3),
+                    "sample_ul": float(plan_volumes["sample_ul"][i]), "diluent_ul": float(plan_volumes["diluent_ul"][i]),
+                    "final_concentration_mg_ml": _number(plan_volumes["final_concentration_mg_ml"][i], 3),
+                    "flags": flags}
+        transfers.append(transfer)
+        notes.extend(_flag_notes(transfer, target_mg_ml, final_ul))
+
+    plan = {"version": PLAN_VERSION, "created": datetime.datetime.now().isoformat(timespec="seconds"),
+            "source_file": Path(plate_file).name, "source_hash": file_hash(plate_file), "units": dict(UNITS),
+            "absorbance": ABSORBANCE, "target_mg_ml": target_mg_ml, "final_ul": final_ul, "prefilled_ul": prefilled_ul, "min_ul": min_ul,
+            "curve": {"model": curve.model, "r_squared": _number(curve.fit_r_squared, 5),
+                      "rejected_standards_mg_ml": [float(c) for c in curve.standards[curve.rejected]]},
+            "notes": notes, "transfers": transfers}
+    validate_plan(plan)
+    return plan
+
+
+def _number(value, digits: int):
+    # JSON has no NaN
+    return round(float(value), digits) if np.isfinite(value) else None
+
+
+def _flag_notes(transfer: dict, target_mg_ml: float, final_ul: float) -> list:
+    label = f"{transfer['name']} ({transfer['source']})" if transfer["name"] == transfer["sample"] \
+        else f"{transfer['name']} ({transfer['sample']}, {transfer['source']})"
+    notes = []
+    if "off_curve" in transfer["flags"]:
+        notes.append(f"{label}: absorbance {transfer['absorbance']} is off the standard curve; not transferred, "
+                     f"normalize it by hand")
+    if "too_dilute" in transfer["flags"]:
+        notes.append(f"{label}: {transfer['concentration_mg_ml']} mg/mL is too dilute for {target_mg_ml:g} mg/mL "
+                     f"in {final_ul:g} µL; it will be {transfer['final_concentration_mg_ml']} mg/mL")
+    if "too_concentrated" in transfer["flags"]:
+        notes.append(f"{label}: {transfer['concentration_mg_ml']} mg/mL needs less than the smallest pipettable "
+                     f"volume; it will be {transfer['final_concentration_mg_ml']} mg/mL, pre-dilute it next time")
+    if "extrapolated" in transfer["flags"]:
+        notes.append(f"{label}: {transfer['concentration_mg_ml']} mg/mL is outside the standards")
+    return notes
+
+
+def validate_plan(plan: dict) -> dict:
+    """
+    Check a plan before anything is pipetted from it.
+
+    Raises:
+        ValueError: Listing everything wrong with the plan.
+    """
+    problems = []
+    if plan.get("version") != PLAN_VERSION:
+        problems.append(f"version {plan.get('version')} is not {PLAN_VERSION}")
+    if plan.get("units") != UNITS:
+        problems.append(f"units must be {UNITS}, not {plan.get('units')}")
+    final_ul, prefilled_ul, min_ul = plan.get("final_ul", 0), plan.get("prefilled_ul", 0), plan.get("min_ul", 0)
+    destinations = [transfer.get("destination") for transfer in plan.get("transfers", [])]
+    if len(set(destinations)) != len(destinations):
+        problems.append("two samples share a destination well")
+    for transfer in plan.get("transfers", []):
+        label = transfer.get("name", "?")
+        for well in ("source", "destination"):
+            if not isinstance(transfer.get(well), str) or not _WELL.match(transfer[well]):
+                problems.append(f"{label}: bad {well} well {transfer.get(well)!r}")
+        total = prefilled_ul
+        for key in ("sample_ul", "diluent_ul"):
+            volume = transfer.get(key)
+            if not isinstance(volume, (int, float)) or not np.isfinite(volume) or volume < 0:
+                problems.append(f"{label}: bad {key} {volume!r}")
+                continue
+            if 0 < volume < min_ul:
+                problems.append(f"{label}: {key} {volume} is below the {min_ul} µL minimum")
+            total += volume
+        if total > final_ul + 0.1:
+            problems.append(f"{label}: {total:g} µL in the well, more than {final_ul:g} µL")
+        unknown = set(transfer.get("flags", ())) - set(FLAGS)
+        if unknown:
+            problems.append(f"{label}: unknown flags {', '.join(sorted(unknown))}")
+    if problems:
+        raise ValueError("Invalid normalization plan: " + "; ".join(problems))
+    return plan
+
+
+def plan_path(plate_file, directory=PLAN_DIR) -> Path:
+    """Where the plan for an export goes: <directory>/<export name>.json."""
+    return Path(directory) / f"{Path(plate_file).stem}.json"
+
+
+def write_plan(plan: dict, path) -> tuple:
+    """Write plan as JSON to path and as CSV next to it; returns both paths."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    rows = io.StringIO()
+    writer = csv.DictWriter(rows, fieldnames=list(plan["transfers"][0]) if plan["transfers"] else ["sample"])
+    writer.writeheader()
+    for transfer in plan["transfers"]:
+        writer.writerow({**transfer, "flags": ";".join(transfer["flags"])})
+    table = path.with_suffix(".csv")
+    _write_atomically(table, rows.getvalue())
+    # the JSON last: a protocol reuses a plan only once it is complete
+    _write_atomically(path, json.dumps(plan, indent=2, ensure_ascii=False) + "\n")
+    return path, table
+
+
+def _write_atomically(path: Path, text: str):
+    # a crash leaves the old file or the new one, never half of one
+    temporary = path.with_name(f".{path.name}.tmp")
+    with open(temporary, "w", newline="", encoding="utf-8") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+
+
+def load_plan(path) -> dict:
+    """Read and validate a JSON plan."""
+    return validate_plan(json.loads(Path(path).read_text(encoding="utf-8")))
+
+
+def load_or_plan(plate_file, samples: int, sources=None, destinations=None, directory=PLAN_DIR, **settings) -> dict:
+    """
+    The plan for an export: the one made off the robot, or a new one.
+
+    A plan in directory is used when it was made from this very file (same
+    content hash) and from the same absorbances (ABSORBANCE); it must then
+    match the protocol's samples, wells and settings. Otherwise a plan is made
+    with the default names and the protocol's wells, and written to directory.
+
+    Args:
+        plate_file: Plate reader export.
+        samples (int): Number of unknowns the protocol loaded.
+        sources, destinations: The protocol's tubes and wells, to plan with or check the plan against.
+        settings: target_mg_ml, final_ul, prefilled_ul, min_ul and weighting for plan_normalization().
+
+    Raises:
+        ValueError: If the existing plan does not fit the protocol, or no valid plan can be made.
+    """
+    from plate_reader import file_hash
+
+    path = plan_path(plate_file, directory)
+    plan = None
+    if path.exists():
+        plan = load_plan(path)
+        if plan["source_hash"] != file_hash(plate_file):
+            print(f"{path.name} was planned from another version of {Path(plate_file).name}; planning again")
+            plan = None
+        elif plan.get("absorbance") != ABSORBANCE:
+            print(f"{path.name} was planned from the {plan.get('absorbance', 'plain')} mean absorbances; planning again")
+            plan = None
+    if plan is None:
+        plan = plan_normalization(plate_file, samples, sources=sources, destinations=destinations, **settings)
+        try:
+            write_plan(plan, path)
+        except OSError as e:
+            print(f"Could not save the plan to {path}: {e}")
+        return plan
+    problems = [f"{key} is {plan[key]:g}, the protocol uses {value:g}" for key, value in settings.items()
+                if key in plan and value is not None and not np.isclose(plan[key], value)]
+    if len(plan["transfers"]) != samples:
+        problems.append(f"{len(plan['transfers'])} samples, the protocol loaded {samples}")
+    for key, wells in (("source", sources), ("destination", destinations)):
+        if wells is not None and [transfer[key] for transfer in plan["transfers"]] != list(wells)[:samples]:
+            problems.append(f"{key} wells differ from the protocol's")
+    if problems:
+        raise ValueError(f"The plan {path} does not fit this run: " + "; ".join(problems))
+    return plan
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Plan the normalization transfers from a BCA plate reader export.")
+    parser.add_argument("file", nargs="?", help="plate reader export; default: wait for today's in " + PLATE_READER_DIR)
+    parser.add_argument("--samples", type=int, help="number of unknowns (default: the manifest's length)")
+    parser.add_argument("--manifest", help="CSV with name[,source][,destination] per sample, in plate order")
+    parser.add_argument("--target", type=float, default=TARGET_MG_ML, help="target concentration, mg/mL")
+    parser.add_argument("--final-ul", type=float, default=FINAL_UL, help="final volume per sample, µL")
+    parser.add_argument("--prefilled-ul", type=float, default=0.0, help="diluent already in each well, µL")
+    parser.add_argument("--min-ul", type=float, default=MIN_VOLUME_UL, help="smallest volume to pipette, µL")
+    parser.add_argument("--weighting", choices=["1/y^2"], help="standard curve weighting")
+    parser.add_argument("--output", default=str(PLAN_DIR), help="folder for the plan")
+    args = parser.parse_args()
+
+    plate_file = args.file
+    if plate_file is None:
+        from file_watcher import wait_for_file
+
+        plate_file = wait_for_file(PLATE_READER_DIR).path
+    plan = plan_normalization(plate_file, args.samples, args.manifest and load_manifest(args.manifest),
+                              args.target, args.final_ul, args.prefilled_ul, args.min_ul, args.weighting)
+    for note in plan["notes"]:
+        print(note)
+    for transfer in plan["transfers"]:
+        print(f"{transfer['name']:<20} {transfer['source'] or '-':>4} -> {transfer['destination']:<4} "
+              f"{transfer['concentration_mg_ml'] if transfer['concentration_mg_ml'] is not None else '-':>7} mg/mL  "
+              f"{transfer['sample_ul']:>6.1f} µL sample  {transfer['diluent_ul']:>6.1f} µL diluent  "
+              f"{' '.join(transfer['flags'])}")
+    for path in write_plan(plan, plan_path(plate_file, args.output)):
+        print(f"Wrote {path}")
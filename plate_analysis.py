@@ -0,0 +1,128 @@
+import numpy as np
+
+# Plate reader results as numpy arrays, shared by the BCA normalization
+# protocols.
+#
+# A plate is one (8, 12) array of absorbances (rows A-H, columns 1-12), or a
+# stack of plates (n_plates, 8, 12). Samples are in triplicate across three
+# neighbouring columns of a row and numbered down the rows one group of three
+# columns at a time:
+#
+#     Sample 1-8    A1:A3 ... H1:H3   (the BSA standards)
+#     Sample 9-16   A4:A6 ... H4:H6
+#     ...
+#     Sample 25-32  A10:A12 ... H10:H12
+#
+# triplicates() gets every sample's replicates with a reshape and a swap of
+# axes instead of indexing well by well, and replicate_stats() computes
+# means, CVs and outlier masks for all samples of all plates at once.
+
+ROWS = "ABCDEFGH"
+PLATE_SHAPE = (8, 12)
+REPLICATES = 3
+STANDARD_CONCENTRATIONS = (10, 5, 2.5, 1.25, 0.625, 0.3125, 0.15625, 0)  # mg/mL BSA, samples 1-8
+OUTLIER_FRACTION = 0.2  # a replicate this far from its group's median (relative) ...
+OUTLIER_ABSOLUTE = 0.02  # ... and this far in absorbance units is an outlier
+
+
+def as_plates(values) -> np.ndarray:
+    """
+    Absorbances as a float array of shape (8, 12) or (n_plates, 8, 12).
+
+    Raises:
+        ValueError: If the values are not one plate or a stack of plates.
+    """
+    plates = np.asarray(values, dtype=float)
+    if plates.shape[-2:] != PLATE_SHAPE or plates.ndim not in (2, 3):
+        raise ValueError(f"Expected an 8 x 12 plate or a stack of them, got shape {plates.shape}")
+    return plates
+
+
+def triplicates(plates, replicates: int = REPLICATES) -> np.ndarray:
+    """
+    Replicates of every sample, in sample order.
+
+    Args:
+        plates: (8, 12) or (n_plates, 8, 12) absorbances.
+        replicates (int): Neighbouring columns per sample.
+
+    Returns:
+        ndarray: (32, 3) for one plate, (n_plates, 32, 3) for a stack.
+    """
+    plates = as_plates(plates)
+    rows, columns = PLATE_SHAPE
+    groups = columns // replicates
+    # (..., row, group, replicate) -> (..., group, row, replicate) -> (..., sample, replicate)
+    by_group = plates.reshape(*plates.shape[:-2], rows, groups, replicates).swapaxes(-3, -2)
+    return by_group.reshape(*plates.shape[:-2], groups * rows, replicates)
+
+
+def sample_wells(replicates: int = REPLICATES) -> list:
+    """Wells of each sample in sample order, e.g. [["A1", "A2", "A3"], ["B1", "B2", "B3"], ...]."""
+    rows, columns = PLATE_SHAPE
+    return [[f"{row}{group * replicates + i + 1}" for i in range(replicates)]
+            for group in range(columns // replicates) for row in ROWS]
+
+
+def outlier_mask(values, fraction: float = OUTLIER_FRACTION, absolute: float = OUTLIER_ABSOLUTE) -> np.ndarray:
+    """
+    Replicates that disagree with the rest of their sample.
+
+    A replicate is an outlier when it is further from the median of its
+    sample than both fraction of that median and absolute.
+
+    Args:
+        values: (..., replicates) array, e.g. from triplicates().
+
+    Returns:
+        ndarray: Boolean mask of the same shape.
+    """
+    values = np.asarray(values, dtype=float)
+    median = np.median(values, axis=-1, keepdims=True)
+    distance = np.abs(values - median)
+    return (distance > fraction * np.abs(median)) & (distance > absolute)
+
+
+def replicate_stats(plates, replicates: int = REPLICATES, fraction: float = OUTLIER_FRACTION,
+                    absolute: float = OUTLIER_ABSOLUTE) -> dict:
+    """
+    Mean, standard deviation, CV and outliers of every sample, for one plate or a stack.
+
+    Returns:
+        dict: "replicates" (..., 32, 3), and per sample "mean", "sd", "cv" (sd / mean),
+            "outliers" (..., 32, 3 mask) and "clean_mean" (mean without the outliers).
+    """
+    values = triplicates(plates, replicates)
+    mean = values.mean(axis=-1)
+    sd = values.std(axis=-1, ddof=1)
+    outliers = outlier_mask(values, fraction, absolute)
+    kept = np.where(outliers, 0.0, values)
+    counts = (~outliers).sum(axis=-1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cv = np.where(mean != 0, sd / np.abs(mean), np.nan)
+        clean_mean = np.where(counts > 0, kept.sum(axis=-1) / counts, mean)
+    return {"replicates": values, "mean": mean, "sd": sd, "cv": cv, "outliers": outliers, "clean_mean": clean_mean}
+
+
+def replicate_table(plate, replicates: int = REPLICATES):
+    """
+    One plate's samples as a DataFrame: Sample, Wells, Replicate 1-3, Mean Absorbance, CV and Outliers.
+
+    Raises:
+        ValueError: If plate is not a single 8 x 12 plate.
+    """
+    import pandas as pd
+
+    plate = as_plates(plate)
+    if plate.ndim != 2:
+        raise ValueError("replicate_table() takes one plate; use replicate_stats() for a stack")
+    stats = replicate_stats(plate, replicates)
+    values = stats["replicates"]
+    table = pd.DataFrame({"Sample": [f"Sample {i + 1}" for i in range(len(values))],
+                          "Wells": [":".join((wells[0], wells[-1])) for wells in sample_wells(replicates)]})
+    for i in range(replicates):
+        table[f"Replicate {i + 1}"] = values[:, i]
+    table["Mean Absorbance"] = stats["mean"]
+    table["CV"] = stats["cv"]
+    table["Outliers"] = stats["outliers"].sum(axis=-1)
+    return table
@@ -0,0 +1,154 @@
+import csv
+import hashlib
+import io
+from pathlib import Path
+
+import numpy as np
+
+# Read the 96 absorbances out of a plate reader export, and nothing else.
+#
+# pd.read_excel parses the whole workbook into a DataFrame; here .xlsx files
+# are streamed with openpyxl in read-only, values-only mode and reading stops
+# at the last row of the plate. The reader's CSV/TXT exports are read with the
+# csv module. Either way the layout is found from the header row (the column
+# numbers 1-12), so the plate does not have to start at C7; if no header row
+# is found the block the protocols always used, C7:N14, is taken.
+#
+# Grids are cached by a hash of the file's bytes, in memory and in CACHE_DIR,
+# so analysing the same export again (or rerunning a protocol on it) costs a
+# hash and a small .npy read.
+
+PLATE_SHAPE = (8, 12)
+DEFAULT_ORIGIN = (7, 3)  # C7: first data row and column, 1-based
+HEADER_SCAN_ROWS = 60
+CACHE_DIR = Path.home() / ".cache" / "flex_plates"
+_memory = {}
+
+
+def file_hash(path) -> str:
+    return hashlib.blake2b(Path(path).read_bytes(), digest_size=16).hexdigest()
+
+
+def read_plate(path, cache: bool = True) -> np.ndarray:
+    """
+    The plate's absorbances as an (8, 12) float array (NaN for empty or non-numeric wells).
+
+    Args:
+        path: .xlsx/.xlsm, .csv, .txt/.tsv export, or a legacy .xls.
+        cache (bool): Look up and store the grid by the file's content hash.
+
+    Raises:
+        ValueError: If the file does not contain a full 8 x 12 block.
+    """
+    path = Path(path)
+    key = file_hash(path) if cache else None
+    if key is not None:
+        if key in _memory:
+            return _memory[key].copy()
+        try:
+            plate = np.load(CACHE_DIR / f"{key}.npy")
+            _memory[key] = plate
+            return plate.copy()
+        except (OSError, ValueError):
+            pass
+    suffix = path.suffix.lower()
+    if suffix in (".xlsx", ".xlsm"):
+        plate = _grid(_xlsx_rows(path), default=True)
+    elif suffix in (".csv", ".txt", ".tsv"):
+        plate = _grid(_text_rows(path), default=False)
+    else:
+        plate = _grid(_xls_rows(path), default=True)
+    if key is not None:
+        _memory[key] = plate
+        try:
+            CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            np.save(CACHE_DIR / f"{key}.npy", plate)
+        except OSError:
+            pass  # caching is only an optimisation
+    return plate.copy()
+
+
+def _xlsx_rows(path):
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        yield from workbook.worksheets[0].iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+
+def _text_rows(path):
+    text = Path(path).read_text(encoding="utf-8-sig", errors="replace")
+    try:
+        dialect = csv.Sniffer().sniff(text[:4096], delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel_tab if "\t" in text else csv.excel
+    yield from csv.reader(io.StringIO(text), dialect)
+
+
+def _xls_rows(path):
+    # legacy binary workbooks: no streaming reader, so let pandas (xlrd) load the first sheet
+    import pandas as pd
+
+    frame = pd.read_excel(path, header=None, nrows=HEADER_SCAN_ROWS)
+    yield from frame.itertuples(index=False, name=None)
+
+
+def _header_column(row) -> int:
+    """0-based column where the labels 1, 2, ... 12 start in row, or None."""
+    labels = [_label(value) for value in row]
+    columns = PLATE_SHAPE[1]
+    for start in range(len(labels) - columns + 1):
+        if labels[start:start + columns] == list(range(1, columns + 1)):
+            return start
+    return None
+
+
+def _label(value):
+    try:
+        number = float(str(value).strip())
+    except ValueError:
+        return None
+    return int(number) if number.is_integer() else None
+
+
+def _number(value) -> float:
+    try:
+        return float(str(value).strip().replace(",", ".")) if value not in (None, "") else np.nan
+    except ValueError:
+        return np.nan  # e.g. OVRFLW
+
+
+def _pad(values: list, width: int) -> list:
+    # read-only worksheets and CSV lines stop at the last non-empty cell
+    return list(values) + [None] * (width - len(values))
+
+
+def _grid(rows, default: bool) -> np.ndarray:
+    """Find the header row in the first rows, then take the 8 x 12 block under it."""
+    height, width = PLATE_SHAPE
+    seen = []
+    column = None
+    for row in rows:
+        row = list(row)
+        if column is None:
+            seen.append(row)
+            column = _header_column(row)
+            if column is None and len(seen) >= HEADER_SCAN_ROWS:
+                break
+            if column is not None:
+                block = []
+            continue
+        block.append(_pad(row[column:column + width], width))
+        if len(block) == height:
+            break
+    if column is None:
+        if not default:
+            raise ValueError("No header row with the column numbers 1-12 found")
+        # the layout the protocols have always read: C7:N14
+        first_row, first_column = DEFAULT_ORIGIN[0] - 1, DEFAULT_ORIGIN[1] - 1
+        block = [_pad(row[first_column:first_column + width], width) for row in seen[first_row:first_row + height]]
+    if len(block) < height:
+        raise ValueError(f"The plate block is incomplete ({len(block)} rows)")
+    return np.array([[_number(value) for value in row] for row in block], dtype=float)
@@ -1,46 +1,514 @@
+import argparse
+import os
+import queue
+import signal
+import subprocess
+import threading
 import time
-import imageio.v3 as iio
-import imageio.v2 as iid
+from pathlib import Path
 
-# call this script in your opentrons protocol to 
+from avi_writer import jpeg_size
+from camera import Camera, Frame, FrameRing
+from metrics import MetricsFile, Registry, add_process_metrics, rate
+from recordings import read_info, write_info
+from replay_buffer import ReplayBuffer, dump_name, remove_pid_file, write_pid_file
+from retention import QUOTA_BYTES, RECORDINGS_DIR, enforce, fit_to_disk, parse_size
+from segments import SEGMENT_SECONDS, SegmentedWriter, load_index
+from timelapse import TimelapseBuilder
+
+# call this script in your opentrons protocol to
 #initiate recording a video of the instrument during your run.
+#
+# By default the camera's own JPEG frames are stored untouched in MJPEG .avi
+# files (passthrough), so the recorder does almost no work next to the robot
+# server. The run is written as a folder of one-minute segments with an
+# index.jsonl (see segments.py), so stopping or crashing the recorder loses at
+# most the last minute. Use --encode for live H.264, or --transcode after the
+# run (or on another computer) to shrink a passthrough recording.
+#
+# With --buffer-minutes nothing is written at all unless something goes wrong:
+# the last minutes are kept in memory and dumped to disk on SIGUSR1 (see
+# replay_buffer.py).
+
+QUEUE_SIZE = 120  # frames buffered between the capture and encoder threads
+
+class DropLog:
+    """
+    Dropped frames, merged into time ranges for the end-of-recording report.
+
+    Args:
+        start_time (float): Recording start, used to report drops as offsets into the video.
+    """
+
+    def __init__(self, start_time: float):
+        self.start_time = start_time
+        self.total = 0
+        self.reasons = {}  # frames dropped per reason, for /metrics
+        self.spans = []  # [first offset, last offset, frames, reason]
 
-def record_video(output_file: str, duration: int, device_index: str = "<video2>"):
+    def add(self, timestamp: float, reason: str, count: int = 1):
+        offset = timestamp - self.start_time
+        self.total += count
+        self.reasons[reason] = self.reasons.get(reason, 0) + count
+        last = self.spans[-1] if self.spans else None
+        if last is not None and last[3] == reason and offset - last[1] < 1.0:
+            last[1] = offset
+            last[2] += count
+        else:
+            self.spans.append([offset, offset, count, reason])
+
+    def summary(self) -> str:
+        if not self.total:
+            return "No frames dropped."
+        lines = [f"Dropped {self.total} frames:"]
+        for first, last, count, reason in self.spans:
+            lines.append(f"  {first:8.1f}s - {last:8.1f}s  {count:5d} frames ({reason})")
+        return "\n".join(lines)
+
+class FrameDecimator:
+    """
+    Keep at most one frame per slot of a constant fps timeline, chosen by capture timestamp.
+
+    Used before anything is queued or decoded, so frames the recording will not
+    keep cost nothing beyond reading them off the ring.
+
+    Args:
+        fps (float): Output frame rate.
+    """
+
+    def __init__(self, fps: float):
+        self.fps = fps
+        self._start = None
+        self._last = -1
+
+    def slot(self, timestamp: float):
+        """Return the output slot for a frame, or None if that slot is already filled."""
+        if self._start is None:
+            self._start = timestamp
+        index = int((timestamp - self._start) * self.fps + 0.5)
+        if index <= self._last:
+            return None
+        self._last = index
+        return index
+
+class Recorder:
+    """
+    Producer/consumer recorder.
+
+    A capture thread takes frames off the shared camera ring and timestamps
+    them into a bounded queue; an encoder thread drains the queue into the
+    writer. A slow write therefore never stalls reading the camera, and any
+    frame that cannot be queued is counted in the drop log with its position
+    in the video instead of silently disappearing.
+
+    Frames beyond the output fps are decimated by capture timestamp before
+    they are queued, and gaps are filled by repeating the previous frame, so
+    the video plays back in real time whatever rate the camera delivers.
+
+    With adaptive set, frames of a still deck are dropped as well (see
+    motion.py): long incubations shrink to an occasional frame while the
+    timeline stays real time.
+
+    With buffer_seconds set, frames go to an in-memory ReplayBuffer instead of
+    the disk, and only dump() writes them out, into a dump_<time> folder
+    inside output_file.
+
+    With scale_width set (when the disk is short of space), frames are scaled
+    down in the encoder thread before they are written.
+
+    With roi set, the recording itself stays the camera's full frames (still
+    passthrough); motion detection, the timelapse and the contact sheets look
+    at that part of the deck only (see rois.py), and the region is stored in
+    the recording's info for viewers to crop to. With crop set as well, the
+    recorded frames are cropped too, in the encoder thread: that decodes and
+    re-encodes every frame, so it costs far more CPU than passthrough.
+
+    With timelapse_speed set, a timelapse and per-hour contact sheets are built
+    alongside the recording (see timelapse.py), from every captured frame
+    whether or not the recording keeps it.
+
+    Counters, the encoder queue depth and a capture-to-write latency
+    histogram are kept in self.metrics (see metrics.py).
+
+    Args:
+        output_file (str): Directory for the segments, or the output video file when segment_seconds is None.
+        ring (FrameRing): Shared camera ring buffer to record from.
+        fps (float): Frame rate of the output video.
+        passthrough (bool): Store the camera's JPEG frames as-is instead of decoding and re-encoding them.
+        queue_size (int): Frames buffered between the capture and encoder threads.
+        segment_seconds (float): Length of each segment, or None for a single file.
+        adaptive (bool): Skip frames while nothing on the deck moves.
+        buffer_seconds (float): Keep only this much in memory until dump() is called.
+        scale_width (int): Scale frames down to this width before writing them.
+        timelapse_speed (float): Build a timelapse this many times faster than real time, and contact sheets.
+        roi (tuple): (left, top, right, bottom) fractions of the frame to watch, or None for the whole frame.
+        crop (bool): Also crop the recorded frames to roi.
+        since (float): Start with the frames still in the ring captured at or after this time,
+            instead of the next new one (so a recording asked for a moment ago misses nothing).
+    """
+
+    def __init__(self, output_file: str, ring: FrameRing, fps: float = 3, passthrough: bool = True,
+                 queue_size: int = QUEUE_SIZE, segment_seconds: float = SEGMENT_SECONDS,
+                 adaptive: bool = False, buffer_seconds: float = None, scale_width: int = None,
+                 timelapse_speed: float = None, roi: tuple = None, crop: bool = False, since: float = None):
+        self.output_file = output_file
+        self.ring = ring
+        self.fps = fps
+        self.passthrough = passthrough
+        self.segment_seconds = segment_seconds
+        self.adaptive = adaptive
+        self.buffer = ReplayBuffer(buffer_seconds) if buffer_seconds else None
+        self.scale_width = scale_width
+        self.timelapse_speed = timelapse_speed
+        self.roi = roi
+        self.crop = crop
+        self.since = since
+        self.timelapse = None
+        self.frames_captured = 0
+        self.frames_written = 0
+        self.frames_skipped = 0
+        self.frames_still = 0
+        self.bytes_written = 0
+        self.drops = None
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._threads = []
+        self._dumps = []
+        self.metrics = Registry()
+        self.latency = self._register(self.metrics)
+
+    def _register(self, registry: Registry):
+        registry.counter("flex_recorder_frames_captured_total", "Frames taken off the camera ring.",
+                         lambda: self.frames_captured)
+        registry.counter("flex_recorder_frames_written_total", "Frames written to the recording (or replay buffer).",
+                         lambda: self.frames_written)
+        registry.counter("flex_recorder_frames_skipped_total", "Frames not kept on purpose.",
+                         lambda: {"decimated": self.frames_skipped, "still": self.frames_still}, label="reason")
+        registry.counter("flex_recorder_frames_dropped_total", "Frames lost because something was behind.",
+                         lambda: dict(self.drops.reasons) if self.drops else {}, label="reason")
+        registry.gauge("flex_recorder_queue_depth", "Frames waiting for the encoder thread.", self._queue.qsize)
+        registry.counter("flex_recorder_bytes_written_total", "JPEG bytes handed to the writer.",
+                         lambda: self.bytes_written)
+        registry.gauge("flex_recorder_write_bytes_per_second", "Bytes written per second since the last update.",
+                       rate(lambda: self.bytes_written))
+        registry.counter("flex_recorder_timelapse_dropped_total", "Timelapse frames skipped because its thread was behind.",
+                         lambda: self.timelapse.dropped if self.timelapse else 0)
+        add_process_metrics(registry, "flex_recorder")
+        return registry.histogram("flex_recorder_capture_to_write_seconds",
+                                  "Time from capture to the frame being written.")
+
+    def start(self):
+        self.drops = DropLog(time.time())
+        if self.segment_seconds and self.buffer is None:
+            info = read_info(self.output_file) or {"started": self.drops.start_time}  # also retention.py's marker
+            if self.roi and not self.crop:
+                info["roi"] = list(self.roi)
+            write_info(self.output_file, **info)
+        if self.timelapse_speed:
+            output = Path(self.output_file)
+            if self.segment_seconds:
+                self.timelapse = TimelapseBuilder(output, self.timelapse_speed, roi=self.roi)
+            else:
+                self.timelapse = TimelapseBuilder(output.parent, self.timelapse_speed, prefix=f"{output.stem}_",
+                                                  roi=self.roi)
+        self._threads = [
+            threading.Thread(target=self._capture, name="recorder-capture", daemon=True),
+            threading.Thread(target=self._encode, name="recorder-encode", daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def wait(self, duration: float):
+        """Block until duration seconds have passed since start (or the recorder stopped)."""
+        self._stop.wait(max(duration - (time.time() - self.drops.start_time), 0))
+
+    def stop(self):
+        self._stop.set()
+        for thread in self._threads + self._dumps:
+            thread.join()
+        if self.timelapse is not None:
+            self.timelapse.close()
+        print(self.drops.summary())
+
+    def dump(self) -> str:
+        """
+        Write the replay buffer to disk without interrupting the recording.
+
+        Returns:
+            str: Folder the dump is written to, or None when not recording to a buffer.
+        """
+        if self.buffer is None:
+            return None
+        directory = str(Path(self.output_file) / dump_name())
+        self._dumps.append(self.buffer.dump(directory, self.fps, self.passthrough))
+        return directory
+
+    def _capture(self):
+        try:
+            decimator = FrameDecimator(self.fps)
+            motion = None
+            if self.adaptive:
+                from motion import MotionDetector
+                motion = MotionDetector(roi=self.roi)
+            seq = (self.ring.next_seq if self.since is None else self.ring.seq_at(self.since)) - 1
+            still = None
+            while not self._stop.is_set():
+                frame = self.ring.wait_next(seq, timeout=1.0)
+                if frame is None:
+                    if self.ring.closed:
+                        break
+                    continue
+                if seq >= 0 and frame.seq > seq + 1:
+                    # the camera ring overwrote frames before we got to them
+                    self.drops.add(frame.timestamp, "camera ring overrun", frame.seq - seq - 1)
+                seq = frame.seq
+                self.frames_captured += 1
+                if self.timelapse is not None:
+                    self.timelapse.offer(frame)
+                slot = decimator.slot(frame.timestamp)
+                if slot is None:
+                    self.frames_skipped += 1
+                    continue
+                if motion is not None and not motion.keep(frame.data, frame.timestamp):
+                    self.frames_still += 1
+                    still = (slot, frame)
+                    continue
+                still = None
+                try:
+                    self._queue.put_nowait((slot, frame))
+                except queue.Full:
+                    self.drops.add(frame.timestamp, "encoder behind")
+            if still is not None:
+                # end on the last frame seen so the video covers the whole run
+                try:
+                    self._queue.put_nowait(still)
+                    self.frames_still -= 1
+                except queue.Full:
+                    pass
+        except Exception as e:
+            print(f"Capture failed: {e}")
+            self._stop.set()
+        finally:
+            # tell the encoder to finish, unless it already died
+            while self._threads[1].is_alive():
+                try:
+                    self._queue.put(None, timeout=1.0)
+                    break
+                except queue.Full:
+                    pass
+
+    def _encode(self):
+        writer = self.buffer or SegmentedWriter(self.output_file, self.fps, self.passthrough, self.segment_seconds)
+        scale = failure = None  # failure: the drop reason for a frame scale() cannot decode
+        if self.roi and self.crop:
+            from rois import crop_jpeg
+            scale, failure = lambda data, width: crop_jpeg(data, self.roi, width), "could not crop"
+        elif self.scale_width:
+            from frame_cache import scale_jpeg
+            scale, failure = scale_jpeg, "could not scale"
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+                slot, frame = item
+                if scale is not None:
+                    try:
+                        frame = Frame(frame.seq, frame.timestamp, scale(frame.data, self.scale_width))
+                    except OSError:
+                        # one corrupt camera frame must not end a cropped or scaled-down recording
+                        self.drops.add(frame.timestamp, failure)
+                        continue
+                if writer.write(slot, frame):
+                    self.frames_written += 1
+                    self.bytes_written += len(frame.data)
+                    self.latency.observe(time.time() - frame.timestamp)
+        except Exception as e:
+            print(f"Recording failed: {e}")
+            self._stop.set()
+            raise
+        finally:
+            # Close the writer when done
+            writer.close()
+
+def record_video(output_file: str, duration: int, device_path: str = "/dev/video2",
+                 fps: float = 3, passthrough: bool = True, width: int = None, height: int = None,
+                 segment_seconds: float = SEGMENT_SECONDS, adaptive: bool = False,
+                 buffer_seconds: float = None, quota: int = QUOTA_BYTES, timelapse_speed: float = None,
+                 roi: str = None, crop: bool = False):
     """
     Record video from the flexs camera.
 
+    Frames come from the shared camera capture loop, so recording works while
+    the video app is streaming the same camera. If the recorder is the one
+    opening the camera, it asks the device for the requested resolution and
+    the lowest frame rate that covers fps.
+
+    The recorder also stops cleanly on SIGTERM (what the protocols send with
+    video_process.terminate()), so the last segment is finalized too.
+
+    With buffer_seconds set, only the last buffer_seconds are kept, in memory,
+    and written to output_file/dump_<time> each time the recorder gets SIGUSR1
+    (replay_buffer.request_dump(), or POST /recorder/dump on the video app).
+
+    Before recording to disk, old recordings over the quota are deleted (see
+    retention.py), and if the rest of the run would still not fit in the free
+    space the frame rate, then the frame size, is lowered to make it fit.
+
+    While recording, the recorder's metrics are written to
+    metrics.RECORDER_METRICS every few seconds, for the video app's /metrics.
+
     Args:
-        output_file (str): Path to the output video file.
+        output_file (str): Directory for the segments, or the output video file when segment_seconds is None.
         duration (int): Duration to record (in seconds).
-        device_index (str): Camera device (e.g., "<video2>").
+        device_path (str): Camera device (e.g., "/dev/video2").
+        fps (float): Frame rate of the output video.
+        passthrough (bool): Store the camera's JPEG frames as-is instead of decoding and re-encoding them.
+        width (int): Capture width, or None for the camera default.
+        height (int): Capture height, or None for the camera default.
+        segment_seconds (float): Length of each segment, or None for a single file.
+        adaptive (bool): Skip frames while nothing on the deck moves.
+        buffer_seconds (float): Keep only this much in memory, to be dumped on SIGUSR1.
+        quota (int): Bytes all recordings in the notebooks folder may take, or None to delete nothing.
+        timelapse_speed (float): Also build a timelapse this many times faster, and contact sheets.
+        roi (str): Part of the deck to watch, e.g. "deck" or "D2" (see rois.py); see Recorder.
+        crop (bool): Crop the recorded frames to roi as well (decodes and re-encodes every frame).
+
+    Returns:
+        Recorder: The finished recorder, with frames_written and the drop log.
     """
     print(f"Recording video to {output_file} for {duration} seconds...")
+    box = None
+    if roi is not None:
+        from rois import find_roi
+        box = find_roi(roi)
 
-    # Open the video writer with the desired FPS
-    fps = 3  # Adjust FPS as needed
-    writer = iid.get_writer(output_file, fps=fps)
-
-    start_time = time.time()
-    
     # Capture frames from the camera for the specified duration
-    for idx, frame in enumerate(iio.imiter(device_index)):
-        # Stop recording after the specified duration
-        if time.time() - start_time > duration:
-            break
+    with Camera(device_path, width=width, height=height, fps=fps) as camera:
+        scale_width = None
+        if not buffer_seconds:
+            fps, scale_width = make_room(output_file, duration, fps, camera, quota)
+        recorder = Recorder(output_file, camera.ring, fps=fps, passthrough=passthrough,
+                            segment_seconds=segment_seconds, adaptive=adaptive,
+                            buffer_seconds=buffer_seconds, scale_width=scale_width,
+                            timelapse_speed=None if buffer_seconds else timelapse_speed, roi=box,
+                            crop=crop).start()
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda signum, stack: recorder._stop.set())
+            if buffer_seconds:
+                signal.signal(signal.SIGUSR1, lambda signum, stack: recorder.dump())
+                write_pid_file()
+        metrics_file = MetricsFile(recorder.metrics).start()
+        try:
+            recorder.wait(duration)
+            recorder.stop()
+        finally:
+            metrics_file.stop()
+            if buffer_seconds:
+                remove_pid_file()
+    if adaptive:
+        print(f"Skipped {recorder.frames_still} frames of a still deck.")
+    if camera.error is not None:
+        raise camera.error
 
-        # Print the current frame index for debugging
-        #print(f"Frame {idx}")
+    print("Recording completed!")
+    return recorder
 
-        # Write the current frame to the video file
-        writer.append_data(frame)
+def make_room(output_file: str, duration: float, fps: float, camera: Camera, quota: int = QUOTA_BYTES) -> tuple:
+    """
+    Free space for a recording and pick settings that fit in what is left.
 
-    # Close the writer when done
-    writer.close()
-    print("Recording completed!")
+    Returns:
+        tuple: (fps, width to scale frames to or None).
+    """
+    # only ever delete recordings in the notebooks folder, never next to an --output elsewhere
+    parent = Path(output_file).resolve().parent
+    if quota is not None and parent == Path(RECORDINGS_DIR).resolve():
+        enforce(parent, quota, keep=[output_file])
+    frame = camera.ring.wait_next(camera.ring.next_seq - 1, timeout=10.0)
+    if frame is None:
+        return fps, None
+    fitted, scale_width, free = fit_to_disk(output_file, duration, fps, len(frame.data), jpeg_size(frame.data)[0])
+    if fitted < fps or scale_width:
+        print(f"Only {max(free, 0) / 2**30:.1f} GB free: recording at {fitted:.2f} fps"
+              + (f", frames scaled to {scale_width} wide" if scale_width else ""))
+    return fitted, scale_width
+
+def transcode(input_file: str, output_file: str = None, crf: int = 23, speed: float = 1) -> str:
+    """
+    Re-encode a passthrough MJPEG recording to a much smaller H.264 mp4.
+
+    Meant to run after the protocol has finished, or on another computer. On
+    the robot it runs at the lowest CPU priority.
+
+    Args:
+        input_file (str): Passthrough recording (.avi), or a segmented recording folder.
+        output_file (str): Path of the mp4 to write. Defaults to input_file with a .mp4 suffix.
+        crf (int): x264 quality (lower is better, 18-28 is sensible).
+        speed (float): Playback speed-up for a timelapse, e.g. 60; 1 keeps real time.
+
+    Returns:
+        str: Path of the transcoded file.
+    """
+    import imageio_ffmpeg
+
+    source = Path(input_file)
+    output_file = output_file or str(source.with_suffix(".mp4"))
+    inputs = ["-i", str(source)]
+    if source.is_dir():
+        # join the segments in recording order
+        playlist = source / "concat.txt"
+        playlist.write_text("".join(f"file '{e['file']}'\n" for e in load_index(source)))
+        inputs = ["-f", "concat", "-safe", "0", "-i", str(playlist)]
+    timelapse = ["-vf", f"setpts=PTS/{speed}", "-r", "30"] if speed != 1 else []
+    command = [
+        imageio_ffmpeg.get_ffmpeg_exe(), "-y", "-loglevel", "error", *inputs, *timelapse,
+        "-c:v", "libx264", "-preset", "veryfast", "-crf", str(crf), "-pix_fmt", "yuv420p",
+        output_file,
+    ]
+    subprocess.run(command, check=True, preexec_fn=(lambda: os.nice(19)) if hasattr(os, "nice") else None)
+    return output_file
+
+def build_parser() -> argparse.ArgumentParser:
+    """Command line of record_video.py, also used to parse the arguments sent to recorder_service.py."""
+    parser = argparse.ArgumentParser(description="Record the flex camera during a protocol run.")
+    parser.add_argument("--duration", type=int, default=2100, help="seconds to record")
+    parser.add_argument("--fps", type=float, default=3, help="frame rate of the recording")
+    parser.add_argument("--width", type=int, help="capture width (must be offered by the camera)")
+    parser.add_argument("--height", type=int, help="capture height (must be offered by the camera)")
+    parser.add_argument("--segment", type=float, default=SEGMENT_SECONDS,
+                        help="segment length in seconds, 0 for a single file")
+    parser.add_argument("--output", help="output folder, or file with --segment 0 (default: dated, in the notebooks folder)")
+    parser.add_argument("--adaptive", action="store_true", help="skip frames while nothing on the deck moves")
+    parser.add_argument("--buffer-minutes", type=float,
+                        help="keep only the last N minutes in memory, written to disk on SIGUSR1")
+    parser.add_argument("--quota", type=parse_size, default=QUOTA_BYTES,
+                        help="total size of the recordings in the notebooks folder, e.g. 20G; older ones are deleted")
+    parser.add_argument("--timelapse", type=float, nargs="?", const=60, metavar="SPEED",
+                        help="also build a timelapse (60x by default) and a contact sheet per hour while recording")
+    parser.add_argument("--roi", help="part of the deck to watch: deck, a slot such as D2, or mag_block/heater_shaker; "
+                                      "motion detection, the timelapse and contact sheets use it, the recording stays full frame")
+    parser.add_argument("--crop-recording", action="store_true",
+                        help="crop the recorded frames to --roi too; decodes and re-encodes every frame "
+                             "(tens of ms of CPU per frame on the robot) instead of storing the camera's JPEG as-is")
+    parser.add_argument("--encode", action="store_true", help="re-encode to H.264 mp4 while recording")
+    parser.add_argument("--transcode", metavar="RECORDING", help="convert a passthrough recording (.avi or folder) to mp4 and exit")
+    return parser
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
 
-# Generate a filename with the current date and time
-timestamp = time.strftime("%Y%m%d_%H%M%S")  # e.g., "20250125_153045"
-output_file = f"/var/lib/jupyter/notebooks/{timestamp}.mp4"
+    if args.transcode:
+        print(f"Transcoded to {transcode(args.transcode)}")
+    else:
+        # Generate a filename with the current date and time
+        timestamp = time.strftime("%Y%m%d_%H%M%S")  # e.g., "20250125_153045"
+        suffix = "" if args.segment else ".mp4" if args.encode else ".avi"
+        output_file = args.output or f"/var/lib/jupyter/notebooks/{timestamp}{suffix}"
 
-# Record a 10-second video from <video2> (adjust device index as necessary)
-record_video(output_file, duration=2100, device_index="<video2>")
\ No newline at end of file
+        record_video(output_file, duration=args.duration, device_path="/dev/video2",
+                     fps=args.fps, passthrough=not args.encode, width=args.width, height=args.height,
+                     segment_seconds=args.segment or None, adaptive=args.adaptive,
+                     buffer_seconds=args.buffer_minutes and args.buffer_minutes * 60, quota=args.quota,
+                     timelapse_speed=args.timelapse, roi=args.roi, crop=args.crop_recording)
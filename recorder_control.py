@@ -0,0 +1,165 @@
+import functools
+import signal
+import subprocess
+import threading
+import time
+from pathlib import Path
+
+from recorder_service import RecorderServiceError, start_recording, stop_recording
+from recordings import write_info
+from step_index import track_comments
+
+# Protocol side of the recorder. The protocols used to start record_video.py
+# with a bare subprocess.Popen and terminate it on their last line, so a
+# protocol that raised (or was cancelled) left the recorder running for its
+# full, hard-coded duration next to the robot server. RecordingSupervisor
+# stops and finalizes the recording on every exit path, and sizes the
+# recorder's own time limit from the protocol's estimated run time, which only
+# matters if the protocol process itself dies.
+#
+# When recorder_service.py is running, the recording is started there (camera
+# already open, first frame in milliseconds) instead of in a new process.
+
+RECORD_SCRIPT = "/var/lib/jupyter/notebooks/record_video.py"
+RECORDINGS_DIR = "/var/lib/jupyter/notebooks"
+DURATION_MARGIN = 1.25      # allow runs this much longer than estimated
+DURATION_SLACK = 30 * 60    # plus this, for waiting on the operator or the plate reader
+STOP_TIMEOUT = 30           # seconds to let the recorder finalize before killing it
+FAILURE_TAIL = 5            # seconds of the deck to keep recording after a failure
+
+
+def max_duration(estimated_minutes: float) -> int:
+    """Recorder time limit, in seconds, for a protocol estimated to take estimated_minutes."""
+    return int(estimated_minutes * 60 * DURATION_MARGIN + DURATION_SLACK)
+
+
+class RecordingSupervisor:
+    """
+    Record the deck for the length of a protocol run.
+
+    Use as a context manager (or the @recorded decorator on run()): the
+    recorder is started on entry and stopped on exit, whether the protocol
+    finished, raised or was cancelled. On failure the error is marked in the
+    step index, and a recorder running with --buffer-minutes is asked to dump
+    its buffer first. Nothing is started while the protocol is being analysed
+    or simulated.
+
+    The recording is made by the resident recorder service if it is running,
+    otherwise by a record_video.py process started for the run.
+
+    Args:
+        protocol: The ProtocolContext passed to run().
+        estimated_minutes (float): Expected run time, used to size the recorder's time limit.
+        recording_dir (str): Folder for the recording. Defaults to a dated folder in the notebooks folder.
+        args (list): Extra record_video.py arguments, e.g. ["--adaptive"].
+        name (str): Protocol name for the recording library.
+    """
+
+    def __init__(self, protocol, estimated_minutes: float, recording_dir: str = None, args: list = (),
+                 name: str = None, script: str = RECORD_SCRIPT):
+        self.protocol = protocol
+        self.name = name
+        self.estimated_minutes = estimated_minutes
+        self.recording_dir = recording_dir or f"{RECORDINGS_DIR}/{time.strftime('%Y%m%d_%H%M%S')}"
+        self.args = list(args)
+        self.script = script
+        self.process = None
+        self.service = None  # recording name in the recorder service
+        self.steps = None
+
+    def start(self):
+        if self.protocol.is_simulating():
+            return self
+        started = time.time()
+        duration = max_duration(self.estimated_minutes)
+        write_info(self.recording_dir, protocol=self.name, estimated_minutes=self.estimated_minutes,
+                   started=started)
+        name = Path(self.recording_dir).name
+        try:
+            start_recording(name, duration, self.args, output=self.recording_dir, since=started)
+            self.service = name
+        except (OSError, RecorderServiceError) as e:
+            if not isinstance(e, (FileNotFoundError, ConnectionRefusedError)):
+                print(f"Recorder service failed ({e}), starting record_video.py")
+            command = [
+                "python3", self.script, "--output", self.recording_dir,
+                "--duration", str(duration), *self.args,
+            ]
+            self.process = subprocess.Popen(command)
+        # Index every protocol.comment against the video so each step can be found in the recording
+        self.steps = track_comments(self.protocol, self.recording_dir)
+        return self
+
+    def stop(self, error: BaseException = None):
+        """
+        Stop the recorder and wait for it to finalize the last segment.
+
+        After a failure the recorder keeps going for FAILURE_TAIL seconds, to
+        show the state of the deck the failure left behind, but the protocol
+        does not wait for that: the service is asked to stop later, or a
+        background thread stops the record_video.py process.
+
+        Args:
+            error (BaseException): What ended the run, if it did not finish normally.
+        """
+        process, self.process = self.process, None
+        service, self.service = self.service, None
+        if process is None and service is None:
+            return
+        tail = None
+        if error is not None:
+            self.steps.mark(f"Protocol failed: {type(error).__name__}: {error}")
+            tail = FAILURE_TAIL
+        buffering = error is not None and "--buffer-minutes" in self.args
+        if service is not None:
+            try:
+                stop_recording(service, after=tail, dump=buffering)
+            except (OSError, RecorderServiceError) as e:
+                print(f"Could not stop the recording in the recorder service: {e}")
+            return
+        if tail is None:
+            _stop_process(process, buffering)
+        else:
+            # not a daemon: the interpreter waits for it, so the recording is finalized even if the process exits
+            threading.Thread(target=_stop_process, args=(process, buffering, tail), name="recorder-stop").start()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop(exc)
+
+
+def _stop_process(process: subprocess.Popen, buffering: bool, after: float = 0):
+    """Stop a record_video.py process after seconds (dumping its buffer first) and wait for it to finalize."""
+    time.sleep(after)
+    if buffering and process.poll() is None:
+        process.send_signal(signal.SIGUSR1)
+    if process.poll() is None:
+        process.terminate()
+    try:
+        process.wait(STOP_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def recorded(estimated_minutes: float, args: list = ()):
+    """
+    Decorate a protocol's run() so the whole run is recorded by a RecordingSupervisor.
+
+    The recording is listed under the protocolName from the protocol's metadata.
+
+    Args:
+        estimated_minutes (float): Expected run time, used to size the recorder's time limit.
+        args (list): Extra record_video.py arguments, e.g. ["--adaptive"].
+    """
+    def decorate(run):
+        name = run.__globals__.get("metadata", {}).get("protocolName")
+
+        @functools.wraps(run)
+        def run_recorded(protocol):
+            with RecordingSupervisor(protocol, estimated_minutes, args=args, name=name):
+                return run(protocol)
+        return run_recorded
+    return decorate
@@ -0,0 +1,295 @@
+import argparse
+import json
+import signal
+import socket
+import socketserver
+import threading
+import time
+from pathlib import Path
+
+# Resident recorder: keeps the camera open and everything a recording needs
+# imported and warmed up, so a protocol can start a recording with one local
+# call instead of cold-starting record_video.py (imports, device probing,
+# format negotiation) while the first steps of the run go unrecorded.
+#
+# Requests are one JSON line on SERVICE_SOCKET, answered with one JSON line:
+#
+#     {"command": "start", "name": "20250412_101500", "duration": 7200, "args": ["--adaptive"], "since": 1744452900.1}
+#     {"command": "stop", "name": "20250412_101500"}
+#     {"command": "stop", "name": "20250412_101500", "after": 5, "dump": true}
+#     {"command": "dump", "name": "20250412_101500"}
+#     {"command": "status"}
+#
+# "args" are record_video.py options. "since" is when the caller asked: the
+# recording starts with the frames the camera ring still holds from that
+# moment, so not even the round trip is missing from the video. A stop with
+# "after" answers at once and stops the recording that many seconds later (a
+# failed protocol keeps a few seconds of the deck without waiting for them),
+# dumping the replay buffer first if "dump" is set. The client
+# functions below only use the standard library, so protocols can import this
+# module cheaply; RecordingSupervisor falls back to starting record_video.py
+# when the service is not running.
+#
+#     python3 recorder_service.py    # e.g. from a systemd unit, next to video_app.py
+
+SERVICE_SOCKET = "/tmp/flex_recorder_control.sock"
+REQUEST_TIMEOUT = 60  # stopping waits for the last segment to be finalized
+
+
+class RecorderServiceError(RuntimeError):
+    """The recorder service refused or failed a request."""
+
+
+def request(command: str, socket_path: str = SERVICE_SOCKET, timeout: float = REQUEST_TIMEOUT, **fields) -> dict:
+    """
+    Send one request to the recorder service.
+
+    Raises:
+        OSError: If the service is not running (FileNotFoundError, ConnectionRefusedError).
+        RecorderServiceError: If the service answered with an error.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        sock.sendall(json.dumps({"command": command, **fields}).encode() + b"\n")
+        reply = json.loads(sock.makefile("rb").readline() or b"{}")
+    if "error" in reply:
+        raise RecorderServiceError(reply["error"])
+    return reply
+
+
+def start_recording(name: str, duration: float, args=(), output: str = None, since: float = None, **kwargs) -> dict:
+    """Start a named recording; returns {"output": folder}."""
+    return request("start", name=name, duration=duration, args=list(args), output=output,
+                   since=time.time() if since is None else since, **kwargs)
+
+
+def stop_recording(name: str, after: float = None, dump: bool = False, **kwargs) -> dict:
+    """
+    Stop a named recording and wait until it is finalized; returns frames written and dropped.
+
+    Args:
+        name (str): Recording name.
+        after (float): Return at once and stop the recording this many seconds later instead.
+        dump (bool): Dump the replay buffer of a --buffer-minutes recording just before stopping.
+    """
+    return request("stop", name=name, after=after, dump=dump, **kwargs)
+
+
+def dump_recording(name: str, **kwargs) -> dict:
+    """Write the replay buffer of a --buffer-minutes recording to disk."""
+    return request("dump", name=name, **kwargs)
+
+
+class RecorderService:
+    """
+    The resident recorder: one open camera, any number of named recordings.
+
+    Args:
+        device_path (str): Camera device.
+        socket_path (str): Where to listen for requests.
+    """
+
+    def __init__(self, device_path: str = "/dev/video2", socket_path: str = SERVICE_SOCKET):
+        from camera import Camera
+        from metrics import LabeledRegistries, MetricsFile, add_process_metrics
+
+        self.device_path = device_path
+        self.socket_path = socket_path
+        self.camera = Camera(device_path)
+        self.recordings = {}  # name -> Recorder
+        self.metrics = LabeledRegistries("recording")  # every recording's metrics, in one file
+        add_process_metrics(self.metrics.shared, "flex_recorder")
+        self._metrics_file = MetricsFile(self.metrics)
+        self._lock = threading.Lock()
+        self._server = None
+
+    def start(self):
+        self.camera.start()
+        self._warm()
+        try:
+            request("status", self.socket_path, timeout=1)
+        except OSError:
+            pass
+        else:
+            raise RecorderServiceError(f"A recorder service is already listening on {self.socket_path}")
+        Path(self.socket_path).unlink(missing_ok=True)
+        service = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                try:
+                    reply = service.handle(json.loads(self.rfile.readline()))
+                except Exception as e:
+                    reply = {"error": f"{type(e).__name__}: {e}"}
+                self.wfile.write(json.dumps(reply).encode() + b"\n")
+
+        self._server = socketserver.ThreadingUnixStreamServer(self.socket_path, Handler)
+        self._server.daemon_threads = True
+        self._metrics_file.start()
+        print(f"Recorder service listening on {self.socket_path}")
+        return self
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def shutdown(self):
+        """Stop every recording (finalizing it), then the server and the camera."""
+        for name in list(self.recordings):
+            self.finish(name)
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            Path(self.socket_path).unlink(missing_ok=True)
+            self._metrics_file.stop()
+        self.camera.stop()
+
+    def _warm(self):
+        # import and exercise the JPEG path once, so the first recording pays for nothing
+        import frame_cache
+        import metrics
+        import motion
+        import record_video
+        import retention
+        import rois
+        import timelapse
+
+        frame = self.camera.ring.wait_next(self.camera.ring.next_seq - 1, timeout=10.0)
+        if frame is not None:
+            frame_cache.scale_jpeg(frame.data, 160)
+
+    def handle(self, message: dict) -> dict:
+        command = message.get("command")
+        if command == "start":
+            return self.begin(message["name"], message["duration"], message.get("args", ()),
+                              message.get("output"), message.get("since"))
+        if command == "stop":
+            if message.get("after"):
+                return self.finish_later(message["name"], message["after"], message.get("dump", False))
+            return self.finish(message["name"], message.get("dump", False))
+        if command == "dump":
+            recorder = self._recorder(message["name"])
+            directory = recorder.dump()
+            if directory is None:
+                raise ValueError(f"Recording {message['name']} is not buffering")
+            return {"dumping": directory}
+        if command == "status":
+            with self._lock:
+                return {"recordings": {name: {"output": recorder.output_file, "frames_written": recorder.frames_written}
+                                       for name, recorder in self.recordings.items()}}
+        raise ValueError(f"Unknown command {command!r}")
+
+    def _recorder(self, name: str):
+        with self._lock:
+            if name not in self.recordings:
+                raise LookupError(f"No recording named {name}")
+            return self.recordings[name]
+
+    def begin(self, name: str, duration: float, args=(), output: str = None, since: float = None) -> dict:
+        """Start a recording from the warm camera ring and return at once."""
+        from avi_writer import jpeg_size
+        from record_video import Recorder, build_parser
+        from retention import RECORDINGS_DIR, fit_to_disk
+        from rois import find_roi
+
+        if not name or Path(name).name != name:
+            raise ValueError(f"Bad recording name {name!r}")
+        try:
+            options = build_parser().parse_args(list(args))
+        except SystemExit:
+            raise ValueError(f"Bad recorder arguments: {' '.join(args)}")
+        if options.width or options.height:
+            raise ValueError("The service's camera is already open; --width and --height cannot change it")
+        output = output or options.output or f"{RECORDINGS_DIR}/{name}"
+        fps, scale_width = options.fps, None
+        latest = self.camera.ring.latest()
+        made_room = False
+        if not options.buffer_minutes and latest is not None:
+            frame = (len(latest.data), jpeg_size(latest.data)[0])
+            fps, scale_width, _ = fit_to_disk(output, duration, options.fps, *frame)
+            if fps < options.fps or scale_width:
+                # deleting old recordings may be all it takes: do it now rather than degrade this one
+                made_room = self._make_room(output, options.quota)
+                if made_room:
+                    fps, scale_width, _ = fit_to_disk(output, duration, options.fps, *frame)
+        with self._lock:
+            if name in self.recordings:
+                raise ValueError(f"Recording {name} is already running")
+            recorder = Recorder(output, self.camera.ring, fps=fps, passthrough=not options.encode,
+                                segment_seconds=options.segment or None, adaptive=options.adaptive,
+                                buffer_seconds=options.buffer_minutes and options.buffer_minutes * 60,
+                                scale_width=scale_width, timelapse_speed=options.timelapse,
+                                roi=options.roi and find_roi(options.roi), crop=options.crop_recording,
+                                since=since).start()
+            self.recordings[name] = recorder
+            self.metrics.add(name, recorder.metrics)
+        threading.Thread(target=self._limit, args=(name, recorder, duration), name=f"limit-{name}", daemon=True).start()
+        if not options.buffer_minutes and not made_room:
+            threading.Thread(target=self._make_room, args=(output, options.quota), daemon=True).start()
+        print(f"Recording {name} to {output}")
+        return {"output": output}
+
+    def finish(self, name: str, dump: bool = False) -> dict:
+        """Stop a recording (dumping its replay buffer first if dump is set) and wait for it to be finalized."""
+        with self._lock:
+            if name not in self.recordings:
+                raise LookupError(f"No recording named {name}")
+            recorder = self.recordings.pop(name)
+        if dump and recorder.dump() is None:
+            print(f"Recording {name} is not buffering, nothing to dump")
+        recorder.stop()
+        self.metrics.remove(name)
+        print(f"Recording {name} finished")
+        return {"output": recorder.output_file, "frames_written": recorder.frames_written,
+                "frames_dropped": recorder.drops.total}
+
+    def finish_later(self, name: str, after: float, dump: bool = False) -> dict:
+        """Stop a recording after seconds, without waiting."""
+        self._recorder(name)  # LookupError now rather than later
+        threading.Thread(target=self._finish_later, args=(name, after, dump), name=f"stop-{name}",
+                         daemon=True).start()
+        return {"stopping_in": after}
+
+    def _finish_later(self, name: str, after: float, dump: bool):
+        time.sleep(after)
+        try:
+            self.finish(name, dump)
+        except LookupError:
+            pass  # stopped meanwhile (time limit or shutdown)
+
+    def _limit(self, name: str, recorder, duration: float):
+        recorder.wait(duration)
+        try:
+            self.finish(name)
+        except LookupError:
+            pass  # stopped by request
+
+    def _make_room(self, output: str, quota: int) -> bool:
+        # normally after the recording has started, so deleting old recordings costs it nothing;
+        # returns whether the quota was enforced
+        from retention import RECORDINGS_DIR, enforce
+
+        parent = Path(output).resolve().parent
+        if quota is None or parent != Path(RECORDINGS_DIR).resolve():
+            return False
+        try:
+            enforce(parent, quota, keep=[output])
+        except OSError as e:
+            print(f"Could not enforce the recordings quota: {e}")
+            return False
+        return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Keep the flex camera open and record on request.")
+    parser.add_argument("--device", default="/dev/video2", help="camera device")
+    parser.add_argument("--socket", default=SERVICE_SOCKET, help="unix socket to listen on")
+    args = parser.parse_args()
+
+    service = RecorderService(args.device, args.socket).start()
+    # shutdown() must not run on the thread inside serve_forever()
+    signal.signal(signal.SIGTERM, lambda signum, stack: threading.Thread(target=service.shutdown).start())
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        service.shutdown()
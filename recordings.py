@@ -0,0 +1,179 @@
+import json
+import os
+import re
+import struct
+import time
+from pathlib import Path
+
+from segments import INDEX_FILE, load_index
+
+# The recording library: what is in the notebooks folder, for video_app.py.
+# Segmented recordings are folders with an index.jsonl (see segments.py) and
+# a recording.json written by the protocol's RecordingSupervisor; older
+# recordings are single .avi/.mp4 files. Durations come from the index or the
+# file headers, so listing never opens a video beyond its first few KB.
+#
+# The folder is also where users keep their own notebooks and videos, so
+# retention.py only ever deletes what the recorder wrote: the dated names it
+# gives its output (20250125_153045, .avi/.mp4 and _timelapse.avi), folders
+# with a recording.json marker, and the mp4 that replaced a compacted folder.
+
+RECORDING_INFO = "recording.json"
+VIDEO_SUFFIXES = {".avi": "video/x-msvideo", ".mp4": "video/mp4"}
+FILE_TYPES = {**VIDEO_SUFFIXES, ".jpg": "image/jpeg"}  # what /files serves: videos and contact sheets
+RECORDER_NAME = re.compile(r"\d{8}_\d{6}(_timelapse\.avi|\.avi|\.mp4)?")  # record_video.py's default names
+
+
+def write_info(directory: str, **info):
+    """Store what a recording is of (protocol name, estimate, ...) next to its segments."""
+    path = Path(directory)
+    path.mkdir(parents=True, exist_ok=True)
+    (path / RECORDING_INFO).write_text(json.dumps(info))
+
+
+def read_info(directory) -> dict:
+    try:
+        return json.loads((Path(directory) / RECORDING_INFO).read_text())
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def video_duration(path) -> float:
+    """Duration of an .avi or .mp4 file from its header, or None if it cannot be read."""
+    try:
+        with open(path, "rb") as f:
+            if Path(path).suffix == ".avi":
+                return _avi_duration(f)
+            return _mp4_duration(f)
+    except (OSError, struct.error):
+        return None
+
+
+def _avi_duration(f) -> float:
+    # RIFF/AVI/LIST/hdrl/avih: microseconds per frame, then total frames
+    f.seek(12)
+    if f.read(4) != b"LIST" or f.read(12)[4:] != b"hdrlavih":
+        return None
+    f.seek(32)
+    usec_per_frame, = struct.unpack("<I", f.read(4))
+    f.seek(48)
+    frames, = struct.unpack("<I", f.read(4))
+    return frames * usec_per_frame / 1e6
+
+
+def _mp4_duration(f) -> float:
+    # walk the top-level boxes to moov, then read mvhd's timescale and duration
+    end = os.fstat(f.fileno()).st_size
+    offset = 0
+    while offset + 8 <= end:
+        f.seek(offset)
+        size, kind = struct.unpack(">I4s", f.read(8))
+        header = 8
+        if size == 1:
+            size, = struct.unpack(">Q", f.read(8))
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if kind == b"moov":
+            return _mvhd_duration(f, offset + header, offset + size)
+        if size < header:
+            return None
+        offset += size
+    return None
+
+
+def _mvhd_duration(f, offset: int, end: int) -> float:
+    while offset + 8 <= end:
+        f.seek(offset)
+        size, kind = struct.unpack(">I4s", f.read(8))
+        if kind == b"mvhd":
+            version = f.read(4)[0]
+            if version == 1:
+                timescale, duration = struct.unpack(">16xIQ", f.read(28))
+            else:
+                timescale, duration = struct.unpack(">8xII", f.read(16))
+            return duration / timescale if timescale and duration else None
+        if size < 8:
+            return None
+        offset += size
+    return None
+
+
+def describe(path) -> dict:
+    """
+    Summary of one recording (folder or video file), or None if path is not a recording.
+
+    Returns:
+        dict: name, protocol, started, duration (seconds), size (bytes) and files
+            (paths relative to the recordings folder, in playing order).
+    """
+    path = Path(path)
+    if path.is_file():
+        if path.suffix not in VIDEO_SUFFIXES:
+            return None
+        stat = path.stat()
+        return {
+            "name": path.name, "protocol": None, "started": None,
+            "duration": _round(video_duration(path)), "size": stat.st_size, "files": [path.name],
+        }
+    if not (path / INDEX_FILE).exists() and not (path / RECORDING_INFO).exists():
+        return None
+    info = read_info(path)
+    entries = load_index(path)
+    size = 0
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_file():
+                size += entry.stat().st_size
+    recording = {
+        "name": path.name,
+        "protocol": info.get("protocol"),
+        "started": info.get("started") or (entries[0]["start"] if entries else None),
+        "duration": _round(sum(e["end"] - e["start"] for e in entries if e["end"] is not None)),
+        "size": size,
+        "files": [f"{path.name}/{e['file']}" for e in entries],
+    }
+    if (path / "timelapse.avi").exists():
+        recording["timelapse"] = f"{path.name}/timelapse.avi"
+    sheets = sorted(path.glob("contact_*.jpg"))
+    if sheets:
+        recording["contact_sheets"] = [f"{path.name}/{sheet.name}" for sheet in sheets]
+    transcoded = path.with_suffix(".mp4")
+    if transcoded.exists():
+        recording["transcoded"] = transcoded.name
+        if info.get("compacted"):
+            # the segments were replaced by the mp4 (see retention.compact)
+            duration = video_duration(transcoded)
+            recording["duration"] = _round(duration and duration * info.get("speed", 1))
+    return recording
+
+
+def written_by_recorder(path) -> bool:
+    """True if path is a recording the recorder wrote (and retention may delete), not a user's file."""
+    path = Path(path)
+    if RECORDER_NAME.fullmatch(path.name):
+        return True
+    if path.is_dir():
+        return (path / RECORDING_INFO).exists()
+    # <folder>.mp4 written by retention.compact
+    return path.suffix == ".mp4" and read_info(path.with_suffix("")).get("compacted") == path.name
+
+
+def list_recordings(directory) -> list:
+    """All recordings in a folder, newest first."""
+    recordings = []
+    with os.scandir(directory) as it:
+        for entry in it:
+            recording = describe(entry.path)
+            if recording is None:
+                continue
+            if recording["started"] is None:
+                recording["started"] = entry.stat().st_mtime - (recording["duration"] or 0)
+            recording["started_at"] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(recording["started"]))
+            recordings.append(recording)
+    recordings.sort(key=lambda recording: recording["started"], reverse=True)
+    return recordings
+
+
+def _round(seconds: float) -> float:
+    return None if seconds is None else round(seconds, 3)
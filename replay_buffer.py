@@ -0,0 +1,111 @@
+import os
+import signal
+import threading
+import time
+from collections import deque
+from pathlib import Path
+
+from segments import SegmentedWriter
+
+# "Black box" recording. Most runs succeed and nobody ever watches them, so in
+# this mode the recorder keeps only the last few minutes of the camera's
+# compressed JPEG frames in memory, bounded by both time and bytes, and
+# writes nothing to disk. When something goes wrong (protocol error, SIGUSR1,
+# POST /recorder/dump on the video app) the buffer is written out as a normal
+# segmented recording.
+
+BUFFER_SECONDS = 600
+BUFFER_BYTES = 256 * 2**20
+PID_FILE = "/tmp/flex_recorder.pid"
+
+
+class ReplayBuffer:
+    """
+    Memory-bounded buffer of the most recent recorded frames.
+
+    Has the same write()/close() interface as SegmentedWriter so the recorder
+    can use either as its sink.
+
+    Args:
+        seconds (float): Keep at most this much of the recording.
+        max_bytes (int): Keep at most this many bytes of JPEG data.
+    """
+
+    def __init__(self, seconds: float = BUFFER_SECONDS, max_bytes: int = BUFFER_BYTES):
+        self.seconds = seconds
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._frames = deque()
+        self._lock = threading.Lock()
+
+    def write(self, slot: int, frame) -> bool:
+        with self._lock:
+            self._frames.append((slot, frame))
+            self.bytes += len(frame.data)
+            oldest = frame.timestamp - self.seconds
+            while self._frames and (self.bytes > self.max_bytes or self._frames[0][1].timestamp < oldest):
+                self.bytes -= len(self._frames.popleft()[1].data)
+        return True
+
+    def close(self):
+        """Nothing to flush: a run that ends normally leaves no trace on disk."""
+
+    def dump(self, directory: str, fps: float, passthrough: bool = True) -> threading.Thread:
+        """
+        Write the buffered frames out as a segmented recording.
+
+        The buffer is snapshotted immediately and written on a background thread,
+        so recording carries on while the dump goes to disk.
+
+        Returns:
+            threading.Thread: The writer thread (join it to wait for the dump).
+        """
+        with self._lock:
+            frames = list(self._frames)
+        print(f"Dumping the last {len(frames)} frames to {directory}")
+
+        def write():
+            writer = SegmentedWriter(directory, fps, passthrough)
+            try:
+                for slot, frame in frames:
+                    writer.write(slot, frame)
+            finally:
+                writer.close()
+
+        thread = threading.Thread(target=write, name="replay-dump")
+        thread.start()
+        return thread
+
+
+def write_pid_file(path: str = PID_FILE):
+    Path(path).write_text(str(os.getpid()))
+
+
+def remove_pid_file(path: str = PID_FILE):
+    try:
+        if Path(path).read_text() == str(os.getpid()):
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def request_dump(pid: int = None, path: str = PID_FILE):
+    """
+    Ask a running recorder to write out its replay buffer.
+
+    Args:
+        pid (int): Recorder process, e.g. video_process.pid. Defaults to the one in the pid file.
+
+    Raises:
+        ProcessLookupError: If no recorder is running.
+    """
+    if pid is None:
+        try:
+            pid = int(Path(path).read_text())
+        except (FileNotFoundError, ValueError):
+            raise ProcessLookupError("No recorder is running")
+    os.kill(pid, signal.SIGUSR1)
+
+
+def dump_name() -> str:
+    return time.strftime("dump_%Y%m%d_%H%M%S")
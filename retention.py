@@ -0,0 +1,271 @@
+import argparse
+import json
+import math
+import os
+import shutil
+import subprocess
+import threading
+import time
+from pathlib import Path
+
+from recordings import describe, read_info, write_info, written_by_recorder
+from segments import INDEX_FILE, load_index
+
+# Keep the recordings from filling the robot's storage.
+#
+# enforce() deletes recordings older than the age limit, then the least
+# recently used ones (last written or downloaded, see touch()) until the
+# folder is under its byte quota. A recording still being written is never
+# touched, and neither is anything the recorder did not write (see
+# recordings.written_by_recorder): users keep their own videos here too. compact() is the optional low-priority pass: it transcodes old
+# passthrough recordings to H.264 (or a timelapse), usually a tenth of the
+# size or less, and drops the original segments. fit_to_disk() is what the
+# recorder calls before starting: it picks a frame rate and, if it has to, a
+# smaller frame width that fit in the free space, instead of failing.
+
+RECORDINGS_DIR = "/var/lib/jupyter/notebooks"
+QUOTA_BYTES = 20 * 2**30
+MAX_AGE_DAYS = 60
+RESERVE_BYTES = 2 * 2**30   # always leave this free for the robot itself
+ACTIVE_SECONDS = 10 * 60    # a recording written to this recently may still be running
+MIN_FPS = 0.5
+USED_FILE = ".recordings_used.json"  # last download of each recording (atime is not reliable)
+WIDTHS = (1280, 960, 640, 480, 320, 160)
+
+
+def _load_used(directory) -> dict:
+    try:
+        return json.loads((Path(directory) / USED_FILE).read_text())
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def touch(path):
+    """Mark a recording as just used (downloaded), so it is evicted last."""
+    path = Path(path)
+    used = _load_used(path.parent)
+    used[path.name] = time.time()
+    (path.parent / USED_FILE).write_text(json.dumps(used))
+
+
+def _recordings(directory) -> list:
+    """(path, size, last written or downloaded, still active) for every recorder-written recording in directory."""
+    found = []
+    now = time.time()
+    used = _load_used(directory)
+    with os.scandir(directory) as it:
+        for entry in it:
+            if not written_by_recorder(entry.path):
+                continue
+            recording = describe(entry.path)
+            if recording is None:
+                continue
+            written = _last_written(entry.path)
+            active = now - written < ACTIVE_SECONDS
+            found.append((Path(entry.path), recording["size"], max(written, used.get(entry.name, 0)), active))
+    return found
+
+
+def _last_written(path) -> float:
+    if not os.path.isdir(path):
+        return os.stat(path).st_mtime
+    with os.scandir(path) as it:
+        return max((e.stat().st_mtime for e in it if e.is_file()), default=os.stat(path).st_mtime)
+
+
+def remove(path: Path):
+    if path.is_dir():
+        shutil.rmtree(path)
+    else:
+        path.unlink()
+
+
+def enforce(directory: str = RECORDINGS_DIR, quota: int = QUOTA_BYTES, max_age_days: float = MAX_AGE_DAYS,
+            keep=()) -> list:
+    """
+    Delete old recordings until the folder is within its quota.
+
+    Args:
+        directory (str): Recordings folder.
+        quota (int): Bytes the recordings may take in total.
+        max_age_days (float): Delete recordings not used for this long, or None for no limit.
+        keep: Paths never to delete (e.g. the recording about to start).
+
+    Returns:
+        list: Paths of the deleted recordings.
+    """
+    keep = {Path(p).resolve() for p in keep}
+    recordings = sorted(_recordings(directory), key=lambda r: r[2])
+    total = sum(size for _, size, _, _ in recordings)
+    cutoff = time.time() - max_age_days * 86400 if max_age_days else None
+    removed = []
+    for path, size, used, active in recordings:
+        if active or path.resolve() in keep:
+            continue
+        if total <= quota and (cutoff is None or used >= cutoff):
+            continue
+        print(f"Deleting recording {path.name} ({size / 2**20:.0f} MB, last used {time.ctime(used)})")
+        remove(path)
+        total -= size
+        removed.append(path)
+    used = _load_used(directory)
+    if any(path.name in used for path in removed):
+        for path in removed:
+            used.pop(path.name, None)
+        (Path(directory) / USED_FILE).write_text(json.dumps(used))
+    return removed
+
+
+def compact(directory: str = RECORDINGS_DIR, older_than_days: float = 7, speed: float = 1) -> list:
+    """
+    Transcode passthrough recordings not used for a while to H.264 and drop their segments.
+
+    The step index and recording info stay in the folder; the video becomes
+    <folder>.mp4 next to it. ffmpeg runs at the lowest CPU priority. A
+    recording ffmpeg cannot transcode (a corrupt or truncated segment) keeps
+    its segments and is marked compact_failed in its info, so it is not
+    retried on every pass.
+
+    Args:
+        directory (str): Recordings folder.
+        older_than_days (float): Only compact recordings not used for this long.
+        speed (float): 1 to keep real time, 60 for a one-second-per-minute timelapse.
+
+    Returns:
+        list: Paths of the mp4 files written.
+    """
+    from record_video import transcode
+
+    cutoff = time.time() - older_than_days * 86400
+    written = []
+    for path, _, used, active in sorted(_recordings(directory), key=lambda r: r[2]):
+        if active or used >= cutoff or not path.is_dir():
+            continue
+        info = read_info(path)
+        if info.get("compacted") or info.get("compact_failed"):
+            continue
+        segments = [path / e["file"] for e in load_index(path)]
+        if not segments or any(s.suffix != ".avi" for s in segments):
+            continue
+        try:
+            output = transcode(str(path), speed=speed)
+        except (subprocess.CalledProcessError, OSError) as e:
+            print(f"Could not compact {path.name}: {e}")
+            path.with_suffix(".mp4").unlink(missing_ok=True)  # partial output
+            write_info(path, **info, compact_failed=time.time())
+            continue
+        for segment in segments:
+            segment.unlink(missing_ok=True)
+        (path / INDEX_FILE).unlink(missing_ok=True)
+        (path / "concat.txt").unlink(missing_ok=True)
+        write_info(path, **read_info(path), compacted=Path(output).name, speed=speed)
+        print(f"Compacted {path.name} to {Path(output).name}")
+        written.append(Path(output))
+    return written
+
+
+def fit_to_disk(directory: str, duration: float, fps: float, frame_bytes: int, width: int,
+                reserve: int = RESERVE_BYTES) -> tuple:
+    """
+    Choose a frame rate and width for a recording that fits in the free space.
+
+    The frame rate is lowered first (down to MIN_FPS), then the frames are
+    scaled to a smaller width. If even that does not fit the recording still
+    goes ahead at the smallest setting; it just will not cover the whole run.
+
+    Args:
+        directory (str): Where the recording goes (or its parent if it does not exist yet).
+        duration (float): Seconds to record.
+        fps (float): Requested frame rate.
+        frame_bytes (int): Size of a camera frame (JPEG bytes), e.g. from the first frame.
+        width (int): Width of the camera frames.
+
+    Returns:
+        tuple: (fps, width to scale frames to or None for no scaling, free bytes).
+    """
+    path = Path(directory)
+    while not path.exists():
+        path = path.parent
+    free = shutil.disk_usage(path).free - reserve
+    per_second = max(free, 0) / max(duration, 1)
+    if fps * frame_bytes <= per_second:
+        return fps, None, free
+    rate = per_second / frame_bytes
+    if rate >= MIN_FPS:
+        return rate, None, free
+    # JPEG size goes roughly with the pixel count
+    scale = math.sqrt(per_second / (MIN_FPS * frame_bytes))
+    smaller = [w for w in WIDTHS if w <= width * scale]
+    return MIN_FPS, smaller[0] if smaller else WIDTHS[-1], free
+
+
+class RetentionManager:
+    """
+    Background thread that enforces the quota (and optionally compacts) every interval.
+
+    Args:
+        directory (str): Recordings folder.
+        quota (int): Bytes the recordings may take in total.
+        max_age_days (float): Delete recordings not used for this long.
+        compact_after_days (float): Compact recordings not used for this long, or None to never compact.
+        interval (float): Seconds between passes.
+    """
+
+    def __init__(self, directory: str = RECORDINGS_DIR, quota: int = QUOTA_BYTES,
+                 max_age_days: float = MAX_AGE_DAYS, compact_after_days: float = None,
+                 interval: float = 3600):
+        self.directory = directory
+        self.quota = quota
+        self.max_age_days = max_age_days
+        self.compact_after_days = compact_after_days
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="retention", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        if hasattr(os, "setpriority"):
+            # nice only this thread (Linux threads have their own priority)
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        while not self._stop.is_set():
+            # a failed compaction must not stop the quota from being enforced
+            if self.compact_after_days is not None:
+                try:
+                    compact(self.directory, self.compact_after_days)
+                except Exception as e:
+                    print(f"Compaction pass failed: {e}")
+            try:
+                enforce(self.directory, self.quota, self.max_age_days)
+            except OSError as e:
+                print(f"Retention pass failed: {e}")
+            self._stop.wait(self.interval)
+
+
+def parse_size(text: str) -> int:
+    """Parse a size like 500M or 20G into bytes."""
+    units = {"K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+    text = text.strip().upper().rstrip("B")
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Delete or compact old flex recordings.")
+    parser.add_argument("--directory", default=RECORDINGS_DIR, help="recordings folder")
+    parser.add_argument("--quota", type=parse_size, default=QUOTA_BYTES, help="total size allowed, e.g. 20G")
+    parser.add_argument("--max-age", type=float, default=MAX_AGE_DAYS, help="delete recordings unused for this many days")
+    parser.add_argument("--compact", type=float, metavar="DAYS", help="transcode recordings unused for this many days")
+    parser.add_argument("--speed", type=float, default=1, help="timelapse factor for --compact, e.g. 60")
+    args = parser.parse_args()
+
+    if args.compact is not None:
+        compact(args.directory, args.compact, args.speed)
+    enforce(args.directory, args.quota, args.max_age)
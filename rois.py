@@ -0,0 +1,105 @@
+import io
+import json
+from pathlib import Path
+
+from PIL import Image
+
+# Named regions of the camera frame: the deck, and each deck slot, so a
+# stream or a recording can carry only the pixels that matter (the mag block
+# in D2, the heater-shaker in D1) instead of the enclosure and the ceiling.
+#
+# Regions are fractions of the frame (left, top, right, bottom), so they hold
+# at any capture resolution. The slots are a 4 x 3 grid over DECK with row A
+# at the top and column 1 on the left; both are rough, so measure them on a
+# /snapshot and put the corrected boxes in ROI_FILE, e.g.
+#
+#     {"deck": [0.12, 0.08, 0.9, 0.97], "D2": [0.4, 0.75, 0.62, 0.97]}
+#
+# The camera delivers JPEG, so a crop cannot be a view of the frame: it is
+# one decode and an encode of just the region. Every consumer after that
+# (encoder, disk, socket) only handles the region's pixels.
+
+ROI_FILE = "/var/lib/jupyter/notebooks/rois.json"
+DECK = (0.05, 0.05, 0.95, 0.98)
+ROWS = "ABCD"
+COLUMNS = "123"
+ALIASES = {"heater_shaker": "D1", "mag_block": "D2", "temp_module": "C1"}
+QUALITY = 85
+_BLOCK = 16  # JPEG MCU size; boxes are aligned to it so crops re-encode cleanly
+
+
+def slot_box(slot: str, deck: tuple = DECK) -> tuple:
+    """Fractional box of a deck slot such as "D2", from the deck box."""
+    row, column = ROWS.index(slot[0]), COLUMNS.index(slot[1])
+    left, top, right, bottom = deck
+    width, height = (right - left) / len(COLUMNS), (bottom - top) / len(ROWS)
+    return (left + column * width, top + row * height, left + (column + 1) * width, top + (row + 1) * height)
+
+
+def load_rois(path: str = ROI_FILE) -> dict:
+    """
+    All named regions: "deck", every slot and the module aliases, with any overrides from path.
+
+    Returns:
+        dict: name -> (left, top, right, bottom) as fractions of the frame.
+    """
+    try:
+        overrides = {name: tuple(box) for name, box in json.loads(Path(path).read_text()).items()}
+    except FileNotFoundError:
+        overrides = {}
+    deck = overrides.get("deck", DECK)
+    rois = {"deck": deck}
+    for row in ROWS:
+        for column in COLUMNS:
+            rois[row + column] = slot_box(row + column, deck)
+    rois.update(overrides)
+    for alias, slot in ALIASES.items():
+        rois.setdefault(alias, rois[slot])
+    return rois
+
+
+def find_roi(name: str, path: str = ROI_FILE) -> tuple:
+    """
+    Fractional box of a named region.
+
+    Raises:
+        ValueError: If there is no region by that name.
+    """
+    rois = load_rois(path)
+    if name not in rois:
+        raise ValueError(f"Region must be one of {', '.join(rois)}")
+    return rois[name]
+
+
+def pixel_box(roi: tuple, width: int, height: int) -> tuple:
+    """Pixel box of a fractional region in a width x height frame, aligned to JPEG blocks."""
+    left, top, right, bottom = roi
+    x0, y0 = int(left * width) // _BLOCK * _BLOCK, int(top * height) // _BLOCK * _BLOCK
+    x1 = min(-(-int(right * width) // _BLOCK) * _BLOCK, width)
+    y1 = min(-(-int(bottom * height) // _BLOCK) * _BLOCK, height)
+    return x0, y0, max(x1, x0 + 1), max(y1, y0 + 1)
+
+
+def crop_jpeg(data: bytes, roi: tuple, width: int = None, quality: int = QUALITY) -> bytes:
+    """
+    Crop a JPEG frame to a region and optionally scale it down to width.
+
+    Args:
+        data (bytes): JPEG frame.
+        roi (tuple): (left, top, right, bottom) as fractions of the frame.
+        width (int): Scale the region down to this width, or None to keep its pixels.
+        quality (int): JPEG quality of the result.
+    """
+    image = Image.open(io.BytesIO(data))
+    box = pixel_box(roi, image.width, image.height)
+    if width is not None and box[2] - box[0] > width:
+        # decode at a reduced scale when the region will be scaled down anyway
+        scale = (box[2] - box[0]) / width
+        image.draft("RGB", (int(image.width / scale), int(image.height / scale)))
+        box = pixel_box(roi, image.width, image.height)
+    image = image.convert("RGB").crop(box)
+    if width is not None and image.width > width:
+        image = image.resize((width, max(round(image.height * width / image.width), 1)), Image.BILINEAR)
+    out = io.BytesIO()
+    image.save(out, "JPEG", quality=quality)
+    return out.getvalue()
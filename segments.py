@@ -0,0 +1,230 @@
+import bisect
+import json
+import os
+from pathlib import Path
+
+from avi_writer import MjpegAviWriter
+from step_index import StepIndexer
+
+# Rolling, crash-safe recording. Instead of one file for the whole run, the
+# recorder writes fixed-length segments into a directory, closing (and so
+# finalizing) each one before starting the next. When a segment is closed a
+# line is appended to index.jsonl mapping its wall-clock span to the file, so
+# a crash or kill loses at most the segment being written and any moment of
+# the run can be found without opening a multi-GB file.
+
+INDEX_FILE = "index.jsonl"
+SEGMENT_SECONDS = 60
+
+
+class Segment:
+    """
+    One independently playable file of a recording.
+
+    Args:
+        path (Path): File to write (.avi for passthrough, .mp4 otherwise).
+        fps (float): Output frame rate.
+        passthrough (bool): Store JPEG frames as-is instead of decoding and re-encoding them.
+    """
+
+    def __init__(self, path: Path, fps: float, passthrough: bool = True):
+        self.path = Path(path)
+        self.fps = fps
+        self.passthrough = passthrough
+        self.frames = 0
+        self.start = None
+        self.end = None
+        self.last_index = None
+        self._first_slot = None
+        self._next_slot = 0
+        self._image = None
+        if passthrough:
+            self._writer = MjpegAviWriter(str(self.path), fps)
+        else:
+            import imageio.v2 as iid
+            self._writer = iid.get_writer(str(self.path), fps=fps)
+
+    @property
+    def full(self) -> bool:
+        return self.passthrough and self._writer.full
+
+    def write(self, slot: int, frame) -> bool:
+        """
+        Write a frame at its slot on the recording's fps timeline.
+
+        Returns:
+            bool: False if the frame was skipped because its slot was already filled.
+        """
+        if self._first_slot is None:
+            self._first_slot = slot
+            self.start = frame.timestamp
+        index = slot - self._first_slot
+        if self.passthrough:
+            written = self._writer.write(frame.data, index=index)
+        else:
+            written = self._append_decoded(index, frame)
+        if written:
+            self.frames += 1
+            self.end = self.start + (index + 1) / self.fps
+            self.last_index = index
+        return written
+
+    @property
+    def last_byte_offset(self) -> int:
+        """File offset of the last frame written, or None for re-encoded segments."""
+        return self._writer.last_offset if self.passthrough else None
+
+    def _append_decoded(self, index: int, frame) -> bool:
+        import imageio.v3 as iio
+
+        if index < self._next_slot:
+            return False
+        # hold the previous frame over any gap so the timeline stays real time
+        while self._image is not None and self._next_slot < index:
+            self._writer.append_data(self._image)
+            self._next_slot += 1
+        # Decode the camera's JPEG and re-encode it into the video file
+        self._image = iio.imread(frame.data, extension=".jpg")
+        self._writer.append_data(self._image)
+        self._next_slot = index + 1
+        return True
+
+    def close(self) -> dict:
+        """Finalize the file and return its index entry."""
+        self._writer.close()
+        return {
+            "file": self.path.name,
+            "start": self.start,
+            "end": self.end,
+            "frames": self.frames,
+            "bytes": self.path.stat().st_size if self.path.exists() else 0,
+        }
+
+
+class SegmentedWriter:
+    """
+    Write a recording as a directory of fixed-length segments plus index.jsonl.
+
+    With segment_seconds=None the recording goes to a single file instead
+    (continued in _partN files if an AVI reaches its size limit), without an index.
+
+    Protocol step markers dropped into the folder are resolved against the
+    frames as they are written (see step_index.py).
+
+    Args:
+        output (str): Directory for the segments and the index (created if missing),
+            or the output file when segment_seconds is None.
+        fps (float): Output frame rate.
+        passthrough (bool): Store JPEG frames as-is instead of decoding and re-encoding them.
+        segment_seconds (float): Length of each segment, or None for a single file.
+    """
+
+    def __init__(self, output: str, fps: float, passthrough: bool = True,
+                 segment_seconds: float = SEGMENT_SECONDS):
+        self.output = Path(output)
+        self.fps = fps
+        self.passthrough = passthrough
+        self.segment_seconds = segment_seconds
+        self.segments = 0
+        self._segment = None
+        self._steps = None
+        if segment_seconds:
+            self.output.mkdir(parents=True, exist_ok=True)
+            self._steps = StepIndexer(self.output)
+
+    def write(self, slot: int, frame) -> bool:
+        segment = self._segment
+        if segment is not None and (segment.full or (
+                self.segment_seconds and frame.timestamp - segment.start >= self.segment_seconds)):
+            self._roll()
+        if self._segment is None:
+            self._segment = Segment(self._next_path(), self.fps, self.passthrough)
+            self.segments += 1
+        segment = self._segment
+        written = segment.write(slot, frame)
+        if written and self._steps is not None:
+            self._steps.frame_written(frame.timestamp, segment.path.name, segment.last_index,
+                                      segment.last_index / self.fps, segment.last_byte_offset)
+        return written
+
+    def close(self):
+        if self._segment is not None:
+            self._roll()
+
+    def _next_path(self) -> Path:
+        if self.segment_seconds:
+            suffix = ".avi" if self.passthrough else ".mp4"
+            return self.output / f"seg_{self.segments:05d}{suffix}"
+        if self.segments == 0:
+            return self.output
+        return self.output.with_name(f"{self.output.stem}_part{self.segments}{self.output.suffix}")
+
+    def _roll(self):
+        entry = self._segment.close()
+        self._segment = None
+        if self.segment_seconds and entry["frames"]:
+            append_index(self.output, entry)
+
+
+def append_index(directory, entry: dict):
+    """Append one finished segment to the index and make sure it reaches the disk."""
+    with open(Path(directory) / INDEX_FILE, "a") as f:
+        f.write(json.dumps(entry) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def load_index(directory) -> list:
+    """Read the index of a segmented recording, ignoring a torn last line from a crash."""
+    entries = []
+    path = Path(directory) / INDEX_FILE
+    if not path.exists():
+        return entries
+    with open(path) as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except json.JSONDecodeError:
+                break
+    return entries
+
+
+def find(directory, when: float, entries: list = None) -> tuple:
+    """
+    Find the segment holding a wall-clock moment of the recording.
+
+    Args:
+        directory (str): Segmented recording directory.
+        when (float): Wall-clock time (seconds since the epoch).
+        entries (list): Already loaded index, to avoid re-reading it.
+
+    Returns:
+        tuple: (segment path, offset in seconds into that segment).
+
+    Raises:
+        LookupError: If the recording does not cover that moment.
+    """
+    entries = load_index(directory) if entries is None else entries
+    i = bisect.bisect_right([e["start"] for e in entries], when) - 1
+    if i < 0 or when > entries[i]["end"]:
+        raise LookupError(f"Recording in {directory} does not cover {when}")
+    return Path(directory) / entries[i]["file"], when - entries[i]["start"]
+
+
+def window(directory, start: float, end: float) -> list:
+    """
+    List the segments needed to play back a wall-clock window.
+
+    Returns:
+        list: (segment path, start offset, end offset) for every segment overlapping the window.
+    """
+    parts = []
+    for e in load_index(directory):
+        if e["end"] <= start or e["start"] >= end:
+            continue
+        parts.append((
+            Path(directory) / e["file"],
+            max(start - e["start"], 0.0),
+            min(end, e["end"]) - e["start"],
+        ))
+    return parts
@@ -0,0 +1,300 @@
+import argparse
+from dataclasses import dataclass
+
+import numpy as np
+
+from plate_analysis import STANDARD_CONCENTRATIONS, replicate_stats
+
+# Standard curves for the BCA protocols: linear, quadratic and four-parameter
+# logistic (4PL) fits of the BSA standards, numpy only.
+#
+# BCA absorbance bends over towards the 10 mg/mL standard, so one straight
+# line misreads the samples near either end. Every model is fitted and the one
+# with the smallest residual standard error (residuals per degree of freedom,
+# so extra parameters have to earn their keep) is used, a more complex model
+# only when it beats the simpler one by SELECT_MARGIN.
+#
+# Everything works on stacks of plates: absorbances of shape (..., 8) give
+# parameters of shape (..., n_params), so a whole archive of plates is fitted
+# with a handful of batched solves. The linear and quadratic models are
+# weighted least squares (normal equations); 4PL is Levenberg-Marquardt with a
+# fixed number of iterations, run for all plates at once.
+#
+# Optionally residuals are weighted by 1/y^2 (relative error, for when the
+# low standards matter most), and one standard per plate can be left out of
+# all fits: the one whose removal tightens the most flexible model's fit the
+# most, if that cuts its residual standard error REJECT_RATIO-fold and the
+# curve fitted without it misses it by more than REJECT_ABSOLUTE (a bad well
+# or a pipetting error).
+#
+#     python3 standard_curve.py /var/lib/jupyter/notebooks/TWH/*.xlsx
+
+MODELS = ("linear", "quadratic", "4pl")
+N_PARAMS = {"linear": 2, "quadratic": 3, "4pl": 4}
+WEIGHTINGS = (None, "1/y^2")
+SELECT_MARGIN = 0.9  # a more complex model must cut the residual standard error by 10%
+REJECT_RATIO = 3.0  # leaving the standard out must cut the residual standard error threefold
+REJECT_ABSOLUTE = 0.03  # absorbance units; never reject a standard missed by less
+MIN_R_SQUARED = 0.98
+LM_ITERATIONS = 100
+
+
+@dataclass
+class CurveFit:
+    """
+    Every model fitted to one plate's standards or a stack of plates.
+
+    Arrays have the plates' leading shape (empty for a single plate), then
+    one entry per model in models order.
+    """
+
+    standards: np.ndarray    # (n,) concentrations, mg/mL
+    models: tuple
+    params: dict             # model -> (..., n_params)
+    residual_se: np.ndarray  # (..., n_models), in (weighted) absorbance units
+    r_squared: np.ndarray    # (..., n_models)
+    rejected: np.ndarray     # (..., n) standards left out of every fit
+    best: np.ndarray         # (...) index of the chosen model
+
+    @property
+    def model(self):
+        """Name of the chosen model (an array of names for a stack of plates)."""
+        names = np.asarray(self.models)[self.best]
+        return str(names) if names.ndim == 0 else names
+
+    @property
+    def fit_r_squared(self) -> np.ndarray:
+        return np.take_along_axis(self.r_squared, self.best[..., None], axis=-1)[..., 0]
+
+    def concentration(self, absorbance) -> np.ndarray:
+        """
+        Concentrations (mg/mL) read off each plate's chosen curve.
+
+        Args:
+            absorbance: (..., k) absorbances with the plates' leading shape, or (k,) for one plate.
+
+        Returns:
+            ndarray: Same shape; NaN where the absorbance is beyond what the curve can reach.
+        """
+        absorbance = np.asarray(absorbance, dtype=float)
+        by_model = np.stack([invert(model, self.params[model], absorbance) for model in self.models])
+        index = np.broadcast_to(self.best[..., None], absorbance.shape)[None]
+        return np.take_along_axis(by_model, index, axis=0)[0]
+
+    def extrapolated(self, concentration) -> np.ndarray:
+        """Mask of concentrations outside the range of the standards, or off the curve (NaN)."""
+        concentration = np.asarray(concentration, dtype=float)
+        return ~((concentration >= self.standards.min()) & (concentration <= self.standards.max()))
+
+    def summary(self) -> str:
+        """One line about a single plate's curve, e.g. for protocol.comment."""
+        line = f"Standard curve: {self.model}, R² {float(self.fit_r_squared):.4f}"
+        left_out = self.standards[self.rejected]
+        if left_out.size:
+            line += f", left out the {', '.join(f'{c:g}' for c in left_out)} mg/mL standard"
+        if not self.fit_r_squared >= MIN_R_SQUARED:
+            line += f" - below {MIN_R_SQUARED}, check the standards"
+        return line
+
+
+def predict(model: str, params, concentration) -> np.ndarray:
+    """Absorbance of each curve at concentration; params (..., n_params), concentration broadcasts as (..., k)."""
+    params = np.asarray(params, dtype=float)
+    x = np.asarray(concentration, dtype=float)
+    if model == "4pl":
+        return _logistic(params, x)[0]
+    return (params[..., None, :] * x[..., None] ** np.arange(params.shape[-1])).sum(axis=-1)
+
+
+def invert(model: str, params, absorbance) -> np.ndarray:
+    """Concentration of each curve at absorbance (..., k); NaN where the curve does not reach it."""
+    params = np.asarray(params, dtype=float)[..., None, :]
+    y = np.asarray(absorbance, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        if model == "linear":
+            return (y - params[..., 0]) / params[..., 1]
+        if model == "quadratic":
+            b0, b1, b2 = params[..., 0], params[..., 1], params[..., 2]
+            # the root on the rising side of the parabola, in a form that stays exact as b2 -> 0
+            root = np.sqrt(b1 ** 2 - 4 * b2 * (b0 - y))
+            return 2 * (y - b0) / (b1 + root)
+        if model == "4pl":
+            a, d, c, b = params[..., 0], params[..., 1], np.exp(params[..., 2]), np.exp(np.clip(params[..., 3], -5, 5))
+            ratio = (a - d) / (y - d) - 1
+            return np.where(ratio >= 0, c * np.abs(ratio) ** (1 / b), np.nan)
+    raise ValueError(f"Model must be one of {', '.join(MODELS)}")
+
+
+def fit_model(model: str, concentration, absorbance, weights=None) -> np.ndarray:
+    """
+    Weighted least-squares fit of one model to every plate's standards.
+
+    Args:
+        model (str): "linear", "quadratic" or "4pl".
+        concentration: (n,) standard concentrations.
+        absorbance: (..., n) absorbances of the standards.
+        weights: (..., n) weights; 0 leaves a standard out. Defaults to 1.
+
+    Returns:
+        ndarray: (..., n_params). Polynomials are b0, b1[, b2]; 4PL is a (response at 0),
+            d (response at infinity), log c (midpoint) and log b (slope).
+    """
+    x = np.asarray(concentration, dtype=float)
+    y = np.asarray(absorbance, dtype=float)
+    w = np.ones_like(y) if weights is None else np.broadcast_to(np.asarray(weights, dtype=float), y.shape)
+    if model == "4pl":
+        return _fit_logistic(x, y, w)
+    if model not in N_PARAMS:
+        raise ValueError(f"Model must be one of {', '.join(MODELS)}")
+    design = x[:, None] ** np.arange(N_PARAMS[model])  # (n, p)
+    normal = np.einsum("...n,np,nq->...pq", w, design, design)
+    moment = np.einsum("...n,np,...n->...p", w, design, y)
+    return np.linalg.solve(normal + 1e-12 * np.eye(len(design[0])), moment[..., None])[..., 0]
+
+
+def _logistic(params, x):
+    """4PL response and its Jacobian with respect to (a, d, log c, log b)."""
+    a, d, log_c, log_b = (params[..., i:i + 1] for i in range(4))
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        b = np.exp(np.clip(log_b, -5, 5))
+        log_ratio = np.log(x) - log_c
+        u = np.where(x > 0, np.exp(np.minimum(b * log_ratio, 50.0)), 0.0)
+        share = 1 / (1 + u)
+        f = d + (a - d) * share
+        df_du = -(a - d) * share ** 2
+        jacobian = np.stack([share, 1 - share,
+                             df_du * -b * u,
+                             np.where(x > 0, df_du * u * b * log_ratio, 0.0)], axis=-1)
+    return f, jacobian
+
+
+def _fit_logistic(x, y, w, iterations: int = LM_ITERATIONS):
+    # batched Levenberg-Marquardt: every plate takes its own damped Gauss-Newton steps
+    used = w > 0
+    low = np.where(used, y, np.inf).min(axis=-1)
+    high = np.where(used, y, -np.inf).max(axis=-1)
+    params = np.stack([low, high + (high - low), np.broadcast_to(np.log(np.median(x[x > 0])), low.shape),
+                       np.zeros_like(low)], axis=-1)
+    damping = np.full(low.shape, 1e-2)
+    sse = _weighted_sse(y - _logistic(params, x)[0], w)
+    for _ in range(iterations):
+        f, jacobian = _logistic(params, x)
+        weighted = jacobian * w[..., None]
+        hessian = np.einsum("...np,...nq->...pq", weighted, jacobian)
+        gradient = np.einsum("...np,...n->...p", weighted, y - f)
+        diagonal = np.diagonal(hessian, axis1=-2, axis2=-1)
+        damped = hessian + (damping[..., None] * diagonal + 1e-12)[..., None] * np.eye(4)
+        step = np.linalg.solve(damped, gradient[..., None])[..., 0]
+        trial = params + step
+        trial_sse = _weighted_sse(y - _logistic(trial, x)[0], w)
+        better = np.isfinite(trial_sse) & (trial_sse < sse)
+        params = np.where(better[..., None], trial, params)
+        sse = np.where(better, trial_sse, sse)
+        damping = np.clip(np.where(better, damping / 3, damping * 4), 1e-9, 1e9)
+    return params
+
+
+def _weighted_sse(residuals, w):
+    with np.errstate(over="ignore", invalid="ignore"):
+        return np.where(w > 0, w * np.nan_to_num(residuals, nan=np.inf) ** 2, 0.0).sum(axis=-1)
+
+
+def _weights(absorbance, weighting):
+    if weighting is None:
+        return np.ones_like(absorbance)
+    if weighting == "1/y^2":
+        # floor the blank so it cannot dominate
+        return 1 / np.maximum(np.abs(absorbance), 0.05) ** 2
+    raise ValueError(f"Weighting must be one of {WEIGHTINGS}")
+
+
+def _statistics(model, x, y, w, params):
+    """Residual standard error and weighted R² of fits, over the standards with weight > 0."""
+    residuals = y - predict(model, params, x)
+    used = (w > 0).sum(axis=-1)
+    sse = _weighted_sse(residuals, w)
+    dof = np.maximum(used - N_PARAMS[model], 1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = (w * y).sum(axis=-1) / w.sum(axis=-1)
+        sst = (w * (y - mean[..., None]) ** 2).sum(axis=-1)
+        return np.sqrt(sse / dof), 1 - sse / sst
+
+
+def _leave_one_out(model, x, y, w):
+    """(..., n) mask with at most one standard per plate whose removal makes the fit much tighter."""
+    n = len(x)
+    held_out = w[..., None, :] * (1 - np.eye(n))  # (..., n, n): fit i leaves out standard i
+    params = fit_model(model, x, np.broadcast_to(y[..., None, :], held_out.shape), held_out)
+    scale, _ = _statistics(model, x, y[..., None, :], held_out, params)
+    full, _ = _statistics(model, x, y, w, fit_model(model, x, y, w))
+    missed = np.abs(y - np.diagonal(predict(model, params, x), axis1=-2, axis2=-1))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        improvement = np.where((w > 0) & (missed > REJECT_ABSOLUTE), full[..., None] / scale, 0)
+    best = improvement.argmax(axis=-1)
+    return (np.arange(n) == best[..., None]) & (improvement.max(axis=-1)[..., None] > REJECT_RATIO)
+
+
+def fit_curves(absorbance, standards=STANDARD_CONCENTRATIONS, models=MODELS, weighting: str = None,
+               reject: bool = True) -> CurveFit:
+    """
+    Fit every model to the standards of one plate or a stack and choose the best for each plate.
+
+    Args:
+        absorbance: (..., n) absorbances of the standards, e.g. the mean of samples 1-8.
+        standards: (n,) their concentrations in mg/mL.
+        models: Models to try, simplest first.
+        weighting (str): None, or "1/y^2" to fit relative rather than absolute residuals.
+        reject (bool): Leave out the one worst standard per plate if it is an outlier.
+
+    Raises:
+        ValueError: For an unknown model or weighting, or too few standards.
+    """
+    x = np.asarray(standards, dtype=float)
+    y = np.asarray(absorbance, dtype=float)
+    if y.shape[-1] != len(x):
+        raise ValueError(f"Expected {len(x)} standards, got shape {y.shape}")
+    base = np.where(np.isfinite(y), _weights(y, weighting), 0.0)
+    y = np.nan_to_num(y)
+    for model in models:
+        if model not in N_PARAMS:
+            raise ValueError(f"Model must be one of {', '.join(MODELS)}")
+        if len(x) - N_PARAMS[model] < 2:
+            raise ValueError(f"Too few standards for a {model} fit")
+    # outliers are a property of the data, so the most flexible model decides and every model
+    # is compared on the same standards; a simpler model would "reject" where it bends away
+    rejected = _leave_one_out(models[-1], x, y, base) if reject else np.zeros(y.shape, dtype=bool)
+    w = np.where(rejected, 0.0, base)
+    params, residual_se, r_squared = {}, [], []
+    for model in models:
+        params[model] = fit_model(model, x, y, w)
+        se, r2 = _statistics(model, x, y, w, params[model])
+        residual_se.append(se)
+        r_squared.append(r2)
+    residual_se = np.stack(residual_se, axis=-1)
+    best = np.zeros(residual_se.shape[:-1], dtype=int)
+    for i in range(1, len(models)):
+        chosen = np.take_along_axis(residual_se, best[..., None], axis=-1)[..., 0]
+        best = np.where(residual_se[..., i] < SELECT_MARGIN * chosen, i, best)
+    return CurveFit(x, tuple(models), params, residual_se, np.stack(r_squared, axis=-1), rejected, best)
+
+
+def fit_plates(plates, weighting: str = None, reject: bool = True) -> CurveFit:
+    """Fit the standards (samples 1-8, replicate means without outliers) of one plate or a stack."""
+    return fit_curves(replicate_stats(plates)["clean_mean"][..., :len(STANDARD_CONCENTRATIONS)],
+                      weighting=weighting, reject=reject)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fit the BSA standard curves of plate reader exports.")
+    parser.add_argument("files", nargs="+", help="plate reader exports (.xlsx, .csv, .txt)")
+    parser.add_argument("--weighting", choices=["1/y^2"], help="weight residuals by 1/absorbance^2")
+    parser.add_argument("--no-reject", action="store_true", help="keep every standard")
+    args = parser.parse_args()
+
+    from plate_reader import read_plate
+
+    plates = np.stack([read_plate(path) for path in args.files])
+    curves = fit_plates(plates, args.weighting, not args.no_reject)
+    for path, model, r2, left_out in zip(args.files, curves.model, curves.fit_r_squared, curves.rejected):
+        note = ", ".join(f"{c:g}" for c in curves.standards[left_out])
+        print(f"{path}\t{model}\tR² {r2:.4f}" + (f"\tleft out {note} mg/mL" if note else ""))
@@ -0,0 +1,172 @@
+import json
+import os
+import struct
+import time
+from collections import deque
+from pathlib import Path
+
+# Protocol-step index for segmented recordings (see segments.py).
+#
+# The protocol appends a marker to steps.jsonl in the recording folder every
+# time it reaches a step (track_comments() turns every protocol.comment into
+# one). While recording, the recorder picks new markers up and resolves each
+# to the first frame written at or after it: segment file, frame number, time
+# offset and the byte offset of that frame's chunk, written to
+# step_index.jsonl. Finding "the third 80% EtOH wash" in a 16 hour run is then
+# a dictionary lookup and a single seek.
+
+STEPS_FILE = "steps.jsonl"
+STEP_INDEX_FILE = "step_index.jsonl"
+
+
+class StepLog:
+    """
+    Protocol side: append step markers to the recording folder as they happen.
+
+    Args:
+        recording_dir (str): Folder the recorder writes the segments into.
+    """
+
+    def __init__(self, recording_dir: str):
+        self.path = Path(recording_dir) / STEPS_FILE
+
+    def mark(self, step: str, when: float = None):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "a") as f:
+            f.write(json.dumps({"time": time.time() if when is None else when, "step": step}) + "\n")
+
+
+def track_comments(protocol, recording_dir: str) -> StepLog:
+    """
+    Record every protocol.comment() as a step marker for the video.
+
+    Nothing is written while the protocol is being analysed or simulated.
+
+    Args:
+        protocol: The ProtocolContext passed to run().
+        recording_dir (str): Folder the recorder writes the segments into.
+
+    Returns:
+        StepLog: For marking steps that have no comment.
+    """
+    log = StepLog(recording_dir)
+    if protocol.is_simulating():
+        log.mark = lambda step, when=None: None
+        return log
+    comment = protocol.comment
+
+    def comment_and_mark(msg):
+        log.mark(msg.strip())
+        return comment(msg)
+
+    protocol.comment = comment_and_mark
+    return log
+
+
+class StepIndexer:
+    """
+    Recorder side: resolve markers from steps.jsonl against the frames being written.
+
+    Args:
+        directory (str): Segmented recording folder.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = Path(directory)
+        self._steps = self.directory / STEPS_FILE
+        self._read = 0
+        self._pending = deque()
+
+    def frame_written(self, timestamp: float, segment: str, frame: int, offset: float, byte_offset: int = None):
+        """
+        Called after every frame; cheap (one stat) when no new markers arrived.
+
+        Args:
+            timestamp (float): Capture time of the frame.
+            segment (str): Segment file name.
+            frame (int): Frame number within the segment.
+            offset (float): Time offset of the frame within the segment.
+            byte_offset (int): File offset of the frame's chunk, if the container has one.
+        """
+        self._poll()
+        resolved = []
+        while self._pending and self._pending[0]["time"] <= timestamp:
+            marker = self._pending.popleft()
+            resolved.append({
+                **marker, "segment": segment, "frame": frame,
+                "offset": round(offset, 3), "byte_offset": byte_offset,
+            })
+        if resolved:
+            with open(self.directory / STEP_INDEX_FILE, "a") as f:
+                f.writelines(json.dumps(entry) + "\n" for entry in resolved)
+
+    def _poll(self):
+        try:
+            if os.stat(self._steps).st_size <= self._read:
+                return
+        except FileNotFoundError:
+            return
+        with open(self._steps, "rb") as f:
+            f.seek(self._read)
+            data = f.read()
+        # leave a half-written last line for the next poll
+        complete = data[:data.rfind(b"\n") + 1]
+        self._read += len(complete)
+        for line in complete.splitlines():
+            try:
+                self._pending.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+
+
+class StepIndex:
+    """
+    Look up protocol steps in a finished (or still running) recording.
+
+    Args:
+        directory (str): Segmented recording folder.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = Path(directory)
+        self.entries = []
+        self._by_step = {}
+        path = self.directory / STEP_INDEX_FILE
+        if path.exists():
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        break
+                    self.entries.append(entry)
+                    self._by_step.setdefault(entry["step"].lower(), []).append(entry)
+
+    def find(self, step: str, occurrence: int = 1) -> dict:
+        """
+        Find the nth time a step happened.
+
+        An exact (case-insensitive) match is a dictionary lookup; otherwise the
+        steps containing the text are searched in run order.
+
+        Args:
+            step (str): Step or comment text, e.g. "80% EtOH wash".
+            occurrence (int): 1 for the first time the step happened, 3 for the third, ...
+
+        Raises:
+            LookupError: If the step did not happen that many times.
+        """
+        key = step.lower()
+        matches = self._by_step.get(key) or [e for e in self.entries if key in e["step"].lower()]
+        if len(matches) < occurrence:
+            raise LookupError(f"Step {step!r} occurred {len(matches)} times in {self.directory}")
+        return matches[occurrence - 1]
+
+    def read_frame(self, entry: dict) -> bytes:
+        """Return the JPEG frame a step resolved to, read with a single seek into its segment."""
+        if entry.get("byte_offset") is None:
+            raise LookupError("Segment has no byte offsets (recorded with --encode)")
+        with open(self.directory / entry["segment"], "rb") as f:
+            f.seek(entry["byte_offset"])
+            _, size = struct.unpack("<4sI", f.read(8))
+            return f.read(size)
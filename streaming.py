@@ -0,0 +1,235 @@
+import asyncio
+import time
+
+from camera import Frame, FrameRing
+from frame_cache import ScaledFrameCache
+
+# Asyncio side of the camera. A single FramePump task waits on the shared ring
+# (one worker thread in total, not one per viewer) and hands each new frame to
+# every connected client through a one-slot queue. A client that cannot keep up
+# simply has its unsent frame replaced by the newest one, so a slow socket only
+# lowers that client's frame rate and never stalls the pump or the other viewers.
+#
+# Smaller resolution tiers (/stream?w=320) sit on top of the pump: a tier is a
+# single subscriber of the full-resolution pump that scales each frame once
+# and fans the result out to all of its own clients the same way. A tier only
+# runs while someone is watching it. Deck regions (/stream?roi=D2) are tiers
+# too, cropped once per frame for all of their clients.
+
+BOUNDARY = "frame"
+_PART_HEADER = b"--" + BOUNDARY.encode() + b"\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n"
+
+
+class FramePump:
+    """
+    Fan frames out from a FrameRing to any number of asyncio consumers.
+
+    Args:
+        ring (FrameRing): Shared ring buffer filled by the camera capture loop.
+    """
+
+    def __init__(self, ring: FrameRing):
+        self.ring = ring
+        self.dropped = 0
+        self._clients = set()
+        self._has_clients = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        return self
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for queue in self._clients:
+            _offer(queue, None)
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=1)
+        latest = self.ring.latest()
+        if latest is not None:
+            queue.put_nowait(latest)  # show something immediately instead of waiting a frame period
+        self._clients.add(queue)
+        self._has_clients.set()
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self._clients.discard(queue)
+        if not self._clients:
+            self._has_clients.clear()
+
+    @property
+    def clients(self) -> int:
+        return len(self._clients)
+
+    async def _run(self):
+        seq = self.ring.next_seq - 1
+        while not self.ring.closed:
+            # nobody watching: don't keep a worker thread parked on the ring
+            await self._has_clients.wait()
+            frame = await asyncio.to_thread(self.ring.wait_next, seq, 1.0)
+            if frame is None:
+                continue
+            seq = frame.seq
+            for queue in self._clients:
+                if _offer(queue, frame):
+                    self.dropped += 1
+        for queue in self._clients:
+            _offer(queue, None)
+
+
+class TierPump:
+    """
+    One resolution tier (or deck region): frames from the full-resolution pump,
+    scaled or cropped once each and shared by every client of the tier.
+
+    The tier subscribes to the source pump when its first client arrives and
+    stops scaling and unsubscribes when its last client leaves. If scaling
+    falls behind, frames are skipped rather than queued, and so are frames
+    that cannot be decoded (counted in failed).
+
+    Args:
+        source (FramePump): Full-resolution pump.
+        width (int): Width of the tier's frames, or None to keep the region's pixels.
+        cache (ScaledFrameCache): Where frames are scaled, shared with /snapshot.
+        roi (str): Name of the deck region to crop to, or None for the whole frame.
+    """
+
+    def __init__(self, source: FramePump, width: int, cache: ScaledFrameCache, roi: str = None):
+        self.source = source
+        self.width = width
+        self.cache = cache
+        self.roi = roi
+        self.dropped = 0
+        self.failed = 0
+        self._clients = set()
+        self._latest = None
+        self._task = None
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=1)
+        if self._latest is not None:
+            queue.put_nowait(self._latest)
+        self._clients.add(queue)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self._clients.discard(queue)
+        if not self._clients and self._task is not None:
+            # last viewer gone: stop scaling for this tier
+            self._task.cancel()
+            self._task = None
+            self._latest = None
+
+    @property
+    def clients(self) -> int:
+        return len(self._clients)
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def _run(self):
+        source = self.source.subscribe()
+        try:
+            while True:
+                frame = await source.get()
+                if frame is None:
+                    break
+                try:
+                    data = await asyncio.to_thread(self.cache.get, frame, self.width, self.roi)
+                except OSError:
+                    # a truncated or corrupt camera frame: the next one will do
+                    self.failed += 1
+                    continue
+                self._latest = Frame(frame.seq, frame.timestamp, data)
+                for queue in self._clients:
+                    if _offer(queue, self._latest):
+                        self.dropped += 1
+            for queue in self._clients:
+                _offer(queue, None)
+        finally:
+            self.source.unsubscribe(source)
+
+
+class StreamTiers:
+    """
+    The full-resolution pump plus a lazily started TierPump per width and region.
+
+    Args:
+        pump (FramePump): Full-resolution pump.
+        cache (ScaledFrameCache): Scaled frames, shared with /snapshot; its widths and regions are the tiers.
+    """
+
+    def __init__(self, pump: FramePump, cache: ScaledFrameCache):
+        self.pump = pump
+        self.cache = cache
+        self._tiers = {}
+
+    def tier(self, width: int = None, roi: str = None):
+        """
+        The pump for a width and region, or the full-resolution pump for neither.
+
+        Raises:
+            ValueError: If width is not one of the cache's widths, or roi not one of its regions.
+        """
+        if width is None and roi is None:
+            return self.pump
+        self.cache.check(width, roi)
+        if (width, roi) not in self._tiers:
+            self._tiers[width, roi] = TierPump(self.pump, width, self.cache, roi)
+        return self._tiers[width, roi]
+
+    def all(self) -> dict:
+        """Every pump started so far, by (width, roi); (None, None) is the full-resolution pump."""
+        return {(None, None): self.pump, **self._tiers}
+
+
+def _offer(queue: asyncio.Queue, item) -> bool:
+    """Put item in a one-slot queue, replacing a stale entry. Returns True if one was dropped."""
+    dropped = False
+    if queue.full():
+        queue.get_nowait()
+        dropped = True
+    queue.put_nowait(item)
+    return dropped
+
+
+async def mjpeg_stream(pump, lag=None, client: str = None):
+    """
+    Multipart MJPEG body for one client of a FramePump or TierPump.
+
+    Each part is yielded as header, JPEG payload and trailer so the frame bytes
+    from the ring go to the socket as-is instead of being copied into a new
+    bytes object per client per frame.
+
+    Args:
+        pump: FramePump or TierPump to stream.
+        lag (metrics.ClientLag): Where to record how old each frame is once it has been sent.
+        client (str): Name of the client in lag, e.g. its address.
+    """
+    queue = pump.subscribe()
+    try:
+        while True:
+            frame = await queue.get()
+            if frame is None:
+                return
+            yield _PART_HEADER % len(frame.data)
+            yield frame.data
+            yield b"\r\n"
+            # the generator resumes once the server has sent the part
+            if lag is not None:
+                lag.observe(client, time.time() - frame.timestamp)
+    finally:
+        pump.unsubscribe(queue)
+        if lag is not None:
+            lag.remove(client)
@@ -0,0 +1,149 @@
+import io
+import queue
+import threading
+import time
+from pathlib import Path
+
+from avi_writer import MjpegAviWriter
+
+# Review artifacts built while the run is being recorded, so they are ready
+# the moment it ends without a second pass over hours of video:
+#
+#   timelapse.avi   the run at SPEED x (one frame every SPEED / TIMELAPSE_FPS
+#                   seconds, e.g. every 6 s at 60x), scaled to TIMELAPSE_WIDTH
+#   contact_NN.jpg  one page per hour, a grid with a timestamped thumbnail for
+#                   every minute of that hour
+#
+# The recorder's capture thread offers every frame, but only the few that
+# are due (one every few seconds) are queued; scaling and writing happen on
+# this module's own low-volume thread.
+
+SPEED = 60
+TIMELAPSE_FPS = 10
+TIMELAPSE_WIDTH = 640
+THUMB_WIDTH = 160
+THUMB_SECONDS = 60
+SHEET_COLUMNS = 10
+SHEET_SECONDS = 3600  # one contact sheet page per hour
+
+
+class TimelapseBuilder:
+    """
+    Build a timelapse and contact sheets from frames offered during recording.
+
+    Args:
+        directory (str): Where timelapse.avi and the contact_NN.jpg pages are written.
+        speed (float): Timelapse speed-up.
+        prefix (str): Prepended to the file names (for single-file recordings).
+        roi (tuple): Crop the timelapse and thumbnails to this part of the deck (see rois.py), or None.
+    """
+
+    def __init__(self, directory: str, speed: float = SPEED, prefix: str = "", roi: tuple = None):
+        self.directory = Path(directory)
+        self.speed = speed
+        self.prefix = prefix
+        self.roi = roi
+        self.interval = speed / TIMELAPSE_FPS
+        self.dropped = 0
+        self.failed = 0  # frames that could not be decoded or written
+        self._start = None
+        self._next_timelapse = None
+        self._next_thumb = None
+        self._queue = queue.Queue(maxsize=8)
+        self._writer = None
+        self._page = None
+        self._thumbs = []  # (timestamp, jpeg) for the current page
+        self._thread = threading.Thread(target=self._run, name="timelapse", daemon=True)
+        self._thread.start()
+
+    def offer(self, frame) -> bool:
+        """
+        Called with every captured frame; queues it only if the timelapse or the sheet needs it.
+
+        Never blocks: if the worker is behind, the frame is skipped.
+        """
+        if self._start is None:
+            self._start = self._next_timelapse = self._next_thumb = frame.timestamp
+        timelapse = frame.timestamp >= self._next_timelapse
+        thumb = frame.timestamp >= self._next_thumb
+        if not (timelapse or thumb):
+            return False
+        if timelapse:
+            self._next_timelapse += self.interval * (int((frame.timestamp - self._next_timelapse) / self.interval) + 1)
+        if thumb:
+            self._next_thumb += THUMB_SECONDS * (int((frame.timestamp - self._next_thumb) / THUMB_SECONDS) + 1)
+        try:
+            self._queue.put_nowait((frame, timelapse, thumb))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def close(self, timeout: float = 30):
+        """Finish the timelapse and write the last (partial) contact sheet page."""
+        if self._thread.is_alive():
+            try:
+                self._queue.put(None, timeout=timeout)
+            except queue.Full:
+                print("Timelapse worker is stuck; not waiting for it")
+                return
+            self._thread.join(timeout)
+        if self.failed:
+            print(f"Timelapse skipped {self.failed} frames it could not process.")
+
+    def _run(self):
+        from frame_cache import scale_jpeg
+        from rois import crop_jpeg
+
+        # the frames are decoded and scaled down here anyway, so cropping costs nothing extra
+        scale = scale_jpeg if self.roi is None else lambda data, width: crop_jpeg(data, self.roi, width)
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+                try:
+                    self._process(*item, scale)
+                except Exception as e:
+                    # one corrupt frame (or a full disk for a moment) must not end the timelapse
+                    if not self.failed:
+                        print(f"Timelapse frame failed: {e}")
+                    self.failed += 1
+        finally:
+            try:
+                if self._writer is not None:
+                    self._writer.close()
+                if self._thumbs:
+                    self._write_sheet()
+            except Exception as e:
+                print(f"Could not finish the timelapse: {e}")
+
+    def _process(self, frame, timelapse: bool, thumb: bool, scale):
+        if timelapse:
+            if self._writer is None:
+                self.directory.mkdir(parents=True, exist_ok=True)
+                self._writer = MjpegAviWriter(str(self.directory / f"{self.prefix}timelapse.avi"), TIMELAPSE_FPS)
+            index = int((frame.timestamp - self._start) / self.interval + 0.5)
+            self._writer.write(scale(frame.data, TIMELAPSE_WIDTH), index=index)
+        if thumb:
+            page = int((frame.timestamp - self._start) // SHEET_SECONDS)
+            if self._page is not None and page != self._page:
+                self._write_sheet()
+            self._page = page
+            self._thumbs.append((frame.timestamp, scale(frame.data, THUMB_WIDTH)))
+
+    def _write_sheet(self):
+        from PIL import Image, ImageDraw
+
+        thumbs = [(when, Image.open(io.BytesIO(data)).convert("RGB")) for when, data in self._thumbs]
+        width, height = thumbs[0][1].size
+        rows = -(-len(thumbs) // SHEET_COLUMNS)
+        sheet = Image.new("RGB", (SHEET_COLUMNS * width, rows * height), "black")
+        draw = ImageDraw.Draw(sheet)
+        for i, (when, thumb) in enumerate(thumbs):
+            x, y = (i % SHEET_COLUMNS) * width, (i // SHEET_COLUMNS) * height
+            sheet.paste(thumb.resize((width, height)), (x, y))
+            draw.text((x + 3, y + 2), time.strftime("%H:%M", time.localtime(when)), fill="yellow")
+        self.directory.mkdir(parents=True, exist_ok=True)
+        sheet.save(self.directory / f"{self.prefix}contact_{self._page:02d}.jpg", quality=85)
+        self._thumbs = []
@@ -1,31 +1,244 @@
-from fastapi import FastAPI
-from fastapi.responses import StreamingResponse
-from v4l2py import Device
+import asyncio
+from contextlib import asynccontextmanager
+from email.utils import formatdate, parsedate_to_datetime
+from pathlib import Path
+import time
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import FileResponse, PlainTextResponse, Response, StreamingResponse
 from starlette.responses import HTMLResponse
 import uvicorn
 
+from analysis import FrameAnalysis
+from camera import Camera
+from file_serving import RangeFileResponse
+from frame_cache import ScaledFrameCache
+from live_hls import PLAYLIST, HlsLive
+from metrics import ClientLag, Registry, add_process_metrics, read_metrics_file
+from recordings import FILE_TYPES, list_recordings
+from retention import RetentionManager, touch
+from rois import load_rois
+from replay_buffer import request_dump
+from step_index import StepIndex
+from streaming import BOUNDARY, FramePump, StreamTiers, mjpeg_stream
+
 #This is a working applicationt to stream the opentrons flex camera using v4l2py
 
 device_path = "/dev/video2"
-device_id = int(device_path.replace("/dev/video", ""))
-app = FastAPI()
+recordings_dir = Path("/var/lib/jupyter/notebooks")
+live_dir = Path("/tmp/flex_live")
+live_budget = 512 * 2**20  # bytes of live segments kept for rewinding
+recordings_quota = 20 * 2**30  # older recordings are deleted beyond this
+compact_after_days = None  # e.g. 7 to transcode recordings nobody has used for a week
+# frame checks run in worker processes: name -> (top-level function taking JPEG bytes, seconds between frames)
+analyzers = {}
+
+# One capture loop for the whole app. Every /stream client reads the same
+# ring buffer, and record_video.py subscribes to it over the frame socket.
+camera = Camera(device_path)
+pump = FramePump(camera.ring)
+# deck, slots (A1..D3) and modules (mag_block, heater_shaker); see rois.py
+snapshots = ScaledFrameCache(rois=load_rois())
+# /stream?w=320 and /snapshot?w=320 share the same scaled frames (and ?roi=D2 the same crops)
+tiers = StreamTiers(pump, snapshots)
+# H.264 HLS of the 640 wide tier, for remote viewers and rewinding; encoded
+# only while someone is watching (started by the /live requests)
+live = HlsLive(tiers.tier(640), live_dir, byte_budget=live_budget)
+analysis = FrameAnalysis(camera.ring)
+for name, (fn, interval) in analyzers.items():
+    analysis.register(name, fn, interval)
+retention = RetentionManager(str(recordings_dir), recordings_quota, compact_after_days=compact_after_days)
+# frame numbers restart with the app, so ETags carry the start time as well
+etag_prefix = f"{int(time.time()):x}"
+
+# /metrics: read from the objects above when scraped, plus the recorder's file
+metrics = Registry()
+metrics.counter("flex_camera_frames_total", "Frames published to the camera ring.", lambda: camera.ring.next_seq)
+metrics.gauge("flex_stream_clients", "Subscribers per width and region (width 0 is full size, which the other tiers and the live encoder subscribe to).",
+              lambda: {(w or 0, roi or ""): p.clients for (w, roi), p in tiers.all().items()}, label=("width", "roi"))
+metrics.counter("flex_stream_frames_dropped_total", "Frames replaced before a slow client took them, per width and region.",
+                lambda: {(w or 0, roi or ""): p.dropped for (w, roi), p in tiers.all().items()}, label=("width", "roi"))
+metrics.gauge("flex_live_encoder_running", "1 while the live HLS encoder runs (someone watched in the last minute).",
+              lambda: int(live.running))
+metrics.counter("flex_stream_frames_failed_total", "Frames a tier could not decode and skipped, per width and region.",
+                lambda: {(w or 0, roi or ""): p.failed for (w, roi), p in tiers.all().items() if hasattr(p, "failed")},
+                label=("width", "roi"))
+metrics.counter("flex_live_segments_evicted_total", "Live HLS segments deleted to stay in the byte budget.",
+                lambda: live.evicted)
+metrics.counter("flex_analysis_frames_total", "Frames analyzed, skipped (analyzer behind) and failed.",
+                lambda: {(name, kind): count for name, stats in analysis.stats().items()
+                         for kind, count in stats.items()}, label=("analyzer", "outcome"))
+add_process_metrics(metrics, "flex_video_app")
+stream_lag = ClientLag(metrics)
 
-def gen_frames():
-    with Device.from_id(device_id) as cam:
-        for frame in cam:
-            yield b"--frame\r\nContent-Type: image/jpeg\r\n\r\n" + frame.data + b"\r\n"
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    camera.start()
+    pump.start()
+    analysis.start()
+    retention.start()
+    yield
+    retention.stop()
+    analysis.stop()
+    await live.stop()
+    await pump.stop()
+    camera.stop()
+
+app = FastAPI(lifespan=lifespan)
 
 @app.get("/", response_class=HTMLResponse)
 async def index():
     return '<html><img src="/stream" /></html>'
 
 @app.get("/stream")
-async def stream():
+async def stream(request: Request, w: int = None, roi: str = None):
+    """
+    Live MJPEG stream; w=160, 320 or 640 for a smaller tier (phones, the VPN).
+
+    roi=deck, a slot (D2) or a module (mag_block, heater_shaker) streams just that part of the deck.
+    """
+    try:
+        source = tiers.tier(w, roi)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    client = request.client and f"{request.client.host}:{request.client.port}"
+    # async generator: viewers never hold a threadpool worker, and slow ones skip frames
     return StreamingResponse(
-        gen_frames(),
-        media_type="multipart/x-mixed-replace; boundary=frame"
+        mjpeg_stream(source, stream_lag, client),
+        media_type=f"multipart/x-mixed-replace; boundary={BOUNDARY}"
     )
 
+@app.get("/rois")
+def regions():
+    """Deck regions for ?roi=, as (left, top, right, bottom) fractions of the frame."""
+    return snapshots.rois
+
+@app.get("/metrics")
+def prometheus_metrics():
+    """Stream, camera and recorder metrics in the Prometheus text format."""
+    return PlainTextResponse(metrics.render() + read_metrics_file(),
+                             media_type="text/plain; version=0.0.4")
+
+@app.get("/analysis")
+def analysis_results():
+    """Latest result of every frame analyzer, with the capture time of the frame it looked at."""
+    latest = analysis.latest()
+    return {name: {**vars(latest[name]), **stats} if name in latest else stats
+            for name, stats in analysis.stats().items()}
+
+@app.get(f"/live/{PLAYLIST}")
+async def live_playlist():
+    """HLS playlist of the live stream; open it in VLC, Safari or any HLS player."""
+    live.watch()
+    try:
+        playlist = await asyncio.to_thread(live.playlist)
+    except FileNotFoundError:
+        raise HTTPException(status_code=503, detail="Live stream is starting")
+    return PlainTextResponse(playlist, media_type="application/vnd.apple.mpegurl",
+                             headers={"Cache-Control": "no-cache"})
+
+@app.get("/live/{name}")
+async def live_segment(name: str):
+    live.watch()
+    try:
+        path = live.segment_path(name)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Segment not found")
+    return FileResponse(path, media_type="video/mp4", headers={"Cache-Control": "max-age=86400"})
+
+def not_modified(request: Request, etag: str, timestamp: float) -> bool:
+    if "if-none-match" in request.headers:
+        return etag in request.headers["if-none-match"]
+    try:
+        since = parsedate_to_datetime(request.headers["if-modified-since"]).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return False
+    return int(timestamp) <= since
+
+@app.get("/snapshot")
+def snapshot(request: Request, w: int = None, roi: str = None):
+    """
+    The latest camera frame, from memory, for dashboards that poll.
+
+    w=160, 320 or 640 returns a downscaled copy, scaled once per frame, and
+    roi= a crop of part of the deck (see /stream). Send
+    If-None-Match (or If-Modified-Since) to get a 304 while the frame is unchanged.
+    """
+    frame = camera.ring.latest()
+    if frame is None:
+        raise HTTPException(status_code=503, detail="No frame from the camera yet")
+    etag = f'"{etag_prefix}-{frame.seq}-{w or 0}{"-" + roi if roi else ""}"'
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(frame.timestamp, usegmt=True),
+        "Cache-Control": "no-cache",
+    }
+    if not_modified(request, etag, frame.timestamp):
+        return Response(status_code=304, headers=headers)
+    try:
+        data = frame.data if w is None and roi is None else snapshots.get(frame, w, roi)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except OSError as e:
+        # the camera handed over a frame that does not decode; the next one will
+        raise HTTPException(status_code=503, detail=f"Could not decode the latest frame: {e}")
+    return Response(data, media_type="image/jpeg", headers=headers)
+
+def recording_path(name: str) -> Path:
+    path = recordings_dir / name
+    if Path(name).name != name or not path.is_dir():
+        raise HTTPException(status_code=404, detail=f"No recording named {name}")
+    return path
+
+@app.get("/recordings")
+def recordings():
+    """Recordings in the notebooks folder, newest first, with protocol, duration, size and files."""
+    return list_recordings(recordings_dir)
+
+@app.get("/files/{path:path}")
+def recording_file(path: str, request: Request):
+    """A recording file (a path from /recordings), with Range support for seeking."""
+    root = recordings_dir.resolve()
+    target = (root / path).resolve()
+    if root not in target.parents or target.suffix not in FILE_TYPES or not target.is_file():
+        raise HTTPException(status_code=404, detail=f"No recording file {path}")
+    # downloaded recordings are the last to be deleted
+    touch(root / Path(path).parts[0])
+    return RangeFileResponse(target, request.headers.get("range"), FILE_TYPES[target.suffix])
+
+@app.get("/recordings/{name}/steps")
+def recording_steps(name: str):
+    """Every protocol step of a recording with its segment, time offset and byte offset."""
+    return StepIndex(recording_path(name)).entries
+
+@app.get("/recordings/{name}/steps/find")
+def find_step(name: str, step: str, occurrence: int = 1):
+    """Where the nth occurrence of a step is, e.g. ?step=80% EtOH wash&occurrence=3."""
+    try:
+        return StepIndex(recording_path(name)).find(step, occurrence)
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+@app.get("/recordings/{name}/steps/frame")
+def step_frame(name: str, step: str, occurrence: int = 1):
+    """The video frame at the nth occurrence of a step, read with a single seek."""
+    index = StepIndex(recording_path(name))
+    try:
+        entry = index.find(step, occurrence)
+        frame = index.read_frame(entry)
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    headers = {"X-Segment": entry["segment"], "X-Offset": str(entry["offset"])}
+    return Response(frame, media_type="image/jpeg", headers=headers)
+
+@app.post("/recorder/dump")
+def dump_recorder():
+    """Ask the recorder running with --buffer-minutes to write its last minutes to disk."""
+    try:
+        request_dump()
+    except ProcessLookupError:
+        raise HTTPException(status_code=404, detail="No recorder is buffering")
+    return {"dumping": True}
+
 if __name__ == "__main__":
     uvicorn.run(
         "video_app:app",  # Replace 'app:app' with your module and FastAPI instance
@@ -34,4 +247,4 @@ if __name__ == "__main__":
         reload=True      # Auto-reload on code changes (useful in development)
     )
 
-#to watch the stream go to http://172.23.226.47:8000/
\ No newline at end of file
+#to watch the stream go to http://172.23.226.47:8000/  